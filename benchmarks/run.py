@@ -0,0 +1,395 @@
+"""Benchmarks del pipeline de horarios de FGC Trains, sin Home Assistant.
+
+Carga los módulos de la integración que no dependen de Home Assistant
+(``gtfs_updater``, ``gtfs_index``, ``gtfs_cache``, ``catalog``) y mide:
+
+- ``ingest``: extracción del ZIP, construcción del índice y caché binaria.
+- ``cold_load``: carga del índice desde la caché (arranque de HA).
+- ``cold_build``: construcción del índice desde los CSV, sin caché.
+- ``memory``: memoria retenida por el índice construido y sus listas
+  diarias (con ``tracemalloc``), frente a ``MEMORY_BUDGET_PER_100K``.
+- ``warm_query``: primera consulta del día (compilación) y consultas
+  siguientes sobre el índice en memoria.
+- ``polling``: un día entero de ticks de minuto para varias entries, con
+  las mismas consultas que hace el coordinador en cada tick.
+- ``board``: paneles de salidas de todas las estaciones (servicio
+  ``get_departures``).
+- ``daily_update``: instalación de una nueva versión del feed, incremental
+  respecto a la activa.
+
+Cada etapa se ejecuta en un proceso propio para que el pico de RSS sea el
+de esa etapa. El resultado es un JSON con tiempo de pared, tiempo de CPU y
+pico de RSS por etapa, pensado para guardarse y compararse entre versiones.
+
+Uso::
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --zip google_transit.zip --entries 20
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import importlib
+import importlib.util
+import importlib.machinery
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPONENT_DIR = os.path.join(os.path.dirname(BENCH_DIR), "custom_components", "fgc_trains")
+PACKAGE = "fgc_trains"
+
+STAGES = (
+    "ingest", "cold_load", "cold_build", "memory", "warm_query", "polling", "board", "daily_update",
+)
+
+sys.path.insert(0, BENCH_DIR)
+from synthetic_feed import generate_feed  # noqa: E402
+
+
+def load_component(name):
+    """Importar un módulo de la integración sin ejecutar su ``__init__``.
+
+    ``__init__.py`` importa Home Assistant; el paquete se registra vacío
+    para que las importaciones relativas entre módulos funcionen.
+    """
+    if PACKAGE not in sys.modules:
+        spec = importlib.machinery.ModuleSpec(PACKAGE, None, is_package=True)
+        package = importlib.util.module_from_spec(spec)
+        package.__path__ = [COMPONENT_DIR]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+def peak_rss_kb():
+    """Pico de memoria residente del proceso en KB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KB y macOS en bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class Timer:
+    """Mide tiempo de pared y de CPU de un bloque."""
+
+    def __enter__(self):
+        """Empezar a medir."""
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        """Terminar de medir."""
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+
+    def result(self, **extra):
+        """Resultado de la etapa."""
+        return {
+            "wall_s": round(self.wall, 6),
+            "cpu_s": round(self.cpu, 6),
+            "peak_rss_kb": peak_rss_kb(),
+            **extra,
+        }
+
+
+def _query_date(index, requested):
+    """Fecha de consulta: la pedida, hoy si tiene servicio o la primera del feed."""
+    if requested:
+        return requested
+    today = datetime.now().strftime('%Y%m%d')
+    if index.has_service(today):
+        return today
+    dates = sorted(date for date in index._tables["dates"] if index.has_service(date))
+    return dates[0] if dates else today
+
+
+def _pairs(index, count, rng):
+    """Pares (ruta, origen, destino) servidos por algún viaje del feed."""
+    trips = index._tables["trips"]
+    routes = index._tables["routes"]
+    trip_route = index._columns["trip_route"]
+    trip_service = index._columns["trip_service"]
+    candidates = [trip for trip in range(len(trips)) if trip_service[trip] >= 0]
+    pairs = []
+    for trip in rng.sample(candidates, min(len(candidates), count * 4)):
+        schedule = index.trip_schedule(trips[trip])
+        if len(schedule) < 2:
+            continue
+        first, second = sorted(rng.sample(range(len(schedule)), 2))
+        pairs.append((routes[trip_route[trip]], schedule[first][0], schedule[second][0]))
+        if len(pairs) == count:
+            break
+    return pairs
+
+
+def _load_index(workdir):
+    """Índice de la versión activa del feed instalado en workdir."""
+    return load_component("gtfs_index").GTFSIndex.load(os.path.join(workdir, "gtfs"))
+
+
+def stage_ingest(args):
+    """Instalar el ZIP desde cero: extracción, índice y caché."""
+    updater = load_component("gtfs_updater")
+    gtfs_path = os.path.join(args.workdir, "gtfs")
+    shutil.rmtree(gtfs_path, ignore_errors=True)
+    zip_copy = os.path.join(args.workdir, "ingest.zip")
+    shutil.copy2(args.zip, zip_copy)
+    with Timer() as timer:
+        updater.install_gtfs(zip_copy, gtfs_path, {"size": os.path.getsize(args.zip)})
+    index = _load_index(args.workdir)
+    return timer.result(
+        zip_bytes=os.path.getsize(args.zip),
+        stop_times=len(index._columns["st_stop"]),
+        trips=len(index._tables["trips"]),
+        stops=len(index._tables["stops"]),
+    )
+
+
+def stage_cold_load(args):
+    """Cargar el índice desde la caché binaria."""
+    gtfs_index = load_component("gtfs_index")
+    with Timer() as timer:
+        gtfs_index.GTFSIndex.load(os.path.join(args.workdir, "gtfs"))
+    return timer.result()
+
+
+def stage_cold_build(args):
+    """Construir el índice desde los CSV extraídos."""
+    gtfs_index = load_component("gtfs_index")
+    feed_dir = gtfs_index.resolve_feed_dir(os.path.join(args.workdir, "gtfs"))
+    with Timer() as timer:
+        gtfs_index.GTFSIndex.build(feed_dir)
+    return timer.result()
+
+
+def stage_memory(args):
+    """Memoria retenida por el índice residente frente al presupuesto documentado."""
+    gtfs_index = load_component("gtfs_index")
+    feed_dir = gtfs_index.resolve_feed_dir(os.path.join(args.workdir, "gtfs"))
+    rng = random.Random(args.seed)
+    tracemalloc.start()
+    with Timer() as timer:
+        index = gtfs_index.GTFSIndex.build(feed_dir)
+        date = _query_date(index, args.date)
+        for route_id, origin, destination in _pairs(index, args.entries, rng):
+            index.day_departures(date, route_id, origin, destination)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stop_times = len(index._columns["st_stop"])
+    per_100k = retained * 100000 // stop_times if stop_times else 0
+    return timer.result(
+        stop_times=stop_times,
+        retained_bytes=retained,
+        build_peak_bytes=peak,
+        bytes_per_100k_stop_times=per_100k,
+        budget_per_100k=gtfs_index.MEMORY_BUDGET_PER_100K,
+        within_budget=per_100k <= gtfs_index.MEMORY_BUDGET_PER_100K,
+        estimate=index.memory_usage(),
+    )
+
+
+def stage_warm_query(args):
+    """Primera consulta (compila el día) y consultas siguientes."""
+    index = _load_index(args.workdir)
+    rng = random.Random(args.seed)
+    date = _query_date(index, args.date)
+    route_id, origin, destination = _pairs(index, 1, rng)[0]
+
+    with Timer() as first:
+        index.next_departures(date, route_id, origin, destination, 8 * 60, 4)
+    minutes = [rng.randrange(0, 24 * 60) for _query in range(args.queries)]
+    with Timer() as timer:
+        for after in minutes:
+            index.next_departures(date, route_id, origin, destination, after, 4)
+    return timer.result(
+        date=date,
+        first_query_s=round(first.wall, 6),
+        queries=args.queries,
+        per_query_us=round(timer.wall / args.queries * 1e6, 3),
+    )
+
+
+def stage_polling(args):
+    """Un día de ticks de minuto para varias entries, como el coordinador."""
+    gtfs_index = load_component("gtfs_index")
+    index = _load_index(args.workdir)
+    rng = random.Random(args.seed)
+    date = _query_date(index, args.date)
+    entries = _pairs(index, args.entries, rng)
+
+    with Timer() as timer:
+        for minute in range(gtfs_index.MINUTES_PER_DAY):
+            for route_id, origin, destination in entries:
+                if not index.has_service(date) and not index.has_service(gtfs_index.previous_date(date)):
+                    continue
+                len(index.day_departures(date, route_id, origin, destination))
+                index.next_departures(date, route_id, origin, destination, minute, 4)
+    ticks = gtfs_index.MINUTES_PER_DAY * len(entries)
+    return timer.result(
+        date=date,
+        entries=len(entries),
+        ticks=ticks,
+        per_tick_us=round(timer.wall / ticks * 1e6, 3) if ticks else None,
+    )
+
+
+def stage_board(args):
+    """Paneles de salidas de la próxima hora en todas las estaciones.
+
+    Mide la respuesta parada a parada en Python puro y, si NumPy está
+    instalado, la del motor vectorizado (incluida su construcción).
+    """
+    gtfs_numpy = load_component("gtfs_numpy")
+    index = _load_index(args.workdir)
+    date = _query_date(index, args.date)
+    stops = list(index._tables["stops"])
+    with Timer() as timer:
+        python_boards = {
+            stop_id: index.departure_board(date, stop_id, 8 * 60, 60, 10)
+            for stop_id in stops
+        }
+    result = timer.result(
+        date=date,
+        stops=len(stops),
+        departures=sum(len(board) for board in python_boards.values()),
+        numpy=None,
+    )
+
+    np = gtfs_numpy.load_numpy()
+    if np is not None:
+        with Timer() as build:
+            engine = gtfs_numpy.BoardEngine(index, np)
+        with Timer() as query:
+            numpy_boards = engine.boards(date, stops, 8 * 60, 60, 10)
+        result["numpy"] = {
+            "build_s": round(build.wall, 6),
+            "wall_s": round(query.wall, 6),
+            "cpu_s": round(query.cpu, 6),
+            "matches_python": numpy_boards == python_boards,
+        }
+    return result
+
+
+def stage_daily_update(args):
+    """Instalar una nueva versión del feed sobre la activa (incremental)."""
+    updater = load_component("gtfs_updater")
+    zip_copy = os.path.join(args.workdir, "daily.zip")
+    shutil.copy2(args.update_zip, zip_copy)
+    with Timer() as timer:
+        updater.install_gtfs(
+            zip_copy, os.path.join(args.workdir, "gtfs"), {"size": os.path.getsize(args.update_zip)}
+        )
+    index = _load_index(args.workdir)
+    meta = updater.read_feed_meta(index.feed_dir)
+    return timer.result(version=index.version, diff=meta.get("diff"))
+
+
+def run_stage(args):
+    """Ejecutar una etapa en este proceso e imprimir su resultado JSON."""
+    result = globals()[f"stage_{args.stage}"](args)
+    print(json.dumps(result))
+
+
+def run_all(args):
+    """Ejecutar las etapas en procesos separados y reunir los resultados."""
+    workdir = args.workdir or tempfile.mkdtemp(prefix="fgc_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        source = {"zip": args.zip}
+        if args.zip is None:
+            args.zip = os.path.join(workdir, "feed.zip")
+            source = {
+                "synthetic": {
+                    "routes": args.routes, "stops": args.stops, "trips": args.trips,
+                    "days": args.days, "seed": args.seed,
+                },
+                "stop_times": generate_feed(
+                    args.zip, args.routes, args.stops, trips=args.trips, days=args.days, seed=args.seed
+                ),
+            }
+        update_zip = args.update_zip
+        if update_zip is None:
+            # Sin ZIP de actualización: la misma red con un 5% de viajes cambiados
+            update_zip = os.path.join(workdir, "update.zip")
+            if "synthetic" in source:
+                generate_feed(
+                    update_zip, args.routes, args.stops, trips=args.trips, days=args.days,
+                    seed=args.seed, variant=0.05,
+                )
+            else:
+                shutil.copy2(args.zip, update_zip)
+
+        # Las etapas se ejecutan en el orden de STAGES; ingest instala el
+        # feed que usan las demás, así que se ejecuta siempre
+        selected = [stage for stage in STAGES if stage in args.stages or stage == "ingest"]
+        stages = {}
+        for stage in selected:
+            command = [
+                sys.executable, os.path.abspath(__file__), "--stage", stage,
+                "--workdir", workdir, "--zip", args.zip, "--update-zip", update_zip,
+                "--entries", str(args.entries), "--queries", str(args.queries),
+                "--seed", str(args.seed),
+            ]
+            if args.date:
+                command += ["--date", args.date]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                stages[stage] = {"error": completed.stderr.strip().splitlines()[-1:]}
+                continue
+            if stage in args.stages:
+                stages[stage] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+        report = {
+            "generated": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "source": source,
+            "stages": stages,
+        }
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def main():
+    """Punto de entrada de línea de comandos."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--zip", help="ZIP GTFS real a reproducir (por defecto, uno sintético)")
+    parser.add_argument("--update-zip", help="ZIP de la actualización diaria")
+    parser.add_argument("--routes", type=int, default=8)
+    parser.add_argument("--stops", type=int, default=120)
+    parser.add_argument("--trips", type=int, default=120)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--entries", type=int, default=10, help="entries simuladas en polling")
+    parser.add_argument("--queries", type=int, default=10000, help="consultas de warm_query")
+    parser.add_argument("--date", help="fecha de consulta YYYYMMDD")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--workdir", help="directorio de trabajo (se conserva)")
+    parser.add_argument("--output", help="fichero JSON de resultados")
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args)
+    else:
+        run_all(args)
+
+
+if __name__ == "__main__":
+    main()
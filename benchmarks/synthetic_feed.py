@@ -0,0 +1,175 @@
+"""Generador de feeds GTFS sintéticos para los benchmarks de FGC Trains.
+
+Genera un ZIP con la misma estructura que el de FGC (routes, trips,
+stop_times, stops, calendar y calendar_dates) a la escala indicada: número
+de líneas, estaciones, viajes por sentido y día, y días de servicio. Las
+líneas comparten estaciones entre sí, hay viajes después de medianoche
+(horas >= 24:00) y servicios laborables y de fin de semana con excepciones.
+
+Con ``--variant`` se modifica una fracción de los viajes (horas
+desplazadas, viajes nuevos y eliminados) para simular la actualización
+diaria del feed respecto al ZIP generado con la misma semilla.
+
+Uso::
+
+    python benchmarks/synthetic_feed.py feed.zip --routes 8 --trips 120
+"""
+import io
+import csv
+import random
+import argparse
+import zipfile
+from datetime import date, timedelta
+
+# Estaciones y líneas por defecto: del orden de 100k stop_times
+DEFAULT_ROUTES = 8
+DEFAULT_STOPS = 120
+DEFAULT_STOPS_PER_ROUTE = 22
+DEFAULT_TRIPS = 120
+DEFAULT_DAYS = 60
+
+FIRST_DEPARTURE = 5 * 60  # 05:00
+LAST_DEPARTURE = 25 * 60 + 30  # 01:30 del día siguiente
+MINUTES_BETWEEN_STOPS = (2, 4)
+
+
+def _time(minutes):
+    """Hora GTFS (puede pasar de 24:00)."""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}:00"
+
+
+def _writer(zip_file, name):
+    """Fichero CSV dentro del ZIP, escrito en streaming."""
+    text = io.TextIOWrapper(zip_file.open(name, 'w'), encoding='utf-8', newline='')
+    return text, csv.writer(text, lineterminator='\n')
+
+
+def generate_feed(path, routes=DEFAULT_ROUTES, stops=DEFAULT_STOPS,
+                  stops_per_route=DEFAULT_STOPS_PER_ROUTE, trips=DEFAULT_TRIPS,
+                  days=DEFAULT_DAYS, start=None, seed=1, variant=0.0):
+    """Escribir un ZIP GTFS sintético; devuelve el número de stop_times."""
+    rng = random.Random(seed)
+    start = start or date.today() - timedelta(days=1)
+    end = start + timedelta(days=days - 1)
+    stop_ids = [f"ST{number:04d}" for number in range(stops)]
+    stops_per_route = min(stops_per_route, stops)
+
+    # Las secuencias de paradas dependen solo de la semilla, no de variant
+    lines = []
+    for number in range(routes):
+        sequence = rng.sample(stop_ids, stops_per_route)
+        lines.append((f"L{number + 1}", sequence))
+
+    variant_rng = random.Random(f"{seed}-variant")
+    stop_times = 0
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        text, writer = _writer(zip_file, 'agency.txt')
+        writer.writerow(('agency_id', 'agency_name', 'agency_url', 'agency_timezone'))
+        writer.writerow(('SYN', 'Synthetic', 'https://example.invalid', 'Europe/Madrid'))
+        text.close()
+
+        text, writer = _writer(zip_file, 'stops.txt')
+        writer.writerow(('stop_id', 'stop_name', 'stop_lat', 'stop_lon'))
+        for stop_id in stop_ids:
+            writer.writerow((stop_id, f"Estació {stop_id}", '41.0', '2.0'))
+        text.close()
+
+        text, writer = _writer(zip_file, 'routes.txt')
+        writer.writerow(('route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'))
+        for route_id, sequence in lines:
+            writer.writerow((route_id, 'SYN', route_id, f"{sequence[0]} - {sequence[-1]}", '2'))
+        text.close()
+
+        text, writer = _writer(zip_file, 'calendar.txt')
+        writer.writerow((
+            'service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+            'saturday', 'sunday', 'start_date', 'end_date',
+        ))
+        writer.writerow(('WK', 1, 1, 1, 1, 1, 0, 0, start.strftime('%Y%m%d'), end.strftime('%Y%m%d')))
+        writer.writerow(('WE', 0, 0, 0, 0, 0, 1, 1, start.strftime('%Y%m%d'), end.strftime('%Y%m%d')))
+        text.close()
+
+        # Algún festivo entre semana: horario de fin de semana
+        text, writer = _writer(zip_file, 'calendar_dates.txt')
+        writer.writerow(('service_id', 'date', 'exception_type'))
+        for offset in range(10, days, 30):
+            day = start + timedelta(days=offset)
+            if day.weekday() < 5:
+                writer.writerow(('WK', day.strftime('%Y%m%d'), 2))
+                writer.writerow(('WE', day.strftime('%Y%m%d'), 1))
+        text.close()
+
+        # Un ZIP solo admite un fichero abierto para escritura: los viajes
+        # (pocos) se acumulan y se escriben después de stop_times.txt
+        trip_rows = []
+        times_text, times_writer = _writer(zip_file, 'stop_times.txt')
+        times_writer.writerow((
+            'trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence',
+            'pickup_type', 'drop_off_type',
+        ))
+
+        for route_id, sequence in lines:
+            hops = [rng.randint(*MINUTES_BETWEEN_STOPS) for _stop in sequence[1:]]
+            for direction in (0, 1):
+                order = sequence if direction == 0 else sequence[::-1]
+                route_hops = hops if direction == 0 else hops[::-1]
+                for service_id, count in (('WK', trips), ('WE', max(1, trips // 2))):
+                    headway = (LAST_DEPARTURE - FIRST_DEPARTURE) / count
+                    for number in range(count):
+                        trip_id = f"{route_id}-{direction}-{service_id}-{number}"
+                        departure = FIRST_DEPARTURE + int(number * headway)
+                        if variant and variant_rng.random() < variant:
+                            # Viaje modificado, eliminado o duplicado en la nueva versión
+                            change = variant_rng.choice(('shift', 'drop', 'add'))
+                            if change == 'drop':
+                                continue
+                            if change == 'shift':
+                                departure += variant_rng.randint(1, 3)
+                            else:
+                                trip_id = f"{trip_id}b"
+                                departure += int(headway // 2)
+                        trip_rows.append((route_id, service_id, trip_id, order[-1], direction, route_id))
+                        minutes = departure
+                        for position, stop_id in enumerate(order):
+                            times_writer.writerow((
+                                trip_id, _time(minutes), _time(minutes), stop_id, position + 1, 0, 0
+                            ))
+                            if position < len(route_hops):
+                                minutes += route_hops[position]
+                        stop_times += len(order)
+
+        times_text.close()
+
+        text, writer = _writer(zip_file, 'trips.txt')
+        writer.writerow(('route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id', 'shape_id'))
+        writer.writerows(trip_rows)
+        text.close()
+
+    return stop_times
+
+
+def main():
+    """Punto de entrada de línea de comandos."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="ZIP de salida")
+    parser.add_argument("--routes", type=int, default=DEFAULT_ROUTES)
+    parser.add_argument("--stops", type=int, default=DEFAULT_STOPS)
+    parser.add_argument("--stops-per-route", type=int, default=DEFAULT_STOPS_PER_ROUTE)
+    parser.add_argument("--trips", type=int, default=DEFAULT_TRIPS,
+                        help="viajes laborables por línea y sentido")
+    parser.add_argument("--days", type=int, default=DEFAULT_DAYS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--variant", type=float, default=0.0,
+                        help="fracción de viajes modificados respecto a la misma semilla")
+    args = parser.parse_args()
+
+    stop_times = generate_feed(
+        args.path, args.routes, args.stops, args.stops_per_route, args.trips,
+        args.days, seed=args.seed, variant=args.variant,
+    )
+    print(f"{args.path}: {stop_times} stop_times")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,45 @@
 import logging
 from datetime import timedelta
 
+import voluptuous as vol
+
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.core import HomeAssistant, ServiceCall, ServiceResponse, SupportsResponse
+from homeassistant.exceptions import ServiceValidationError
+import homeassistant.helpers.config_validation as cv
 
-from .const import DOMAIN, PLATFORMS, DEFAULT_GTFS_PATH, DEFAULT_UPDATE_INTERVAL
+from .const import (
+    DOMAIN,
+    DATA_FEEDS,
+    PLATFORMS,
+    DEFAULT_GTFS_PATH,
+    DEFAULT_UPDATE_INTERVAL,
+    DEFAULT_RT_UPDATE_INTERVAL,
+    DEFAULT_SCHEDULE_MODE,
+    DEFAULT_TRAIN_SENSORS,
+    MAIN_SENSOR_TRAINS,
+)
 from .coordinator import FGCDataCoordinator
-from .gtfs_updater import update_gtfs
 
 _LOGGER = logging.getLogger(__name__)
 
+NEXT_ARRIVAL_SCHEMA = vol.Schema({
+    vol.Required("arrive_by"): cv.time,
+    vol.Optional("entry_id"): cv.string,
+    vol.Optional("origin"): cv.string,
+    vol.Optional("destination"): cv.string,
+    vol.Optional("line"): cv.string,
+    vol.Optional("limit", default=4): vol.All(vol.Coerce(int), vol.Range(min=1, max=20)),
+})
+
+GET_DEPARTURES_SCHEMA = vol.Schema({
+    vol.Required("stops"): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional("window", default=60): vol.All(vol.Coerce(int), vol.Range(min=1, max=24 * 60)),
+    vol.Optional("limit", default=10): vol.All(vol.Coerce(int), vol.Range(min=1, max=100)),
+    vol.Optional("line"): cv.string,
+    vol.Optional("entry_id"): cv.string,
+})
+
 async def async_setup(hass: HomeAssistant, config: dict):
     """Configuración del componente."""
     hass.data.setdefault(DOMAIN, {})
@@ -20,46 +50,144 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Configurar desde config entry."""
     _LOGGER.info(f"Configurando FGC Trains: {entry.data}")
     
+    # Las opciones modificadas desde el options flow prevalecen sobre los datos
+    config = {**entry.data, **entry.options}
+    
     coordinator = FGCDataCoordinator(
         hass,
-        entry.data.get("gtfs_path", DEFAULT_GTFS_PATH),
-        entry.data.get("origin", "TR"),
-        entry.data.get("destination", "PC"),
-        entry.data.get("line", "S1"),
-        entry.data.get("update_interval", DEFAULT_UPDATE_INTERVAL),
-        entry.data.get("auto_update", True)  # ← Nuevo parámetro
+        config.get("gtfs_path", DEFAULT_GTFS_PATH),
+        config.get("origin", "TR"),
+        config.get("destination", "PC"),
+        config.get("line", "S1"),
+        config.get("update_interval", DEFAULT_UPDATE_INTERVAL),
+        config.get("auto_update_gtfs", config.get("auto_update", True)),
+        config.get("rt_url") or None,
+        config.get("rt_update_interval", DEFAULT_RT_UPDATE_INTERVAL),
+        config.get("schedule_mode", DEFAULT_SCHEDULE_MODE),
+        # Trenes a calcular: los de los sensores individuales o los del principal
+        max(config.get("train_sensors", DEFAULT_TRAIN_SENSORS), MAIN_SENSOR_TRAINS)
     )
     
-    await coordinator.async_config_entry_first_refresh()
-    
     hass.data.setdefault(DOMAIN, {})
     hass.data[DOMAIN][entry.entry_id] = coordinator
     
-    await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
+    try:
+        await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
+    except Exception:
+        hass.data[DOMAIN].pop(entry.entry_id, None)
+        coordinator.async_release()
+        raise
+    
+    # El GTFS se carga en segundo plano: el arranque de HA no espera a
+    # parsearlo ni a descargarlo, y los sensores no están disponibles
+    # hasta que termina la primera carga
+    entry.async_create_background_task(
+        hass, coordinator.async_load(), f"{DOMAIN}_load_{entry.entry_id}"
+    )
     
     async def update_gtfs_service(call: ServiceCall):
         """Servicio para actualizar GTFS."""
         _LOGGER.info("Actualizando GTFS manualmente...")
-        gtfs_path = entry.data.get("gtfs_path", DEFAULT_GTFS_PATH)
-        success = await hass.async_add_executor_job(update_gtfs, gtfs_path)
+        for feed in list(hass.data[DOMAIN].get(DATA_FEEDS, {}).values()):
+            # Los coordinadores del feed se refrescan al terminar la actualización
+            success = await feed.async_update()
+            
+            if success:
+                _LOGGER.info(f"✅ GTFS actualizado correctamente: {feed.gtfs_path}")
+            else:
+                _LOGGER.error(f"❌ Error actualizando GTFS: {feed.gtfs_path}")
+    
+    async def next_arrival_service(call: ServiceCall) -> ServiceResponse:
+        """Servicio: trenes que llegan a destino antes de una hora."""
+        coordinators = {
+            entry_id: value for entry_id, value in hass.data[DOMAIN].items()
+            if isinstance(value, FGCDataCoordinator)
+        }
+        if "entry_id" in call.data:
+            coordinator = coordinators.get(call.data["entry_id"])
+        else:
+            coordinator = next(iter(coordinators.values()), None)
+        if coordinator is None:
+            raise ServiceValidationError("No hay ninguna ruta FGC configurada con ese entry_id")
         
-        if success:
-            coordinator.last_gtfs_update = None  # Forzar nueva descarga en próxima actualización
-            await coordinator.async_refresh()
-            _LOGGER.info("✅ GTFS actualizado correctamente")
+        result = await hass.async_add_executor_job(
+            coordinator.arrivals_before,
+            call.data["arrive_by"],
+            call.data.get("origin"),
+            call.data.get("destination"),
+            call.data.get("line"),
+            call.data["limit"],
+        )
+        if result.get("uncovered"):
+            # Como en get_departures: las siguientes llamadas ya tendrán trenes
+            coordinator.feed.async_cover_stops(result["uncovered"])
+        return result
+    
+    async def get_departures_service(call: ServiceCall) -> ServiceResponse:
+        """Servicio: paneles de salidas de varias paradas en una sola llamada."""
+        if "entry_id" in call.data:
+            coordinator = hass.data[DOMAIN].get(call.data["entry_id"])
+            if not isinstance(coordinator, FGCDataCoordinator):
+                raise ServiceValidationError("No hay ninguna ruta FGC configurada con ese entry_id")
+            feed = coordinator.feed
         else:
-            _LOGGER.error("❌ Error actualizando GTFS")
+            feeds = list(hass.data[DOMAIN].get(DATA_FEEDS, {}).values())
+            if not feeds:
+                raise ServiceValidationError("No hay ninguna ruta FGC configurada")
+            if len(feeds) > 1:
+                # Cada gtfs_path es un feed distinto: no se elige uno al azar
+                raise ServiceValidationError(
+                    "Hay varios GTFS configurados: indica entry_id para elegir uno"
+                )
+            feed = feeds[0]
+        
+        result = await hass.async_add_executor_job(
+            feed.departure_boards,
+            call.data["stops"],
+            call.data["window"],
+            call.data["limit"],
+            call.data.get("line"),
+        )
+        if result.get("uncovered"):
+            # Las siguientes llamadas ya tendrán sus salidas
+            feed.async_cover_stops(result["uncovered"])
+        return result
     
     if not hass.services.has_service(DOMAIN, "update_gtfs"):
         hass.services.async_register(DOMAIN, "update_gtfs", update_gtfs_service)
     
+    if not hass.services.has_service(DOMAIN, "next_arrival_before"):
+        hass.services.async_register(
+            DOMAIN,
+            "next_arrival_before",
+            next_arrival_service,
+            schema=NEXT_ARRIVAL_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+    
+    if not hass.services.has_service(DOMAIN, "get_departures"):
+        hass.services.async_register(
+            DOMAIN,
+            "get_departures",
+            get_departures_service,
+            schema=GET_DEPARTURES_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+    
+    entry.async_on_unload(entry.add_update_listener(async_reload_entry))
+    
     return True
 
+async def async_reload_entry(hass: HomeAssistant, entry: ConfigEntry):
+    """Recargar la entry al cambiar sus opciones."""
+    await hass.config_entries.async_reload(entry.entry_id)
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Descargar config entry."""
     unload_ok = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
     
     if unload_ok:
-        hass.data[DOMAIN].pop(entry.entry_id)
+        coordinator = hass.data[DOMAIN].pop(entry.entry_id)
+        coordinator.async_release()
     
     return unload_ok
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""Catálogo de líneas y estaciones del GTFS para FGC Trains.
+
+Se genera durante la extracción del ZIP (mientras se leen routes, trips,
+stop_times y stops, antes de podar las paradas) y se guarda como un JSON
+pequeño junto al GTFS, de modo que el config flow pueda ofrecer todas las
+estaciones de la red sin parsear CSV.
+"""
+import os
+import json
+import logging
+
+from .gtfs_index import resolve_feed_dir
+
+_LOGGER = logging.getLogger(__name__)
+
+CATALOG_FILE = "catalog.json"
+
+
+class CatalogBuilder:
+    """Acumula el catálogo fila a fila durante la extracción del GTFS."""
+
+    def __init__(self):
+        """Inicializar catálogo vacío."""
+        self.routes = {}
+        self.stop_names = {}
+        self.stop_routes = {}
+        self._trip_routes = {}
+
+    def row_handler(self, file_name, header):
+        """Función que registra una fila cruda de file_name, o None si no interesa."""
+        def position(column):
+            return header.index(column) if column in header else None
+
+        if file_name == 'routes.txt':
+            route_pos = position('route_id')
+            short_pos = position('route_short_name')
+            long_pos = position('route_long_name')
+
+            def handle(row):
+                short_name = row[short_pos] if short_pos is not None else ''
+                long_name = row[long_pos] if long_pos is not None else ''
+                self.routes[row[route_pos]] = (short_name, long_name)
+            return handle
+
+        if file_name == 'trips.txt':
+            trip_pos = position('trip_id')
+            route_pos = position('route_id')
+
+            def handle(row):
+                self._trip_routes[row[trip_pos]] = row[route_pos]
+            return handle
+
+        if file_name == 'stop_times.txt':
+            trip_pos = position('trip_id')
+            stop_pos = position('stop_id')
+            trip_routes = self._trip_routes
+            stop_routes = self.stop_routes
+
+            def handle(row):
+                route = trip_routes.get(row[trip_pos])
+                if route is not None:
+                    routes = stop_routes.get(row[stop_pos])
+                    if routes is None:
+                        routes = stop_routes[row[stop_pos]] = set()
+                    routes.add(route)
+            return handle
+
+        if file_name == 'stops.txt':
+            stop_pos = position('stop_id')
+            name_pos = position('stop_name')
+
+            def handle(row):
+                self.stop_names[row[stop_pos]] = row[name_pos] if name_pos is not None else row[stop_pos]
+            return handle
+
+        return None
+
+    def write(self, dest_dir):
+        """Guardar el catálogo: líneas y estaciones con las líneas que paran en ellas."""
+        routes = {}
+        for route_id in sorted(set(self.routes).union(*self.stop_routes.values())):
+            short_name, long_name = self.routes.get(route_id, ('', ''))
+            short_name = short_name or route_id
+            routes[route_id] = f"{short_name} - {long_name}" if long_name else short_name
+
+        stops = {
+            stop_id: {
+                "name": self.stop_names.get(stop_id, stop_id),
+                "routes": sorted(routes_served),
+            }
+            for stop_id, routes_served in sorted(self.stop_routes.items())
+        }
+        with open(os.path.join(dest_dir, CATALOG_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"routes": routes, "stops": stops}, f, ensure_ascii=False)
+        self._trip_routes.clear()
+
+
+def read_catalog(gtfs_path):
+    """Leer el catálogo de la versión activa del GTFS (None si no existe)."""
+    try:
+        with open(os.path.join(resolve_feed_dir(gtfs_path), CATALOG_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as err:
+        _LOGGER.debug(f"Catálogo GTFS no disponible en {gtfs_path}: {err}")
+        return None
+
+
+def line_stations(catalog, line):
+    """Estaciones (id -> nombre) por las que pasa una línea, ordenadas por nombre."""
+    stops = catalog["stops"]
+    served = [stop_id for stop_id, stop in stops.items() if line in stop["routes"]]
+    if not served:
+        served = list(stops)
+    return {
+        stop_id: stops[stop_id]["name"]
+        for stop_id in sorted(served, key=lambda stop_id: stops[stop_id]["name"])
+    }
@@ -5,9 +5,25 @@ import os
 
 from homeassistant import config_entries
 from homeassistant.core import callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 
-from .const import DOMAIN, LINES, STATIONS, DEFAULT_GTFS_PATH, DEFAULT_UPDATE_INTERVAL
-from .gtfs_updater import update_gtfs
+from .const import (
+    DOMAIN,
+    ANY_LINE,
+    ANY_LINE_NAME,
+    LINES,
+    STATIONS,
+    DEFAULT_GTFS_PATH,
+    DEFAULT_UPDATE_INTERVAL,
+    DEFAULT_RT_UPDATE_INTERVAL,
+    DEFAULT_SCHEDULE_MODE,
+    DEFAULT_TRAIN_SENSORS,
+    MAX_TRAIN_SENSORS,
+    SCHEDULE_MODES,
+)
+from .catalog import line_stations, read_catalog
+from .gtfs_index import resolve_feed_dir
+from .gtfs_updater import async_update_gtfs
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -16,42 +32,51 @@ class FGCTrainsConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
 
     VERSION = 1
 
+    def __init__(self):
+        """Inicializar config flow."""
+        self._user_input = {}
+        self._catalog = None
+
     async def async_step_user(self, user_input=None):
-        """Paso inicial de configuración."""
+        """Paso inicial de configuración: línea, datos GTFS y opciones."""
         errors = {}
 
         if user_input is not None:
-            if user_input.get("origin") == user_input.get("destination"):
-                errors["base"] = "same_origin_destination"
-            else:
-                gtfs_path = user_input.get("gtfs_path", DEFAULT_GTFS_PATH)
-                
-                if not os.path.exists(os.path.join(gtfs_path, "stops.txt")):
-                    _LOGGER.info("GTFS no encontrado, descargando...")
-                    success = await self.hass.async_add_executor_job(update_gtfs, gtfs_path)
-                    if not success:
-                        errors["base"] = "gtfs_download_failed"
-                
-                if not errors:
-                    await self.async_set_unique_id(
-                        f"{user_input['line']}_{user_input['origin']}_{user_input['destination']}"
-                    )
-                    self._abort_if_unique_id_configured()
-                    
-                    return self.async_create_entry(
-                        title=f"FGC {user_input['line']}: {STATIONS.get(user_input['origin'])} → {STATIONS.get(user_input['destination'])}",
-                        data=user_input,
-                    )
+            gtfs_path = user_input.get("gtfs_path", DEFAULT_GTFS_PATH)
+            
+            if not os.path.exists(os.path.join(resolve_feed_dir(gtfs_path), "stops.txt")):
+                _LOGGER.info("GTFS no encontrado, descargando...")
+                success = await async_update_gtfs(
+                    self.hass, async_get_clientsession(self.hass), gtfs_path
+                )
+                if not success:
+                    errors["base"] = "gtfs_download_failed"
+            
+            if not errors:
+                self._user_input = user_input
+                self._catalog = await self.hass.async_add_executor_job(read_catalog, gtfs_path)
+                return await self.async_step_stations()
+
+        # El catálogo se genera al extraer el GTFS; sin él se usan las líneas conocidas
+        catalog = await self.hass.async_add_executor_job(read_catalog, DEFAULT_GTFS_PATH)
+        lines = {ANY_LINE: ANY_LINE_NAME, **(catalog["routes"] if catalog else LINES)}
 
         data_schema = vol.Schema({
-            vol.Required("line", default="S1"): vol.In(LINES),
-            vol.Required("origin", default="TR"): vol.In(STATIONS),
-            vol.Required("destination", default="PC"): vol.In(STATIONS),
+            vol.Required("line", default="S1" if "S1" in lines else next(iter(lines))): vol.In(lines),
             vol.Optional("gtfs_path", default=DEFAULT_GTFS_PATH): str,
             vol.Optional("update_interval", default=DEFAULT_UPDATE_INTERVAL): vol.All(
                 vol.Coerce(int), vol.Range(min=30, max=300)
             ),
             vol.Optional("auto_update_gtfs", default=True): bool,
+            vol.Optional("schedule_mode", default=DEFAULT_SCHEDULE_MODE): vol.In(SCHEDULE_MODES),
+            vol.Optional("train_sensors", default=DEFAULT_TRAIN_SENSORS): vol.All(
+                vol.Coerce(int), vol.Range(min=0, max=MAX_TRAIN_SENSORS)
+            ),
+            vol.Optional("diagnostic_sensors", default=False): bool,
+            vol.Optional("rt_url", default=""): str,
+            vol.Optional("rt_update_interval", default=DEFAULT_RT_UPDATE_INTERVAL): vol.All(
+                vol.Coerce(int), vol.Range(min=10, max=300)
+            ),
         })
 
         return self.async_show_form(
@@ -60,6 +85,44 @@ class FGCTrainsConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             errors=errors,
         )
 
+    async def async_step_stations(self, user_input=None):
+        """Segundo paso: origen y destino entre las estaciones de la línea."""
+        errors = {}
+        line = self._user_input["line"]
+        if self._catalog:
+            stations = line_stations(self._catalog, line)
+        else:
+            stations = STATIONS
+
+        if user_input is not None:
+            if user_input.get("origin") == user_input.get("destination"):
+                errors["base"] = "same_origin_destination"
+            else:
+                await self.async_set_unique_id(
+                    f"{line}_{user_input['origin']}_{user_input['destination']}"
+                )
+                self._abort_if_unique_id_configured()
+                
+                prefix = "FGC" if line == ANY_LINE else f"FGC {line}"
+                return self.async_create_entry(
+                    title=f"{prefix}: {stations.get(user_input['origin'])} → {stations.get(user_input['destination'])}",
+                    data={**self._user_input, **user_input},
+                )
+
+        codes = list(stations)
+        origin = "TR" if "TR" in stations else codes[0]
+        destination = "PC" if "PC" in stations else codes[-1]
+        data_schema = vol.Schema({
+            vol.Required("origin", default=origin): vol.In(stations),
+            vol.Required("destination", default=destination): vol.In(stations),
+        })
+
+        return self.async_show_form(
+            step_id="stations",
+            data_schema=data_schema,
+            errors=errors,
+        )
+
     @staticmethod
     @callback
     def async_get_options_flow(config_entry):
@@ -79,16 +142,37 @@ class FGCTrainsOptionsFlow(config_entries.OptionsFlow):
         if user_input is not None:
             return self.async_create_entry(title="", data=user_input)
 
+        config = {**self.config_entry.data, **self.config_entry.options}
         return self.async_show_form(
             step_id="init",
             data_schema=vol.Schema({
                 vol.Optional(
                     "update_interval",
-                    default=self.config_entry.data.get("update_interval", DEFAULT_UPDATE_INTERVAL),
+                    default=config.get("update_interval", DEFAULT_UPDATE_INTERVAL),
                 ): vol.All(vol.Coerce(int), vol.Range(min=30, max=300)),
                 vol.Optional(
                     "auto_update_gtfs",
-                    default=self.config_entry.data.get("auto_update_gtfs", True),
+                    default=config.get("auto_update_gtfs", True),
                 ): bool,
+                vol.Optional(
+                    "schedule_mode",
+                    default=config.get("schedule_mode", DEFAULT_SCHEDULE_MODE),
+                ): vol.In(SCHEDULE_MODES),
+                vol.Optional(
+                    "train_sensors",
+                    default=config.get("train_sensors", DEFAULT_TRAIN_SENSORS),
+                ): vol.All(vol.Coerce(int), vol.Range(min=0, max=MAX_TRAIN_SENSORS)),
+                vol.Optional(
+                    "diagnostic_sensors",
+                    default=config.get("diagnostic_sensors", False),
+                ): bool,
+                vol.Optional(
+                    "rt_url",
+                    default=config.get("rt_url", ""),
+                ): str,
+                vol.Optional(
+                    "rt_update_interval",
+                    default=config.get("rt_update_interval", DEFAULT_RT_UPDATE_INTERVAL),
+                ): vol.All(vol.Coerce(int), vol.Range(min=10, max=300)),
             }),
         )
@@ -3,11 +3,54 @@
 DOMAIN = "fgc_trains"
 PLATFORMS = ["sensor"]
 
+# Clave en hass.data[DOMAIN] con los feeds GTFS compartidos (por gtfs_path)
+DATA_FEEDS = "feeds"
+# Clave en hass.data[DOMAIN] con los feeds GTFS-RT compartidos (por URL)
+DATA_REALTIME = "realtime"
+
 GTFS_URL = "https://www.fgc.cat/google/google_transit.zip"
 DEFAULT_GTFS_PATH = "/config/custom_components/fgc_trains/gtfs_data"
 DEFAULT_UPDATE_INTERVAL = 60
 DEFAULT_GTFS_UPDATE_DAYS = 1  # Descargar el ZIP cada 1 día
 
+# La actualización diaria se hace a partir de NEXT_DAY_PREPARE_HOUR, con un
+# retraso al azar de cada instalación para no descargar todas a la vez
+GTFS_UPDATE_SPREAD = 90 * 60  # Segundos
+
+# Reintentos de la actualización del GTFS tras un fallo (backoff exponencial)
+GTFS_RETRY_INITIAL = 5 * 60  # Segundos hasta el primer reintento
+GTFS_RETRY_MAX = 12 * 3600  # Espera máxima entre reintentos
+
+# Cerca del fin de validez del feed se comprueba más a menudo si hay uno nuevo
+GTFS_EXPIRY_MARGIN_DAYS = 3
+GTFS_EXPIRY_CHECK_INTERVAL = 6 * 3600
+
+# Modos de actualización de los sensores
+SCHEDULE_EVENT = "event"  # Un temporizador por cambio de minuto, sin releer el GTFS
+SCHEDULE_POLL = "poll"  # Releer los horarios cada update_interval
+SCHEDULE_MODES = [SCHEDULE_EVENT, SCHEDULE_POLL]
+DEFAULT_SCHEDULE_MODE = SCHEDULE_EVENT
+
+# Hora a partir de la cual se compilan en segundo plano las listas del día
+# siguiente (entre el último tren de la noche y el primero de la mañana)
+NEXT_DAY_PREPARE_HOUR = 3
+
+# GTFS-Realtime (TripUpdates), opcional
+DEFAULT_RT_UPDATE_INTERVAL = 30
+RT_STALE_AFTER = 180  # Segundos sin datos RT antes de volver al horario estático
+RT_LOOKBACK_MINUTES = 30  # Trenes ya salidos según horario que aún pueden ir con retraso
+
+# Sensores de próximos trenes (uno por tren) y trenes en atributos del principal
+DEFAULT_TRAIN_SENSORS = 4
+MAX_TRAIN_SENSORS = 10
+MAIN_SENSOR_TRAINS = 4
+
+# Valor de "line" para consultar todas las líneas entre origen y destino
+ANY_LINE = "*"
+ANY_LINE_NAME = "Cualquier línea"
+
+# Líneas y estaciones conocidas; solo se usan si el GTFS instalado aún no
+# tiene catálogo (ver catalog.py)
 LINES = {
     "S1": "Barcelona - Terrassa",
     "S2": "Barcelona - Sabadell", 
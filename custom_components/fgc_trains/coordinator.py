@@ -1,177 +1,419 @@
 """Coordinador de datos para FGC Trains."""
-import os
-import csv
 import logging
 from datetime import datetime, timedelta
 
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
-from homeassistant.core import HomeAssistant
+from homeassistant.helpers.event import async_track_point_in_time
+from homeassistant.core import HomeAssistant, callback
 
-from .const import DOMAIN, DEFAULT_GTFS_UPDATE_DAYS
-from .gtfs_updater import update_gtfs
+from .const import (
+    DOMAIN,
+    ANY_LINE,
+    DEFAULT_RT_UPDATE_INTERVAL,
+    DEFAULT_TRAIN_SENSORS,
+    NEXT_DAY_PREPARE_HOUR,
+    RT_LOOKBACK_MINUTES,
+    SCHEDULE_EVENT,
+    SCHEDULE_POLL,
+)
+from .gtfs_index import MINUTES_PER_DAY, format_minutes, next_date, previous_date
+from .stats import Stats
+from .feed_store import (
+    async_acquire_feed,
+    async_acquire_realtime,
+    async_release_feed,
+    async_release_realtime,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
 class FGCDataCoordinator(DataUpdateCoordinator):
-    """Coordinador para gestionar datos GTFS."""
+    """Coordinador para gestionar datos GTFS.
+
+    En modo SCHEDULE_POLL los horarios se releen cada update_interval. En
+    modo SCHEDULE_EVENT se leen una vez (al arrancar, al cambiar de día, al
+    actualizarse el GTFS o el tiempo real) y después un temporizador en cada
+    cambio de minuto avanza la lista en memoria, sin acceso a disco; solo se
+    notifica a los sensores si los datos mostrados cambian.
+
+    Con line == ANY_LINE se devuelven los trenes de todas las líneas entre
+    origen y destino, mezclados por hora.
+
+    Cuando quedan menos de train_count trenes en el día se muestran también
+    los primeros del día siguiente. Sus listas se compilan en segundo plano a
+    partir de NEXT_DAY_PREPARE_HOUR, así que el cambio de día no las compila.
+    """
 
     def __init__(self, hass: HomeAssistant, gtfs_path: str, origin: str, 
-                 destination: str, line: str, update_interval: int, auto_update: bool = True):
+                 destination: str, line: str, update_interval: int, auto_update: bool = True,
+                 rt_url: str = None, rt_update_interval: int = DEFAULT_RT_UPDATE_INTERVAL,
+                 schedule_mode: str = SCHEDULE_EVENT, train_count: int = DEFAULT_TRAIN_SENSORS):
         """Inicializar coordinador."""
         self.gtfs_path = gtfs_path
         self.origin = origin
         self.destination = destination
         self.line = line
         self.auto_update = auto_update
-        self.last_gtfs_update = None
+        self.schedule_mode = schedule_mode
+        self.train_count = train_count
+        self.feed = async_acquire_feed(hass, gtfs_path, self)
+        self.realtime = None
+        if rt_url:
+            self.realtime = async_acquire_realtime(hass, rt_url, rt_update_interval, self)
+        self._retry_interval = timedelta(seconds=update_interval)
+        self._index = None
+        self._loaded_at = None
+        self._unsub_tick = None
+        self._unsub_prepare = None
+        self._stale_date = None
+        # Tiempos de refresh, consulta, mezcla RT y escritura de entidades
+        self.stats = Stats()
         
         super().__init__(
             hass,
             _LOGGER,
             name=DOMAIN,
-            update_interval=timedelta(seconds=update_interval),
+            update_interval=self._retry_interval if schedule_mode == SCHEDULE_POLL else None,
+            always_update=False,
         )
 
+    @property
+    def loaded_at(self):
+        """Momento en que se leyeron por última vez los horarios del índice."""
+        return self._loaded_at
+
+    async def async_load(self):
+        """Primera carga del feed, en una tarea en segundo plano de la entry.
+
+        Re-extrae el GTFS si no cubre las paradas de la entry y lee los
+        horarios. Si falla, los sensores siguen no disponibles y se reintenta
+        como cualquier otra actualización fallida.
+        """
+        try:
+            await self.hass.async_add_executor_job(self.feed.ensure_stops)
+        except Exception as err:
+            _LOGGER.warning(f"⚠️ No se pudo comprobar la cobertura del GTFS: {err}")
+        await self.async_refresh()
+
+    @callback
+    def async_release(self):
+        """Liberar los feeds compartidos que usa el coordinador."""
+        if self._unsub_tick is not None:
+            self._unsub_tick()
+            self._unsub_tick = None
+        if self._unsub_prepare is not None:
+            self._unsub_prepare()
+            self._unsub_prepare = None
+        async_release_feed(self.hass, self.feed, self)
+        if self.realtime is not None:
+            async_release_realtime(self.hass, self.realtime, self)
+
     async def _async_update_data(self):
         """Actualizar datos del GTFS."""
         try:
-            # Verificar si necesitamos actualizar el ZIP de GTFS
-            if self.auto_update and self._should_update_gtfs():
-                _LOGGER.info("Iniciando actualización automática del GTFS...")
-                success = await self.hass.async_add_executor_job(update_gtfs, self.gtfs_path)
-                
-                if success:
-                    self.last_gtfs_update = datetime.now()
-                    _LOGGER.info("✅ GTFS actualizado automáticamente")
-                else:
-                    _LOGGER.warning("⚠️ Error en actualización automática del GTFS")
+            # La actualización del ZIP de GTFS va en segundo plano con su
+            # propio temporizador: el refresco lee el GTFS instalado y se
+            # repite cuando termina
+            if self.auto_update and not self.feed.check_scheduled:
+                self.feed.async_schedule_check()
             
-            return await self.hass.async_add_executor_job(self._read_gtfs_schedules)
+            with self.stats.timed("refresh"):
+                data = await self.hass.async_add_executor_job(self._read_gtfs_schedules)
         except Exception as err:
+            self._async_schedule_tick(None)
             raise UpdateFailed(f"Error actualizando datos: {err}")
+        
+        self._async_schedule_tick(data)
+        self._async_schedule_prepare(data)
+        return data
+
+    @callback
+    def _async_schedule_prepare(self, data):
+        """Programar la compilación de las listas del día siguiente si faltan.
+
+        Se hace a partir de NEXT_DAY_PREPARE_HOUR, cuando no circulan trenes,
+        o enseguida si ya ha pasado esa hora.
+        """
+        if self._unsub_prepare is not None or self._index is None or "error" in data:
+            return
+        tomorrow = next_date(data["schedule_date"])
+        if self._index.is_prepared(tomorrow, self._day_keys(self._index)):
+            return
+        
+        now = datetime.now()
+        point = now.replace(hour=NEXT_DAY_PREPARE_HOUR, minute=0, second=0, microsecond=0)
+        self._unsub_prepare = async_track_point_in_time(
+            self.hass, self._async_prepare_next_day, max(point, now).astimezone()
+        )
+
+    async def _async_prepare_next_day(self, _now):
+        """Compilar en el executor las listas del día siguiente al de los datos mostrados."""
+        self._unsub_prepare = None
+        index = self._index
+        if index is None or not self.data or "error" in self.data:
+            return
+        tomorrow = next_date(self.data["schedule_date"])
+        with self.stats.timed("prepare_next_day"):
+            compiled = await self.hass.async_add_executor_job(
+                index.prepare_day, tomorrow, self._day_keys(index)
+            )
+        _LOGGER.debug(f"Preparadas {compiled} listas de salidas para el {tomorrow}")
 
-    def _should_update_gtfs(self):
-        """Verificar si es necesario actualizar el GTFS."""
-        # Si nunca se ha actualizado, verificar la antigüedad de los archivos
-        if self.last_gtfs_update is None:
-            trips_file = os.path.join(self.gtfs_path, 'trips.txt')
-            if os.path.exists(trips_file):
-                file_time = datetime.fromtimestamp(os.path.getmtime(trips_file))
-                days_old = (datetime.now() - file_time).days
-                
-                if days_old >= DEFAULT_GTFS_UPDATE_DAYS:
-                    _LOGGER.info(f"Archivos GTFS tienen {days_old} días, actualizando...")
-                    return True
-                else:
-                    # Establecer last_gtfs_update para evitar chequeos constantes
-                    self.last_gtfs_update = file_time
-                    return False
-            else:
-                # No existen archivos, descargar
-                return True
-        
-        # Verificar si han pasado suficientes días desde la última actualización
-        days_since_update = (datetime.now() - self.last_gtfs_update).days
-        
-        if days_since_update >= DEFAULT_GTFS_UPDATE_DAYS:
-            _LOGGER.info(f"Han pasado {days_since_update} días desde la última actualización")
-            return True
-        
-        return False
+    @callback
+    def _async_schedule_tick(self, data):
+        """Programar el siguiente instante en que cambian los datos mostrados.
+
+        Con trenes pendientes es el siguiente cambio de minuto (las salidas
+        tienen resolución de minuto); sin trenes, la medianoche; tras un
+        error, update_interval.
+        """
+        if self.schedule_mode != SCHEDULE_EVENT:
+            return
+        if self._unsub_tick is not None:
+            self._unsub_tick()
+        
+        now = datetime.now()
+        if data is None or self._index is None:
+            point = now + self._retry_interval
+        elif data["trains"]:
+            point = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        else:
+            point = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        self._unsub_tick = async_track_point_in_time(
+            self.hass, self._async_tick, point.astimezone()
+        )
+
+    async def _async_tick(self, _now):
+        """Avanzar la lista de trenes sin releer el GTFS.
+
+        El cálculo va al executor como el de los refrescos: puede compilar
+        listas diarias o buscar el horario proyectado si el feed ha caducado.
+        """
+        self._unsub_tick = None
+        now = datetime.now()
+        if self._index is None or self._loaded_at.date() != now.date():
+            # Nuevo día de servicio (o sin índice): recargar horarios
+            await self.async_refresh()
+            return
+        
+        try:
+            data = await self.hass.async_add_executor_job(self._compute_trains, self._index, now)
+        except Exception as e:
+            _LOGGER.error(f"Error calculando próximos trenes: {e}", exc_info=True)
+            data = None
+        
+        if data is not None and data != self.data:
+            self.stats.increment("tick_updates")
+            self.async_set_updated_data(data)
+        else:
+            self.stats.increment("tick_unchanged")
+        self._async_schedule_tick(data)
 
     def _read_gtfs_schedules(self):
         """Leer horarios del GTFS."""
         try:
-            today = datetime.now().strftime('%Y%m%d')
-            service_ids = []
-            
-            calendar_file = os.path.join(self.gtfs_path, 'calendar_dates.txt')
-            if not os.path.exists(calendar_file):
-                _LOGGER.error(f"No se encuentra: {calendar_file}")
+            index = self.feed.get_index()
+            if index is None:
+                self._index = None
+                _LOGGER.error(f"No se encuentra el GTFS en: {self.gtfs_path}")
                 return {"trains": [], "total": 0, "error": "GTFS not found"}
             
-            with open(calendar_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row['date'] == today and row['exception_type'] == '1':
-                        service_ids.append(row['service_id'])
-            
-            if not service_ids:
-                _LOGGER.warning(f"No hay servicios para hoy: {today}")
-                return {"trains": [], "total": 0, "error": "No service today"}
-            
-            trip_ids = []
-            trips_file = os.path.join(self.gtfs_path, 'trips.txt')
-            
-            with open(trips_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    headsign = row.get('trip_headsign', '')
-                    if (row['route_id'] == self.line and 
-                        row['service_id'] in service_ids and
-                        self._destination_in_headsign(headsign)):
-                        trip_ids.append(row['trip_id'])
-            
-            stop_times_file = os.path.join(self.gtfs_path, 'stop_times.txt')
-            departures_set = set()
-            
-            with open(stop_times_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row['trip_id'] in trip_ids and row['stop_id'] == self.origin:
-                        departure_time = row['departure_time']
-                        parts = departure_time.split(':')
-                        hours = int(parts[0])
-                        minutes = int(parts[1])
-                        total_minutes = hours * 60 + minutes
-                        
-                        if hours >= 24:
-                            hours -= 24
-                            total_minutes = hours * 60 + minutes
-                        
-                        time_str = f"{hours:02d}:{minutes:02d}"
-                        departures_set.add((total_minutes, time_str))
-            
-            departures = [
-                {'minutes': m, 'time': t} 
-                for m, t in sorted(departures_set)
-            ]
-            
-            now = datetime.now()
-            current_minutes = now.hour * 60 + now.minute
-            
-            upcoming_trains = []
-            for dep in departures:
-                if dep['minutes'] > current_minutes:
-                    minutes_until = dep['minutes'] - current_minutes
-                    upcoming_trains.append({
-                        'time': dep['time'],
-                        'minutes': dep['minutes'],
-                        'minutes_until': minutes_until
-                    })
-                    if len(upcoming_trains) >= 6:
-                        break
-            
-            _LOGGER.info(f"Cargados {len(departures)} horarios. Próximos: {len(upcoming_trains)}")
-            
-            return {
-                "trains": upcoming_trains,
-                "total": len(departures),
-                "last_update": datetime.now().isoformat()
-            }
+            self._index = index
+            self._loaded_at = datetime.now()
+            data = self._compute_trains(index, self._loaded_at)
+            if "error" not in data:
+                _LOGGER.info(f"Cargados {data['total']} horarios. Próximos: {len(data['trains'])}")
+            return data
             
         except Exception as e:
             _LOGGER.error(f"Error leyendo GTFS: {e}", exc_info=True)
             return {"trains": [], "total": 0, "error": str(e)}
-    
-    def _destination_in_headsign(self, headsign):
-        """Verificar si el destino está en el headsign."""
-        destination_map = {
-            "PC": "Barcelona",
-            "ES": "Espanya",
-            "TR": "Terrassa",
-            "SR": "Sabadell"
+
+    def _compute_trains(self, index, now):
+        """Próximos trenes a partir del índice en memoria, sin acceso a disco."""
+        today = now.strftime('%Y%m%d')
+        
+        # Fuera del periodo del feed (sin red para descargar el nuevo) se usa
+        # el último horario del mismo día de la semana, marcado como obsoleto
+        projected = None if index.has_service(today) else index.projected_date(today)
+        if projected is not None:
+            if self._stale_date != today:
+                self._stale_date = today
+                _LOGGER.warning(
+                    f"⚠️ El GTFS no cubre el {today}, usando el horario del {projected}"
+                )
+            today = projected
+        elif not index.has_service(today) and not index.has_service(previous_date(today)):
+            _LOGGER.warning(f"No hay servicios para hoy: {today}")
+            return {"trains": [], "total": 0, "error": "No service today"}
+        
+        total = sum(
+            len(index.day_departures(today, route_id, self.origin, self.destination))
+            for route_id in self._routes(index)
+        )
+        
+        current_minutes = now.hour * 60 + now.minute
+        realtime = self.realtime if self.realtime and self.realtime.is_fresh() else None
+        
+        if realtime is None:
+            with self.stats.timed("query"):
+                upcoming_trains = [
+                    self._train(departure, current_minutes)
+                    for departure in self._next_departures(index, today, current_minutes, self.train_count)
+                ]
+        else:
+            with self.stats.timed("rt_merge"):
+                upcoming_trains = self._realtime_trains(
+                    index, realtime.overlay, now, today, current_minutes, self.train_count
+                )
+        
+        return {
+            "trains": upcoming_trains,
+            "total": total,
+            "last_update": self._loaded_at.isoformat(),
+            "timetable_changes": self.feed.timetable_changes,
+            "realtime": realtime is not None,
+            "stale_schedule": projected is not None,
+            "schedule_date": today,
+            "valid_until": self.feed.valid_until,
+        }
+
+    def _routes(self, index):
+        """Rutas consultadas: la configurada o todas las que salen del origen."""
+        return index.routes_from(self.origin) if self.line == ANY_LINE else [self.line]
+
+    def _day_keys(self, index):
+        """Claves (ruta, origen, destino) de las listas diarias que consulta el coordinador."""
+        return [(route_id, self.origin, self.destination) for route_id in self._routes(index)]
+
+    def _next_departures(self, index, today, after_minutes, limit):
+        """Próximas salidas (minuto, id de viaje, llegada, ruta) de la línea o de todas.
+
+        Incluye las primeras del día siguiente si las de today no llegan a limit.
+        """
+        if self.line == ANY_LINE:
+            return index.next_departures_any(
+                today, self.origin, self.destination, after_minutes, limit, lookahead=True
+            )
+        return [
+            departure + (self.line,)
+            for departure in index.next_departures(
+                today, self.line, self.origin, self.destination, after_minutes, limit, lookahead=True
+            )
+        ]
+
+    def arrivals_before(self, arrive_by, origin=None, destination=None, line=None, limit=None):
+        """Trenes que salen a partir de ahora y llegan a destino antes de arrive_by.
+
+        arrive_by es un ``datetime.time``; los datos de la respuesta del
+        servicio incluyen los trenes que llegan a tiempo, ordenados por
+        salida, y el último que sale ("latest"). Si el GTFS podado no cubre
+        origen o destino la respuesta no tiene trenes y lleva
+        ``covered: False`` y esas paradas en ``uncovered``, para que el
+        servicio amplíe el feed. Se ejecuta en el executor.
+        """
+        origin = origin or self.origin
+        destination = destination or self.destination
+        line = line or self.line
+        index = self.feed.get_index()
+        if index is None:
+            return {"trains": [], "latest": None, "error": "GTFS not found"}
+        
+        covered = index.covered_stops
+        uncovered = [
+            stop_id for stop_id in (origin, destination)
+            if covered is not None and stop_id not in covered
+        ]
+        
+        now = datetime.now()
+        today = now.strftime('%Y%m%d')
+        current_minutes = now.hour * 60 + now.minute
+        arrive_by_minutes = arrive_by.hour * 60 + arrive_by.minute
+        if arrive_by_minutes < current_minutes:
+            # Hora ya pasada hoy: se entiende de madrugada
+            arrive_by_minutes += MINUTES_PER_DAY
+        
+        trains = []
+        if not uncovered:
+            routes = index.routes_from(origin) if line == ANY_LINE else [line]
+            trains = [
+                self._train(departure, current_minutes)
+                for departure in index.departures_arriving_by(
+                    today, routes, origin, destination, current_minutes, arrive_by_minutes
+                )
+            ]
+        if limit:
+            trains = trains[-limit:]
+        return {
+            "origin": origin,
+            "destination": destination,
+            "arrive_by": format_minutes(arrive_by_minutes),
+            "covered": not uncovered,
+            "uncovered": uncovered,
+            "trains": trains,
+            "latest": trains[-1] if trains else None,
+        }
+
+    def _train(self, departure, current_minutes, delay=None, arrival_delay=None):
+        """Datos de un tren; con retraso, las horas son las previstas."""
+        minutes, trip_id, arrival, route_id = departure
+        scheduled = minutes
+        if delay is not None:
+            minutes += round(delay / 60)
+        if arrival_delay is None:
+            arrival_delay = delay
+        if arrival_delay is not None:
+            arrival += round(arrival_delay / 60)
+        train = {
+            'time': format_minutes(minutes),
+            'minutes': minutes,
+            'minutes_until': minutes - current_minutes,
+            'arrival_time': format_minutes(arrival),
+            'duration': arrival - minutes,
+            'trip_id': trip_id,
+            'route': route_id
         }
+        if delay is not None:
+            train['scheduled_time'] = format_minutes(scheduled)
+            train['delay'] = round(delay / 60)
+        return train
+
+    def _realtime_trains(self, index, overlay, now, today, current_minutes, limit):
+        """Próximos trenes con las predicciones del GTFS-RT aplicadas.
+
+        Se consideran también los trenes de los últimos RT_LOOKBACK_MINUTES
+        según horario, que pueden no haber salido aún si van con retraso, y se
+        descartan los cancelados o que no paran en el origen.
+        """
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        # Como mucho un tren por minuto en la ventana hacia atrás
+        candidates = self._next_departures(
+            index, today, current_minutes - RT_LOOKBACK_MINUTES, limit + RT_LOOKBACK_MINUTES
+        )
+        
+        trains = []
+        for departure in candidates:
+            minutes, trip_id = departure[:2]
+            delay = arrival_delay = None
+            if trip_id in overlay.trips:
+                schedule = index.trip_schedule(trip_id)
+                # Los viajes de madrugada del día anterior empiezan 24h antes
+                origin_seconds = next(
+                    (seconds for stop, _arrival, seconds in schedule if stop == self.origin),
+                    minutes * 60
+                )
+                service_start = midnight + (minutes - origin_seconds // 60) * 60
+                delay = overlay.departure_delay(trip_id, self.origin, schedule, service_start)
+                if delay is False:
+                    continue
+                arrival_delay = overlay.arrival_delay(
+                    trip_id, self.destination, schedule, service_start
+                )
+                if arrival_delay is False:
+                    continue
+            train = self._train(departure, current_minutes, delay, arrival_delay)
+            if train['minutes_until'] > 0:
+                trains.append(train)
         
-        dest_name = destination_map.get(self.destination, self.destination)
-        return dest_name in headsign
\ No newline at end of file
+        trains.sort(key=lambda train: train['minutes'])
+        return trains[:limit]
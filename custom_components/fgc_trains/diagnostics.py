@@ -0,0 +1,32 @@
+"""Diagnósticos para FGC Trains."""
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+
+# La URL del GTFS-RT puede llevar una clave de API
+TO_REDACT = {"rt_url"}
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry) -> dict:
+    """Diagnósticos de una config entry: configuración, feed, tiempo real y tiempos."""
+    coordinator = hass.data[DOMAIN][entry.entry_id]
+    data = coordinator.data or {}
+
+    return {
+        "config": async_redact_data({**entry.data, **entry.options}, TO_REDACT),
+        "coordinator": {
+            "schedule_mode": coordinator.schedule_mode,
+            "train_count": coordinator.train_count,
+            "last_update_success": coordinator.last_update_success,
+            "loaded_at": coordinator.loaded_at.isoformat() if coordinator.loaded_at else None,
+            "trains": len(data.get("trains", [])),
+            "total": data.get("total"),
+            "realtime": data.get("realtime", False),
+            "error": data.get("error"),
+            "stats": coordinator.stats.as_dict(),
+        },
+        "feed": coordinator.feed.describe(),
+        "realtime": coordinator.realtime.describe() if coordinator.realtime is not None else None,
+    }
@@ -0,0 +1,536 @@
+"""GTFS compartido entre config entries de FGC Trains."""
+import os
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime, time, timedelta
+
+import aiohttp
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.event import async_track_point_in_time, async_track_time_interval
+
+from .const import (
+    DOMAIN,
+    DATA_FEEDS,
+    DATA_REALTIME,
+    GTFS_URL,
+    DEFAULT_GTFS_UPDATE_DAYS,
+    GTFS_EXPIRY_CHECK_INTERVAL,
+    GTFS_EXPIRY_MARGIN_DAYS,
+    GTFS_RETRY_INITIAL,
+    GTFS_RETRY_MAX,
+    GTFS_UPDATE_SPREAD,
+    NEXT_DAY_PREPARE_HOUR,
+    RT_STALE_AFTER,
+    STATIONS,
+)
+from .catalog import read_catalog
+from .gtfs_index import (
+    GTFSIndex,
+    diff_summary,
+    feed_version,
+    format_minutes,
+    resolve_feed_dir,
+)
+from .stats import Stats
+from .gtfs_updater import (
+    DOWNLOAD_TIMEOUT,
+    async_update_gtfs,
+    needs_reingest,
+    read_feed_info,
+    read_feed_meta,
+    reingest_gtfs,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class GTFSFeed:
+    """Un GTFS en disco y su índice, compartido por todas las entries que lo usan.
+
+    El índice se carga una sola vez por versión del feed, sea cual sea el
+    número de coordinadores que lo consultan, y las actualizaciones del GTFS
+    se hacen una sola vez por feed aunque varias entries las pidan a la vez.
+    """
+
+    def __init__(self, hass: HomeAssistant, gtfs_path: str):
+        """Inicializar feed."""
+        self.hass = hass
+        self.gtfs_path = gtfs_path
+        self.index = None
+        self.last_update = None
+        self.timetable_changes = None
+        self.catalog = None
+        self.valid_until = None
+        self.covered_stops = set()
+        self.stats = Stats()
+        self._failures = 0
+        self._retry_at = None
+        self._update_offset = timedelta(seconds=random.randint(0, GTFS_UPDATE_SPREAD))
+        self._unsub_check = None
+        self._coverage_loaded = False
+        self._coordinators = set()
+        self._load_lock = threading.Lock()
+        self._update_task = None
+        self._cover_task = None
+
+    @property
+    def refcount(self):
+        """Número de coordinadores que usan este feed."""
+        return len(self._coordinators)
+
+    @property
+    def coordinators(self):
+        """Coordinadores que usan este feed."""
+        return tuple(self._coordinators)
+
+    def attach(self, coordinator):
+        """Registrar un coordinador que usa este feed."""
+        self._coordinators.add(coordinator)
+
+    def detach(self, coordinator):
+        """Desregistrar un coordinador."""
+        self._coordinators.discard(coordinator)
+        if not self._coordinators and self._unsub_check is not None:
+            self._unsub_check()
+            self._unsub_check = None
+
+    def required_stops(self):
+        """Paradas que debe cubrir el GTFS podado.
+
+        Las de los coordinadores más covered_stops: las que ya cubría el feed
+        instalado y las pedidas a get_departures, que se conservan en las
+        siguientes actualizaciones.
+        """
+        stops = set(self.covered_stops)
+        for coordinator in self._coordinators:
+            stops.update((coordinator.origin, coordinator.destination))
+        return stops
+
+    def ensure_stops(self):
+        """Re-extraer el GTFS si no cubre required_stops.
+
+        Las actualizaciones diarias podan stop_times.txt a los viajes que
+        pasan por las paradas cubiertas; una entry nueva o una consulta de
+        get_departures con otras paradas obliga a re-extraer el ZIP
+        conservado (sin descarga). Las paradas ya cubiertas se mantienen en
+        las siguientes actualizaciones.
+        Se ejecuta en el executor.
+        """
+        with self._load_lock:
+            if not self._coverage_loaded:
+                covered = read_feed_meta(resolve_feed_dir(self.gtfs_path)).get('stops')
+                self.covered_stops.update(covered or ())
+                self._coverage_loaded = True
+            stops = self.required_stops()
+            if needs_reingest(self.gtfs_path, stops):
+                reingest_gtfs(self.gtfs_path, stops, self.stats)
+
+    def should_update(self):
+        """Verificar si es necesario actualizar el GTFS.
+
+        Se actualiza a partir de daily_update_at, en las horas sin trenes
+        DEFAULT_GTFS_UPDATE_DAYS días después de la anterior. Tras un fallo no
+        se vuelve a intentar hasta que pasa el backoff. Si el feed deja de ser
+        válido en menos de GTFS_EXPIRY_MARGIN_DAYS se comprueba además cada
+        GTFS_EXPIRY_CHECK_INTERVAL.
+        """
+        now = datetime.now()
+        if self._retry_at is not None and now < self._retry_at:
+            return False
+        
+        # Si nunca se ha actualizado, usar la antigüedad de los archivos
+        if self.last_update is None:
+            trips_file = os.path.join(resolve_feed_dir(self.gtfs_path), 'trips.txt')
+            if not os.path.exists(trips_file):
+                # No existen archivos, descargar
+                return True
+            self.last_update = datetime.fromtimestamp(os.path.getmtime(trips_file))
+        
+        if now >= self.daily_update_at():
+            days = (now.date() - self.last_update.date()).days
+            _LOGGER.info(f"GTFS descargado hace {days} días, actualizando...")
+            return True
+        
+        age = now - self.last_update
+        if self.expires_soon(now) and age >= timedelta(seconds=GTFS_EXPIRY_CHECK_INTERVAL):
+            _LOGGER.info(f"GTFS a punto de caducar ({self.valid_until}), buscando uno nuevo...")
+            return True
+        
+        return False
+
+    def daily_update_at(self):
+        """Momento de la siguiente actualización diaria del GTFS.
+
+        NEXT_DAY_PREPARE_HOUR más el retraso al azar de esta instalación
+        (hasta GTFS_UPDATE_SPREAD), DEFAULT_GTFS_UPDATE_DAYS días después de
+        la última actualización.
+        """
+        day = self.last_update.date() + timedelta(days=DEFAULT_GTFS_UPDATE_DAYS)
+        return datetime.combine(day, time(NEXT_DAY_PREPARE_HOUR)) + self._update_offset
+
+    def expires_soon(self, now=None):
+        """Comprobar si el feed deja de ser válido en menos de GTFS_EXPIRY_MARGIN_DAYS."""
+        if self.valid_until is None:
+            return False
+        now = now or datetime.now()
+        limit = datetime.strptime(self.valid_until, '%Y%m%d') - timedelta(days=GTFS_EXPIRY_MARGIN_DAYS)
+        return now >= limit
+
+    def _record_update(self, success):
+        """Anotar el resultado de una actualización y programar el backoff si ha fallado."""
+        if success:
+            self._failures = 0
+            self._retry_at = None
+            return
+        self._failures += 1
+        delay = min(GTFS_RETRY_INITIAL * 2 ** (self._failures - 1), GTFS_RETRY_MAX)
+        self._retry_at = datetime.now() + timedelta(seconds=delay)
+        _LOGGER.warning(
+            f"⚠️ Actualización del GTFS fallida ({self._failures} seguidas), "
+            f"siguiente intento a las {self._retry_at.strftime('%H:%M')}"
+        )
+
+    @callback
+    def async_schedule_check(self):
+        """Programar la próxima comprobación del GTFS con un temporizador del feed.
+
+        La actualización diaria (daily_update_at), los reintentos tras un
+        fallo y las comprobaciones cerca del fin de validez no dependen de
+        los refrescos de los coordinadores, que nunca esperan a la descarga.
+        Solo se programa si alguna entry tiene la actualización automática.
+        """
+        if self._unsub_check is not None:
+            self._unsub_check()
+            self._unsub_check = None
+        if not any(coordinator.auto_update for coordinator in self._coordinators):
+            return
+        
+        now = datetime.now()
+        if self.last_update is None:
+            # should_update lee la antigüedad de los ficheros
+            point = now
+        else:
+            point = self.daily_update_at()
+            if self.expires_soon(now):
+                point = min(point, self.last_update + timedelta(seconds=GTFS_EXPIRY_CHECK_INTERVAL))
+        if self._retry_at is not None:
+            point = max(point, self._retry_at)
+        self._unsub_check = async_track_point_in_time(
+            self.hass, self._async_check, max(point, now).astimezone()
+        )
+
+    async def _async_check(self, _now):
+        """Actualizar el GTFS si toca; si no, programar la siguiente comprobación."""
+        self._unsub_check = None
+        if not await self.hass.async_add_executor_job(self.should_update):
+            self.async_schedule_check()
+            return
+        
+        _LOGGER.info("Iniciando actualización automática del GTFS...")
+        if await self.async_update():
+            _LOGGER.info("✅ GTFS actualizado automáticamente")
+        else:
+            _LOGGER.warning("⚠️ Error en actualización automática del GTFS")
+
+    @property
+    def check_scheduled(self):
+        """Comprobar si hay una comprobación del GTFS programada o en curso."""
+        return self._unsub_check is not None or self._update_task is not None
+
+    async def async_update(self):
+        """Actualizar el GTFS; las llamadas concurrentes esperan a la misma tarea.
+
+        Al terminar se pide un refresco a los coordinadores del feed y se
+        programa la siguiente comprobación. Devuelve True si el GTFS
+        instalado está al día.
+        """
+        if self._update_task is None:
+            self._update_task = self.hass.async_create_task(self._async_update())
+        return await asyncio.shield(self._update_task)
+
+    async def _async_update(self):
+        """Descargar, extraer e indexar el GTFS y avisar a los coordinadores."""
+        try:
+            success = await async_update_gtfs(
+                self.hass,
+                async_get_clientsession(self.hass),
+                self.gtfs_path,
+                self.required_stops(),
+                GTFS_URL,
+                self.stats,
+            )
+            self._record_update(success)
+            if not success:
+                return False
+            
+            self.last_update = datetime.now()
+            await self.hass.async_add_executor_job(self.get_index)
+            for coordinator in self.coordinators:
+                await coordinator.async_request_refresh()
+            return True
+        finally:
+            self._update_task = None
+            self.async_schedule_check()
+
+    @callback
+    def async_cover_stops(self, stop_ids):
+        """Ampliar en segundo plano el GTFS podado para que cubra stop_ids."""
+        self.covered_stops.update(stop_ids)
+        if self._cover_task is None:
+            self._cover_task = self.hass.async_create_background_task(
+                self._async_cover(), f"fgc_trains_cover_{self.gtfs_path}"
+            )
+
+    async def _async_cover(self):
+        """Re-extraer el ZIP conservado con las paradas nuevas y cargar el índice."""
+        try:
+            if self._update_task is not None:
+                # La actualización en curso puede haber leído ya las paradas
+                await asyncio.shield(self._update_task)
+            await self.hass.async_add_executor_job(self.ensure_stops)
+            await self.hass.async_add_executor_job(self.get_index)
+        except Exception as err:
+            _LOGGER.warning(f"⚠️ No se pudo ampliar la cobertura del GTFS: {err}")
+        finally:
+            self._cover_task = None
+
+    def get_index(self):
+        """Devolver el índice vigente, cargándolo si el GTFS ha cambiado.
+
+        Se ejecuta en el executor; si varios coordinadores lo piden a la vez
+        solo uno parsea el feed y el resto reutiliza su resultado.
+        """
+        index = self.index
+        if index is not None and index.is_current():
+            return index
+
+        with self._load_lock:
+            index = self.index
+            if index is None or not index.is_current():
+                if feed_version(resolve_feed_dir(self.gtfs_path)) is None:
+                    return None
+                previous = self.index
+                with self.stats.timed("index_load"):
+                    index = GTFSIndex.load(self.gtfs_path)
+                self.stats.increment("index_cache_hit" if index.from_cache else "index_cache_miss")
+                meta = read_feed_meta(index.feed_dir)
+                diff = meta.get('diff')
+                if meta.get('stops') is not None:
+                    index.covered_stops = frozenset(meta['stops'])
+                    self.covered_stops.update(meta['stops'])
+                if previous is not None:
+                    index.adopt_day_cache(previous, diff)
+                self.timetable_changes = diff_summary(diff)
+                self.catalog = read_catalog(self.gtfs_path)
+                # Validez publicada en feed_info.txt o, si no hay, la del calendario
+                self.valid_until = (
+                    read_feed_info(index.feed_dir).get('feed_end_date') or index.service_window()[1]
+                )
+                self.index = index
+        return index
+
+    def departure_boards(self, stop_ids, window_minutes, limit, line=None):
+        """Paneles de salidas de varias paradas en una sola pasada sobre el índice.
+
+        Se ejecuta en el executor; devuelve los datos de respuesta del
+        servicio get_departures. El GTFS podado solo tiene todas las salidas
+        de las paradas que cubre: el resto se devuelve sin salidas, marcado
+        con ``covered: False`` y en ``uncovered``, para que el servicio
+        amplíe el feed en segundo plano con async_cover_stops.
+        """
+        index = self.get_index()
+        if index is None:
+            return {"boards": {}, "error": "GTFS not found"}
+        
+        covered = index.covered_stops
+        if covered is not None:
+            uncovered = [stop_id for stop_id in stop_ids if stop_id not in covered]
+            stop_ids_covered = [stop_id for stop_id in stop_ids if stop_id in covered]
+        else:
+            uncovered = []
+            stop_ids_covered = list(stop_ids)
+        
+        now = datetime.now()
+        today = now.strftime('%Y%m%d')
+        current_minutes = now.hour * 60 + now.minute
+        with self.stats.timed("boards"):
+            departures = index.departure_boards(
+                today, stop_ids_covered, current_minutes, window_minutes, limit, line
+            )
+        boards = {}
+        for stop_id in stop_ids:
+            boards[stop_id] = {
+                "name": self.station_name(stop_id),
+                "covered": stop_id not in uncovered,
+                "departures": [
+                    {
+                        "time": format_minutes(minutes),
+                        "minutes_until": minutes - current_minutes,
+                        "line": route_id,
+                        "headsign": headsign,
+                        "trip_id": trip_id,
+                    }
+                    for minutes, trip_id, route_id, headsign in departures.get(stop_id, [])
+                ],
+            }
+        if uncovered:
+            _LOGGER.debug(f"Paradas sin cubrir en el GTFS podado: {uncovered}")
+        return {"generated": now.isoformat(), "boards": boards, "uncovered": uncovered}
+
+    def describe(self):
+        """Estado del feed para los diagnósticos."""
+        index = self.index
+        return {
+            "gtfs_path": self.gtfs_path,
+            "entries": self.refcount,
+            "last_update": self.last_update.isoformat() if self.last_update else None,
+            "valid_until": self.valid_until,
+            "update_failures": self._failures,
+            "retry_at": self._retry_at.isoformat() if self._retry_at else None,
+            "covered_stops": sorted(self.required_stops()),
+            "catalog_stops": len(self.catalog["stops"]) if self.catalog else None,
+            "timetable_changes": self.timetable_changes,
+            "index": index.describe() if index is not None else None,
+            "stats": self.stats.as_dict(),
+        }
+
+    def station_name(self, stop_id):
+        """Nombre de una estación según el catálogo del GTFS."""
+        if self.catalog and stop_id in self.catalog["stops"]:
+            return self.catalog["stops"][stop_id]["name"]
+        return STATIONS.get(stop_id, stop_id)
+
+
+@callback
+def async_acquire_feed(hass: HomeAssistant, gtfs_path: str, coordinator) -> GTFSFeed:
+    """Obtener (o crear) el feed de gtfs_path y registrar el coordinador."""
+    feeds = hass.data.setdefault(DOMAIN, {}).setdefault(DATA_FEEDS, {})
+    feed = feeds.get(gtfs_path)
+    if feed is None:
+        feed = GTFSFeed(hass, gtfs_path)
+        feeds[gtfs_path] = feed
+        _LOGGER.debug(f"Nuevo feed GTFS compartido: {gtfs_path}")
+    feed.attach(coordinator)
+    return feed
+
+
+@callback
+def async_release_feed(hass: HomeAssistant, feed: GTFSFeed, coordinator):
+    """Liberar el feed de un coordinador y descartarlo si ya nadie lo usa."""
+    feed.detach(coordinator)
+    if feed.refcount == 0:
+        hass.data[DOMAIN][DATA_FEEDS].pop(feed.gtfs_path, None)
+        _LOGGER.debug(f"Feed GTFS liberado: {feed.gtfs_path}")
+
+
+class RealtimeFeed:
+    """Un feed GTFS-RT de TripUpdates, sondeado una vez para todas sus entries.
+
+    Cada sondeo aplica el mensaje al overlay de forma incremental y, si algo
+    ha cambiado, pide un refresco a los coordinadores que lo usan. Si no hay
+    datos recientes (RT_STALE_AFTER) los coordinadores usan solo el horario.
+    """
+
+    def __init__(self, hass: HomeAssistant, url: str, update_interval: int):
+        """Inicializar feed en tiempo real."""
+        # El decodificador GTFS-RT solo se carga si alguna entry lo usa
+        from .gtfs_rt import RealtimeOverlay
+        
+        self.hass = hass
+        self.url = url
+        self.update_interval = update_interval
+        self.overlay = RealtimeOverlay()
+        self.last_success = None
+        self.stats = Stats()
+        self._coordinators = set()
+        self._unsub = None
+
+    @property
+    def refcount(self):
+        """Número de coordinadores que usan este feed."""
+        return len(self._coordinators)
+
+    def attach(self, coordinator):
+        """Registrar un coordinador y empezar a sondear si es el primero."""
+        self._coordinators.add(coordinator)
+        if self._unsub is None:
+            self._unsub = async_track_time_interval(
+                self.hass, self._async_poll, timedelta(seconds=self.update_interval)
+            )
+            self.hass.async_create_task(self._async_poll())
+
+    def detach(self, coordinator):
+        """Desregistrar un coordinador y dejar de sondear si era el último."""
+        self._coordinators.discard(coordinator)
+        if not self._coordinators and self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+
+    def is_fresh(self):
+        """Comprobar si hay datos en tiempo real recientes."""
+        if self.last_success is None:
+            return False
+        return (datetime.now() - self.last_success).total_seconds() < RT_STALE_AFTER
+
+    def describe(self):
+        """Estado del feed en tiempo real para los diagnósticos (sin la URL)."""
+        return {
+            "entries": self.refcount,
+            "update_interval": self.update_interval,
+            "last_success": self.last_success.isoformat() if self.last_success else None,
+            "fresh": self.is_fresh(),
+            "timestamp": self.overlay.timestamp,
+            "trips": len(self.overlay.trips),
+            "stats": self.stats.as_dict(),
+        }
+
+    async def _async_poll(self, _now=None):
+        """Descargar el feed y aplicarlo al overlay."""
+        session = async_get_clientsession(self.hass)
+        try:
+            with self.stats.timed("rt_download"):
+                async with session.get(
+                    self.url, timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)
+                ) as response:
+                    response.raise_for_status()
+                    payload = await response.read()
+            with self.stats.timed("rt_apply"):
+                changed = await self.hass.async_add_executor_job(self.overlay.apply, payload)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, IndexError) as err:
+            _LOGGER.warning(f"⚠️ Error leyendo GTFS-RT {self.url}: {err}")
+            self.stats.increment("rt_errors")
+            return
+
+        self.last_success = datetime.now()
+        self.stats.set("rt_bytes", len(payload))
+        self.stats.set("rt_changed", changed)
+        if changed:
+            _LOGGER.debug(f"GTFS-RT: {changed} viajes actualizados ({len(self.overlay.trips)} activos)")
+            for coordinator in tuple(self._coordinators):
+                await coordinator.async_request_refresh()
+
+
+@callback
+def async_acquire_realtime(hass: HomeAssistant, url: str, update_interval: int, coordinator) -> RealtimeFeed:
+    """Obtener (o crear) el feed GTFS-RT de url y registrar el coordinador."""
+    feeds = hass.data.setdefault(DOMAIN, {}).setdefault(DATA_REALTIME, {})
+    feed = feeds.get(url)
+    if feed is None:
+        feed = RealtimeFeed(hass, url, update_interval)
+        feeds[url] = feed
+        _LOGGER.debug(f"Nuevo feed GTFS-RT compartido: {url}")
+    feed.attach(coordinator)
+    return feed
+
+
+@callback
+def async_release_realtime(hass: HomeAssistant, feed: RealtimeFeed, coordinator):
+    """Liberar el feed GTFS-RT de un coordinador y descartarlo si ya nadie lo usa."""
+    feed.detach(coordinator)
+    if feed.refcount == 0:
+        hass.data[DOMAIN][DATA_REALTIME].pop(feed.url, None)
+        _LOGGER.debug(f"Feed GTFS-RT liberado: {feed.url}")
@@ -0,0 +1,137 @@
+"""Caché binaria del índice GTFS para FGC Trains.
+
+Formato del fichero (todo alineado a 8 bytes):
+
+    b"FGCIDX01" | uint32 longitud de cabecera | cabecera JSON | datos
+
+La cabecera guarda la versión del feed de origen, el orden de bytes y la
+posición, relativa al inicio de los datos, de cada tabla de cadenas (UTF-8
+separadas por saltos de línea) y de cada columna numérica (bytes crudos de
+un ``array``). Las columnas se leen con ``mmap`` y ``memoryview.cast`` sin
+copiarlas a memoria.
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+from array import array
+
+_LOGGER = logging.getLogger(__name__)
+
+CACHE_FILE = "gtfs_index.bin"
+
+_MAGIC = b"FGCIDX01"
+_HEADER_SIZE = struct.Struct("<I")
+_ALIGN = 8
+
+
+def cache_path(gtfs_path):
+    """Ruta del fichero de caché de un GTFS."""
+    return os.path.join(gtfs_path, CACHE_FILE)
+
+
+def _padding(offset):
+    """Bytes de relleno hasta la siguiente posición alineada."""
+    return -offset % _ALIGN
+
+
+def write_cache(path, version, tables, columns):
+    """Escribir tablas de cadenas y columnas numéricas de forma atómica.
+
+    ``tables`` es un dict nombre -> lista de str y ``columns`` un dict
+    nombre -> ``array``.
+    """
+    blobs = []
+    layout = {"tables": {}, "columns": {}}
+    offset = 0
+
+    for name, values in tables.items():
+        data = "\n".join(values).encode("utf-8")
+        layout["tables"][name] = [offset, len(values), len(data)]
+        blobs.append(data)
+        offset += len(data) + _padding(len(data))
+
+    for name, values in columns.items():
+        data = values.tobytes()
+        layout["columns"][name] = [offset, len(values), len(data), values.typecode]
+        blobs.append(data)
+        offset += len(data) + _padding(len(data))
+
+    header = json.dumps(
+        {"version": version, "byteorder": sys.byteorder, **layout},
+        separators=(",", ":"),
+    ).encode("utf-8")
+    prefix = len(_MAGIC) + _HEADER_SIZE.size + len(header)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(_HEADER_SIZE.pack(len(header)))
+        f.write(header)
+        f.write(b"\0" * _padding(prefix))
+        for data in blobs:
+            f.write(data)
+            f.write(b"\0" * _padding(len(data)))
+    os.replace(tmp_path, path)
+
+
+def read_cache(path, version):
+    """Leer una caché si existe y corresponde a ``version``.
+
+    Devuelve ``(tables, columns)`` o None si falta, está obsoleta o es
+    inválida. Las columnas son vistas ``memoryview`` sobre el fichero
+    mapeado en memoria.
+    """
+    try:
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    view = None
+    columns = {}
+    try:
+        if buffer[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("cabecera desconocida")
+        start = len(_MAGIC) + _HEADER_SIZE.size
+        (header_size,) = _HEADER_SIZE.unpack_from(buffer, len(_MAGIC))
+        header = json.loads(buffer[start:start + header_size])
+        base = start + header_size
+        base += _padding(base)
+
+        if header["version"] != version or header["byteorder"] != sys.byteorder:
+            _LOGGER.debug(f"Caché GTFS obsoleta: {path}")
+            _close(buffer, view, columns)
+            return None
+
+        view = memoryview(buffer)
+        tables = {}
+        for name, (offset, count, size) in header["tables"].items():
+            offset += base
+            text = bytes(view[offset:offset + size]).decode("utf-8")
+            values = text.split("\n") if count else []
+            if len(values) != count:
+                raise ValueError(f"tabla {name} corrupta")
+            tables[name] = values
+
+        for name, (offset, count, size, typecode) in header["columns"].items():
+            offset += base
+            if offset + size > len(buffer) or size != count * array(typecode).itemsize:
+                raise ValueError(f"columna {name} corrupta")
+            columns[name] = view[offset:offset + size].cast(typecode)
+        return tables, columns
+    except (ValueError, KeyError, TypeError, struct.error) as err:
+        _LOGGER.warning(f"⚠️ Caché GTFS inválida ({path}): {err}")
+        _close(buffer, view, columns)
+        return None
+
+
+def _close(buffer, view, columns):
+    """Liberar las vistas creadas y cerrar el mapeo de una caché descartada."""
+    for column in columns.values():
+        column.release()
+    if view is not None:
+        view.release()
+    buffer.close()
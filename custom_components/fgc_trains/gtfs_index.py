@@ -0,0 +1,1059 @@
+"""Índice compilado de salidas GTFS para FGC Trains."""
+import os
+import sys
+import csv
+import heapq
+import hashlib
+import logging
+from array import array
+from datetime import datetime, timedelta
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+from .gtfs_cache import cache_path, read_cache, write_cache
+
+_LOGGER = logging.getLogger(__name__)
+
+# Ficheros del GTFS de los que depende el índice
+INDEX_FILES = ("calendar.txt", "calendar_dates.txt", "trips.txt", "stop_times.txt")
+
+# Un GTFS puede definir sus servicios solo con uno de los dos calendarios
+OPTIONAL_INDEX_FILES = ("calendar.txt", "calendar_dates.txt")
+
+# Columnas de días de la semana de calendar.txt, en el orden de weekday()
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+MINUTES_PER_DAY = 24 * 60
+
+# Cada GTFS se instala en gtfs_path/versions/<versión>; el fichero
+# gtfs_path/current indica la versión activa y se reemplaza atómicamente
+CURRENT_FILE = "current"
+VERSIONS_DIR = "versions"
+
+# Versión del formato del índice; forma parte de la clave de la caché
+INDEX_FORMAT = 5
+
+# Proporción de viajes huérfanos (eliminados en versiones anteriores) a
+# partir de la cual la construcción incremental se rehace desde cero
+MAX_ORPHAN_RATIO = 0.25
+
+# Ids de viaje de ejemplo incluidos en el resumen de cambios
+DIFF_EXAMPLES = 5
+
+# Memoria máxima del índice construido (columnas, tablas y diccionarios)
+# por cada 100.000 stop_times; el benchmark "memory" la comprueba
+MEMORY_BUDGET_PER_100K = 4 * 1024 * 1024
+
+# Paradas a partir de las cuales los paneles usan el motor NumPy (si está)
+NUMPY_MIN_STOPS = 8
+
+def parse_gtfs_time(value):
+    """Convertir una hora GTFS (HH:MM:SS, admite horas >= 24) a segundos."""
+    parts = value.strip().split(':')
+    seconds = int(parts[0]) * 3600 + int(parts[1]) * 60
+    if len(parts) > 2:
+        seconds += int(parts[2])
+    return seconds
+
+
+def previous_date(date):
+    """Fecha (YYYYMMDD) del día anterior."""
+    return (datetime.strptime(date, '%Y%m%d') - timedelta(days=1)).strftime('%Y%m%d')
+
+
+def next_date(date):
+    """Fecha (YYYYMMDD) del día siguiente."""
+    return (datetime.strptime(date, '%Y%m%d') + timedelta(days=1)).strftime('%Y%m%d')
+
+
+def format_minutes(minutes):
+    """Hora HH:MM de un minuto del día (los >= 24h son de madrugada)."""
+    minutes %= MINUTES_PER_DAY
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def resolve_feed_dir(gtfs_path):
+    """Directorio con los ficheros de la versión activa del GTFS.
+
+    Si no existe el puntero (instalaciones anteriores a las versiones) los
+    ficheros están directamente en gtfs_path.
+    """
+    try:
+        with open(os.path.join(gtfs_path, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+    except OSError:
+        return gtfs_path
+    return os.path.join(gtfs_path, VERSIONS_DIR, version)
+
+
+def feed_version(gtfs_path):
+    """Versión del GTFS según mtime y tamaño de sus ficheros (None si faltan)."""
+    version = []
+    for name in INDEX_FILES:
+        try:
+            stat = os.stat(os.path.join(gtfs_path, name))
+        except OSError:
+            if name in OPTIONAL_INDEX_FILES:
+                version.append("-")
+                continue
+            return None
+        version.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+    if version[0] == version[1] == "-":
+        return None
+    return "/".join(version)
+
+
+def diff_summary(diff):
+    """Resumen compacto de un diff de índices, apto como atributo de sensor."""
+    if not diff:
+        return None
+    return {
+        "added": diff["added"],
+        "removed": diff["removed"],
+        "changed": diff["changed"],
+        "unchanged": diff["unchanged"],
+        "changed_dates": len(diff["changed_dates"]),
+        "examples": diff["examples"],
+    }
+
+
+class DayDepartures:
+    """Salidas de un día para (ruta, origen, destino), en tres columnas ``array``.
+
+    Ocupa 12 bytes por salida (minuto, viaje internado, llegada) en lugar de
+    una tupla por salida. Indexar o recorrer la lista devuelve tuplas
+    (minuto, id de viaje, minuto de llegada), creadas solo para las salidas
+    que se piden.
+    """
+
+    __slots__ = ("minutes", "trips", "arrivals", "_trip_ids")
+
+    def __init__(self, trip_ids):
+        """Inicializar vacía; trip_ids es la tabla de ids de viaje del índice."""
+        self.minutes = array('i')
+        self.trips = array('i')
+        self.arrivals = array('i')
+        self._trip_ids = trip_ids
+
+    def append(self, minutes, trip, arrival):
+        """Añadir una salida (en orden de minuto)."""
+        self.minutes.append(minutes)
+        self.trips.append(trip)
+        self.arrivals.append(arrival)
+
+    def position(self, minutes):
+        """Posición de la primera salida posterior a minutes."""
+        return bisect_right(self.minutes, minutes)
+
+    def __len__(self):
+        """Número de salidas."""
+        return len(self.minutes)
+
+    def __getitem__(self, item):
+        """Salida i, o lista de salidas de un slice, como tuplas."""
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self.minutes)))]
+        return self.minutes[item], self._trip_ids[self.trips[item]], self.arrivals[item]
+
+    def __iter__(self):
+        """Recorrer las salidas como tuplas."""
+        trip_ids = self._trip_ids
+        for minutes, trip, arrival in zip(self.minutes, self.trips, self.arrivals):
+            yield minutes, trip_ids[trip], arrival
+
+    def nbytes(self):
+        """Bytes de las tres columnas."""
+        return sum(column.itemsize * len(column) for column in (self.minutes, self.trips, self.arrivals))
+
+
+class _StringTable:
+    """Tabla de identificadores de texto internados como enteros."""
+
+    __slots__ = ("values", "ids")
+
+    def __init__(self, values=None):
+        """Inicializar tabla, opcionalmente sembrada con la de otro índice."""
+        self.values = list(values) if values else []
+        self.ids = {value: i for i, value in enumerate(self.values)}
+
+    def add(self, value):
+        """Devolver el entero de value, añadiéndolo si es nuevo."""
+        index = self.ids.get(value)
+        if index is None:
+            index = len(self.values)
+            self.ids[value] = index
+            self.values.append(value)
+        return index
+
+
+def _read_services_by_date(feed_dir, services):
+    """Servicios activos por fecha según calendar.txt y calendar_dates.txt.
+
+    Los patrones semanales de calendar.txt se expanden a su periodo de
+    validez y después se aplican las excepciones de calendar_dates.txt
+    (1 = se añade el servicio, 2 = se suprime).
+    """
+    services_by_date = {}
+    try:
+        with open(os.path.join(feed_dir, 'calendar.txt'), 'r', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                service = services.add(row['service_id'])
+                weekdays = [row.get(day, '').strip() == '1' for day in WEEKDAYS]
+                day = datetime.strptime(row['start_date'].strip(), '%Y%m%d')
+                end = datetime.strptime(row['end_date'].strip(), '%Y%m%d')
+                while day <= end:
+                    if weekdays[day.weekday()]:
+                        services_by_date.setdefault(day.strftime('%Y%m%d'), set()).add(service)
+                    day += timedelta(days=1)
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(os.path.join(feed_dir, 'calendar_dates.txt'), 'r', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                active = services_by_date.setdefault(row['date'].strip(), set())
+                service = services.add(row['service_id'])
+                if row['exception_type'].strip() == '1':
+                    active.add(service)
+                elif row['exception_type'].strip() == '2':
+                    active.discard(service)
+    except FileNotFoundError:
+        pass
+    return services_by_date
+
+
+def _extend_column(column, values):
+    """Añadir a un array los valores de otro array o memoryview, sin iterar."""
+    column.frombytes(memoryview(values).cast('B'))
+
+
+def _copy_column(typecode, column):
+    """Copia modificable de una columna (array o memoryview de la caché)."""
+    copy = array(typecode)
+    if column is not None:
+        _extend_column(copy, column)
+    return copy
+
+
+def _trip_blocks(lines, trip_pos):
+    """Agrupar las líneas de stop_times.txt en bloques contiguos por viaje.
+
+    Si trip_id es la primera columna (lo habitual, y siempre en los GTFS
+    extraídos por la integración) el viaje se obtiene sin parsear el CSV.
+    """
+    block_trip = None
+    block = []
+    for line in lines:
+        if trip_pos == 0 and not line.startswith('"'):
+            trip_id = line[:line.find(',')]
+        else:
+            trip_id = next(csv.reader([line]))[trip_pos]
+        if trip_id != block_trip:
+            if block:
+                yield block_trip, block
+            block_trip = trip_id
+            block = []
+        block.append(line)
+    if block:
+        yield block_trip, block
+
+
+def _hash_block(prefix, lines):
+    """Hash de 64 bits de un viaje: sus atributos y sus líneas de stop_times."""
+    digest = hashlib.blake2b(prefix.encode('utf-8'), digest_size=8)
+    digest.update("".join(lines).encode('utf-8'))
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+
+def _parse_block(lines, positions, stops, rows):
+    """Parsear las líneas de un viaje y añadir paradas, llegadas y salidas a rows.
+
+    Las filas se ordenan por stop_sequence si el fichero la incluye. Si falta
+    la hora de llegada se usa la de salida, y viceversa.
+    """
+    stop_pos, arrival_pos, departure_pos, sequence_pos = positions
+    trip_stops, trip_arrivals, trip_departures = rows
+    parsed = list(csv.reader(lines))
+    if sequence_pos is not None:
+        parsed.sort(key=lambda row: int(row[sequence_pos]))
+    for row in parsed:
+        departure = row[departure_pos].strip()
+        arrival = row[arrival_pos].strip() if arrival_pos is not None else ''
+        trip_stops.append(stops.add(row[stop_pos]))
+        trip_arrivals.append(parse_gtfs_time(arrival or departure))
+        trip_departures.append(parse_gtfs_time(departure or arrival))
+    return rows
+
+
+class GTFSIndex:
+    """Índice en memoria de un GTFS, construido una vez por versión del feed.
+
+    Rutas, paradas, viajes, servicios y headsigns se internan como enteros.
+    Cada viaje apunta a su patrón (la secuencia ordenada de sus paradas) y
+    el sentido se decide por esa secuencia: un viaje sirve para ir de A a B
+    si pasa por A antes que por B. Los patrones válidos de cada par de
+    paradas se calculan una vez y se memorizan.
+    Los servicios activos de cada fecha del periodo de validez del feed se
+    precalculan como un bitmap (un bit por servicio), de modo que saber si
+    un viaje circula hoy, o si es un viaje de madrugada del día de servicio
+    anterior, es O(1).
+    Las salidas se guardan en dos columnas (segundos y viaje) agrupadas por
+    (ruta, parada) y ordenadas por hora. Para cada día de servicio se compila
+    bajo demanda la lista ordenada de salidas (``DayDepartures``, también en
+    columnas) de cada combinación (fecha, ruta, origen, destino); las
+    consultas posteriores son una búsqueda binaria sobre esa lista, sin
+    tocar disco.
+
+    El índice residente ocupa como mucho MEMORY_BUDGET_PER_100K bytes por
+    cada 100.000 stop_times (ver ``memory_usage`` y el benchmark
+    ``memory``); cargado desde la caché, las columnas son páginas del
+    fichero mapeado que el sistema puede descartar.
+
+    El índice se puede volcar a una caché binaria (ver ``gtfs_cache``) que
+    se carga con ``mmap`` en milisegundos en los siguientes arranques.
+    """
+
+    def __init__(self, feed_dir, version, tables, columns, gtfs_path=None):
+        """Inicializar índice a partir de tablas de cadenas y columnas."""
+        self.gtfs_path = gtfs_path if gtfs_path is not None else feed_dir
+        self.feed_dir = feed_dir
+        self.version = version
+        self._tables = tables
+        self._columns = columns
+
+        self._trip_service = columns["trip_service"]
+        self._trip_pattern = columns["trip_pattern"]
+        self._dep_seconds = columns["dep_seconds"]
+        self._dep_trip = columns["dep_trip"]
+
+        dates = tables["dates"]
+        date_bitmap = columns["date_bitmap"]
+        stride = len(date_bitmap) // len(dates) if dates else 0
+        self._services_by_date = {
+            date: int.from_bytes(date_bitmap[i * stride:(i + 1) * stride], 'little')
+            for i, date in enumerate(dates)
+        }
+
+        routes = tables["routes"]
+        stops = tables["stops"]
+        key_route = columns["key_route"]
+        key_stop = columns["key_stop"]
+        key_offsets = columns["key_offsets"]
+        self._departure_ranges = {
+            (routes[key_route[i]], stops[key_stop[i]]): (key_offsets[i], key_offsets[i + 1])
+            for i in range(len(key_route))
+        }
+
+        # Listas diarias por fecha: como mucho el día anterior, el consultado y el siguiente
+        self._days = {}
+        self._trip_ids = None
+        self._pair_patterns = {}
+        self._stop_routes = None
+        self._board_engine = None
+        self.diff = None
+        # Paradas con todas sus salidas si el feed está podado (None = todas)
+        self.covered_stops = None
+        self.from_cache = False
+        self.day_cache_hits = 0
+        self.day_cache_misses = 0
+        self.day_lists_prepared = 0
+
+    @classmethod
+    def load(cls, gtfs_path):
+        """Cargar el índice de la versión activa desde su caché o desde el CSV."""
+        feed_dir = resolve_feed_dir(gtfs_path)
+        version = feed_version(feed_dir)
+        if version is None:
+            raise FileNotFoundError(f"GTFS incompleto en {feed_dir}")
+
+        cached = read_cache(cache_path(feed_dir), f"{INDEX_FORMAT}/{version}")
+        if cached is not None:
+            tables, columns = cached
+            _LOGGER.debug(f"Índice GTFS cargado desde caché: {feed_dir}")
+            index = cls(feed_dir, version, tables, columns, gtfs_path)
+            index.from_cache = True
+            return index
+
+        index = cls.build(feed_dir, version, gtfs_path)
+        try:
+            index.save()
+        except OSError as err:
+            _LOGGER.warning(f"⚠️ No se pudo guardar la caché GTFS: {err}")
+        return index
+
+    @classmethod
+    def build(cls, feed_dir, version=None, gtfs_path=None, previous=None):
+        """Parsear los CSV de un directorio GTFS y construir el índice.
+
+        Si se indica ``previous`` (el índice de la versión anterior) la
+        construcción es incremental: las tablas de ids se siembran con las
+        suyas para que cada id conserve su entero, los viajes cuyo hash no
+        cambia reutilizan sus horarios ya parseados y solo se recompilan los
+        grupos (ruta, parada) que tocan viajes añadidos, eliminados o
+        modificados. El resumen de cambios queda en ``diff``.
+        """
+        if version is None:
+            version = feed_version(feed_dir)
+        if previous is not None and previous.orphan_ratio() > MAX_ORPHAN_RATIO:
+            # Demasiados viajes eliminados acumulados: compactar desde cero
+            previous = None
+
+        prev_tables = previous._tables if previous is not None else {}
+        prev_columns = previous._columns if previous is not None else {}
+
+        routes = _StringTable(prev_tables.get("routes"))
+        stops = _StringTable(prev_tables.get("stops"))
+        trips = _StringTable(prev_tables.get("trips"))
+        services = _StringTable(prev_tables.get("services"))
+        headsigns = _StringTable(prev_tables.get("headsigns"))
+        prev_trip_count = len(trips.values)
+
+        services_by_date = _read_services_by_date(feed_dir, services)
+
+        trip_route = _copy_column('i', prev_columns.get("trip_route"))
+        trip_service = _copy_column('i', prev_columns.get("trip_service"))
+        trip_headsign = _copy_column('i', prev_columns.get("trip_headsign"))
+        trip_keys = {}
+        with open(os.path.join(feed_dir, 'trips.txt'), 'r', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                trip = trips.add(row['trip_id'])
+                if trip in trip_keys:
+                    continue
+                headsign = row.get('trip_headsign', '')
+                attrs = (
+                    routes.add(row['route_id']),
+                    services.add(row['service_id']),
+                    headsigns.add(headsign),
+                )
+                if trip < prev_trip_count:
+                    trip_route[trip], trip_service[trip], trip_headsign[trip] = attrs
+                else:
+                    trip_route.append(attrs[0])
+                    trip_service.append(attrs[1])
+                    trip_headsign.append(attrs[2])
+                trip_keys[trip] = f"{row['route_id']},{row['service_id']},{headsign}\n"
+
+        # Viajes de la versión anterior que ya no existen: quedan huérfanos
+        for trip in range(prev_trip_count):
+            if trip not in trip_keys:
+                trip_service[trip] = -1
+
+        prev_hash = prev_columns.get("trip_hash")
+        hashes = {}
+        parsed = {}
+        reused = set()
+        with open(os.path.join(feed_dir, 'stop_times.txt'), 'r', encoding='utf-8-sig') as f:
+            header = next(csv.reader([f.readline()]))
+            positions = (
+                header.index('stop_id'),
+                header.index('arrival_time') if 'arrival_time' in header else None,
+                header.index('departure_time'),
+                header.index('stop_sequence') if 'stop_sequence' in header else None,
+            )
+            for trip_id, lines in _trip_blocks(f, header.index('trip_id')):
+                trip = trips.ids.get(trip_id)
+                if trip is None or trip not in trip_keys:
+                    continue
+
+                if trip in hashes:
+                    # Bloque no contiguo del mismo viaje: se trata como modificado
+                    if trip in reused:
+                        reused.discard(trip)
+                        parsed[trip] = previous._trip_rows(trip)
+                    hashes[trip] = _hash_block(str(hashes[trip]), lines)
+                    _parse_block(lines, positions, stops, parsed[trip])
+                    continue
+
+                digest = _hash_block(trip_keys[trip], lines)
+                hashes[trip] = digest
+                if trip < prev_trip_count and prev_hash[trip] == digest:
+                    reused.add(trip)
+                    continue
+                parsed[trip] = _parse_block(
+                    lines, positions, stops, (array('i'), array('i'), array('i'))
+                )
+
+        trip_hash = array('q')
+        trip_offsets = array('i', [0])
+        st_stop = array('i')
+        st_arrival = array('i')
+        st_departure = array('i')
+        for trip in range(len(trips.values)):
+            if trip in reused:
+                start, end = previous._trip_range(trip)
+                _extend_column(st_stop, prev_columns["st_stop"][start:end])
+                _extend_column(st_arrival, prev_columns["st_arrival"][start:end])
+                _extend_column(st_departure, prev_columns["st_departure"][start:end])
+            elif trip in parsed:
+                trip_stops, trip_arrivals, trip_departures = parsed[trip]
+                st_stop.extend(trip_stops)
+                st_arrival.extend(trip_arrivals)
+                st_departure.extend(trip_departures)
+            trip_hash.append(hashes.get(trip, 0))
+            trip_offsets.append(len(st_stop))
+
+        # Patrones: secuencias de paradas distintas, compartidas por muchos viajes
+        pattern_ids = {}
+        trip_pattern = array('i')
+        pattern_offsets = array('i', [0])
+        pattern_stops = array('i')
+        for trip in range(len(trips.values)):
+            sequence = st_stop[trip_offsets[trip]:trip_offsets[trip + 1]]
+            key = sequence.tobytes()
+            pattern = pattern_ids.get(key)
+            if pattern is None:
+                pattern = len(pattern_ids)
+                pattern_ids[key] = pattern
+                pattern_stops.extend(sequence)
+                pattern_offsets.append(len(pattern_stops))
+            trip_pattern.append(pattern)
+
+        def had_rows(trip):
+            if trip >= prev_trip_count:
+                return False
+            start, end = previous._trip_range(trip)
+            return end > start
+
+        added = [t for t in parsed if not had_rows(t)]
+        changed = [t for t in parsed if had_rows(t)]
+        removed = [t for t in range(prev_trip_count) if t not in hashes and had_rows(t)]
+
+        # Grupos (ruta, parada) afectados por viajes añadidos, eliminados o modificados
+        affected_trips = set(parsed)
+        affected_trips.update(removed)
+        affected_keys = set()
+        for trip in changed + removed:
+            start, end = previous._trip_range(trip)
+            route = prev_columns["trip_route"][trip]
+            affected_keys.update((route, stop) for stop in prev_columns["st_stop"][start:end])
+        # Salidas nuevas por grupo, empaquetadas (segundos << 32 | viaje) en un
+        # array('q'): 8 bytes por salida en lugar de una tupla
+        new_entries = {}
+        for trip, (trip_stops, _trip_arrivals, trip_departures) in parsed.items():
+            route = trip_route[trip]
+            for stop, seconds in zip(trip_stops, trip_departures):
+                entries = new_entries.get((route, stop))
+                if entries is None:
+                    entries = new_entries[(route, stop)] = array('q')
+                entries.append(seconds << 32 | trip)
+        affected_keys.update(new_entries)
+
+        prev_groups = previous._departure_groups() if previous is not None else {}
+        key_route = array('i')
+        key_stop = array('i')
+        key_offsets = array('i', [0])
+        dep_seconds = array('i')
+        dep_trip = array('i')
+        for key in sorted(affected_keys.union(prev_groups)):
+            if key in prev_groups and key not in affected_keys:
+                start, end = prev_groups[key]
+                _extend_column(dep_seconds, prev_columns["dep_seconds"][start:end])
+                _extend_column(dep_trip, prev_columns["dep_trip"][start:end])
+            else:
+                departures = new_entries.get(key, array('q'))
+                if key in prev_groups:
+                    start, end = prev_groups[key]
+                    departures.extend(
+                        seconds << 32 | trip for seconds, trip in zip(
+                            prev_columns["dep_seconds"][start:end],
+                            prev_columns["dep_trip"][start:end],
+                        )
+                        if trip not in affected_trips
+                    )
+                if not departures:
+                    continue
+                departures = sorted(departures)
+                dep_seconds.extend(packed >> 32 for packed in departures)
+                dep_trip.extend(packed & 0xFFFFFFFF for packed in departures)
+            key_route.append(key[0])
+            key_stop.append(key[1])
+            key_offsets.append(len(dep_seconds))
+
+        date_bitmap = array('B')
+        dates = sorted(services_by_date)
+        stride = (len(services.values) + 7) // 8
+        for date in dates:
+            mask = sum(1 << service for service in services_by_date[date])
+            date_bitmap.frombytes(mask.to_bytes(stride, 'little'))
+
+        tables = {
+            "routes": routes.values,
+            "stops": stops.values,
+            "trips": trips.values,
+            "services": services.values,
+            "headsigns": headsigns.values,
+            "dates": dates,
+        }
+        columns = {
+            "trip_route": trip_route,
+            "trip_service": trip_service,
+            "trip_headsign": trip_headsign,
+            "trip_hash": trip_hash,
+            "trip_offsets": trip_offsets,
+            "trip_pattern": trip_pattern,
+            "pattern_offsets": pattern_offsets,
+            "pattern_stops": pattern_stops,
+            "st_stop": st_stop,
+            "st_arrival": st_arrival,
+            "st_departure": st_departure,
+            "date_bitmap": date_bitmap,
+            "key_route": key_route,
+            "key_stop": key_stop,
+            "key_offsets": key_offsets,
+            "dep_seconds": dep_seconds,
+            "dep_trip": dep_trip,
+        }
+        index = cls(feed_dir, version, tables, columns, gtfs_path)
+
+        if previous is not None:
+            changed_dates = sorted(
+                date for date in set(dates).union(previous._services_by_date)
+                if index._services_by_date.get(date) != previous._services_by_date.get(date)
+            )
+            trip_ids = trips.values
+            index.diff = {
+                "base": previous.version,
+                "added": len(added),
+                "removed": len(removed),
+                "changed": len(changed),
+                "unchanged": len(reused),
+                "changed_dates": changed_dates,
+                "affected": sorted([routes.values[r], stops.values[s]] for r, s in affected_keys),
+                "examples": {
+                    "added": [trip_ids[t] for t in added[:DIFF_EXAMPLES]],
+                    "removed": [trip_ids[t] for t in removed[:DIFF_EXAMPLES]],
+                    "changed": [trip_ids[t] for t in changed[:DIFF_EXAMPLES]],
+                },
+            }
+            _LOGGER.info(
+                f"Índice GTFS actualizado: {len(added)} viajes nuevos, "
+                f"{len(removed)} eliminados, {len(changed)} modificados, "
+                f"{len(reused)} sin cambios"
+            )
+        else:
+            _LOGGER.info(
+                f"Índice GTFS construido: {len(trip_keys)} viajes, "
+                f"{len(dep_seconds)} salidas en {len(key_route)} combinaciones ruta/parada"
+            )
+        return index
+
+    def save(self):
+        """Volcar el índice a su caché binaria junto al GTFS."""
+        write_cache(
+            cache_path(self.feed_dir), f"{INDEX_FORMAT}/{self.version}", self._tables, self._columns
+        )
+
+    def is_current(self):
+        """Comprobar si el índice corresponde a la versión activa del GTFS."""
+        feed_dir = resolve_feed_dir(self.gtfs_path)
+        return feed_dir == self.feed_dir and feed_version(feed_dir) == self.version
+
+    def orphan_ratio(self):
+        """Proporción de viajes de la tabla que ya no existen en el feed."""
+        trip_service = self._columns["trip_service"]
+        if not len(trip_service):
+            return 0
+        return sum(1 for service in trip_service if service < 0) / len(trip_service)
+
+    def adopt_day_cache(self, previous, diff):
+        """Heredar las listas diarias ya compiladas que no afecta el diff."""
+        if not diff or diff.get("base") != previous.version:
+            return
+        affected = {tuple(key) for key in diff["affected"]}
+        days = {}
+        for day, cache in previous._days.items():
+            if day in diff["changed_dates"] or previous_date(day) in diff["changed_dates"]:
+                continue
+            days[day] = {
+                key: departures for key, departures in cache.items()
+                if (key[0], key[1]) not in affected
+            }
+        self._days = days
+
+    def describe(self):
+        """Tamaño del índice y aciertos de las cachés, para los diagnósticos."""
+        return {
+            "version": self.version,
+            "feed_dir": self.feed_dir,
+            "from_cache": self.from_cache,
+            "routes": len(self._tables["routes"]),
+            "stops": len(self._tables["stops"]),
+            "trips": len(self._tables["trips"]),
+            "stop_times": len(self._columns["st_stop"]),
+            "patterns": len(self._columns["pattern_offsets"]) - 1,
+            "dates": len(self._services_by_date),
+            "orphan_ratio": round(self.orphan_ratio(), 4),
+            "days": sorted(self._days),
+            "day_lists": sum(len(cache) for cache in self._days.values()),
+            "day_cache_hits": self.day_cache_hits,
+            "day_cache_misses": self.day_cache_misses,
+            "day_lists_prepared": self.day_lists_prepared,
+            "memory": self.memory_usage(),
+        }
+
+    def memory_usage(self):
+        """Bytes aproximados del índice: columnas propias o mapeadas, tablas y listas."""
+        resident = mapped = 0
+        for column in self._columns.values():
+            if isinstance(column, array):
+                resident += column.itemsize * len(column)
+            else:
+                # memoryview sobre la caché mmap
+                mapped += column.nbytes
+        tables = sum(
+            sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+            for values in self._tables.values()
+        )
+        lookups = (
+            sys.getsizeof(self._services_by_date)
+            + sum(sys.getsizeof(mask) for mask in self._services_by_date.values())
+            + sys.getsizeof(self._departure_ranges)
+            + len(self._departure_ranges) * (2 * sys.getsizeof((0, 0)))
+        )
+        day_lists = sum(
+            departures.nbytes() for cache in self._days.values() for departures in cache.values()
+        )
+        return {
+            "columns": resident,
+            "mapped_columns": mapped,
+            "tables": tables,
+            "lookups": lookups,
+            "day_lists": day_lists,
+            "total": resident + tables + lookups + day_lists,
+        }
+
+    def _trip_range(self, trip):
+        """Rango de filas de stop_times de un viaje."""
+        trip_offsets = self._columns["trip_offsets"]
+        return trip_offsets[trip], trip_offsets[trip + 1]
+
+    def _trip_rows(self, trip):
+        """Copia de las paradas, llegadas y salidas de un viaje."""
+        start, end = self._trip_range(trip)
+        return (
+            _copy_column('i', self._columns["st_stop"][start:end]),
+            _copy_column('i', self._columns["st_arrival"][start:end]),
+            _copy_column('i', self._columns["st_departure"][start:end]),
+        )
+
+    def _departure_groups(self):
+        """Rangos de salidas por (ruta, parada) con enteros internados."""
+        key_route = self._columns["key_route"]
+        key_stop = self._columns["key_stop"]
+        key_offsets = self._columns["key_offsets"]
+        return {
+            (key_route[i], key_stop[i]): (key_offsets[i], key_offsets[i + 1])
+            for i in range(len(key_route))
+        }
+
+    def trip_schedule(self, trip_id):
+        """Paradas y segundos de llegada y salida de un viaje, en orden de recorrido."""
+        if self._trip_ids is None:
+            self._trip_ids = {trip: i for i, trip in enumerate(self._tables["trips"])}
+        trip = self._trip_ids.get(trip_id)
+        if trip is None:
+            return []
+        stops = self._tables["stops"]
+        start, end = self._trip_range(trip)
+        return [
+            (stops[stop], arrival, departure) for stop, arrival, departure in zip(
+                self._columns["st_stop"][start:end],
+                self._columns["st_arrival"][start:end],
+                self._columns["st_departure"][start:end],
+            )
+        ]
+
+    def has_service(self, date):
+        """Comprobar si hay algún servicio activo el día de servicio (YYYYMMDD)."""
+        return bool(self._services_by_date.get(date))
+
+    def service_window(self):
+        """Primera y última fecha con algún servicio (None, None si no hay)."""
+        dates = [date for date, active in self._services_by_date.items() if active]
+        if not dates:
+            return None, None
+        return min(dates), max(dates)
+
+    def projected_date(self, date):
+        """Fecha del feed cuyo horario se proyecta a una fecha posterior a su validez.
+
+        Es la última fecha con servicio del mismo día de la semana. Devuelve
+        None si date está dentro del periodo del feed (un día sin servicio
+        es un día sin servicio) o si no hay ninguna fecha que proyectar.
+        """
+        _first, last = self.service_window()
+        if last is None or date <= last:
+            return None
+        weekday = datetime.strptime(date, '%Y%m%d').weekday()
+        day = datetime.strptime(last, '%Y%m%d')
+        for _week in range(7):
+            if day.weekday() == weekday:
+                break
+            day -= timedelta(days=1)
+        while day.strftime('%Y%m%d') in self._services_by_date:
+            candidate = day.strftime('%Y%m%d')
+            if self.has_service(candidate):
+                return candidate
+            day -= timedelta(days=7)
+        return None
+
+    def day_departures(self, date, route_id, origin, destination):
+        """Salidas (minuto, id de viaje, minuto de llegada) de un día para ruta, origen y destino.
+
+        Incluye los viajes de madrugada del día de servicio anterior (horas
+        GTFS >= 24), con minutos desde la medianoche de date, y los del propio
+        día que pasan de medianoche, con minutos >= 24 * 60.
+        """
+        cache = self._days.get(date)
+        if cache is None:
+            cache = self._store_day(date, {})
+
+        key = (route_id, origin, destination)
+        departures = cache.get(key)
+        if departures is None:
+            self.day_cache_misses += 1
+            departures = self._compile_day(date, route_id, origin, destination)
+            cache[key] = departures
+        else:
+            self.day_cache_hits += 1
+        return departures
+
+    def _store_day(self, date, cache):
+        """Publicar la caché de listas de date y descartar las de días lejanos.
+
+        Se sustituye el diccionario entero, así que una consulta concurrente
+        ve la caché anterior o la nueva, nunca una a medias.
+        """
+        keep = (previous_date(date), date, next_date(date))
+        days = {day: lists for day, lists in self._days.items() if day in keep}
+        days[date] = cache
+        self._days = days
+        return cache
+
+    def is_prepared(self, date, keys):
+        """Comprobar si ya están compiladas las listas de date para las claves (ruta, origen, destino)."""
+        cache = self._days.get(date)
+        return cache is not None and all(key in cache for key in keys)
+
+    def prepare_day(self, date, keys):
+        """Compilar por adelantado las listas de date para las claves (ruta, origen, destino).
+
+        Se ejecuta en segundo plano antes del cambio de día; las listas se
+        publican juntas al terminar, así que a medianoche la consulta solo
+        tiene que encontrarlas. Devuelve el número de listas compiladas.
+        """
+        current = self._days.get(date, {})
+        missing = [key for key in keys if key not in current]
+        if not missing:
+            return 0
+        compiled = {key: self._compile_day(date, *key) for key in missing}
+        # Conservar las listas que se hayan compilado mientras tanto
+        self._store_day(date, {**self._days.get(date, {}), **compiled})
+        self.day_lists_prepared += len(missing)
+        return len(missing)
+
+    def next_departures(self, date, route_id, origin, destination, after_minutes, limit, lookahead=False):
+        """Próximas salidas (minuto, id de viaje, llegada) posteriores a after_minutes.
+
+        Con lookahead, si las salidas del día no llegan a limit se completan
+        con las primeras del día siguiente, con minutos >= 24 * 60.
+        """
+        departures = self.day_departures(date, route_id, origin, destination)
+        start = departures.position(after_minutes)
+        result = departures[start:start + limit]
+        if lookahead and len(result) < limit:
+            result += self._following_departures(
+                date, route_id, origin, destination, departures, after_minutes, limit - len(result)
+            )
+        return result
+
+    def _following_departures(self, date, route_id, origin, destination, departures, after_minutes, limit):
+        """Primeras salidas del día siguiente que no están ya en departures (la lista de date)."""
+        # La lista del día siguiente empieza con la madrugada de date, que
+        # departures ya incluye: se toma solo lo posterior a su última salida
+        last = departures[-1][0] if len(departures) else after_minutes
+        following = self.day_departures(next_date(date), route_id, origin, destination)
+        start = following.position(max(after_minutes, last) - MINUTES_PER_DAY)
+        return [
+            (minutes + MINUTES_PER_DAY, trip_id, arrival + MINUTES_PER_DAY)
+            for minutes, trip_id, arrival in following[start:start + limit]
+        ]
+
+    def routes_from(self, origin):
+        """Rutas con salidas desde una parada."""
+        if self._stop_routes is None:
+            stop_routes = {}
+            for route_id, stop_id in self._departure_ranges:
+                stop_routes.setdefault(stop_id, []).append(route_id)
+            self._stop_routes = stop_routes
+        return self._stop_routes.get(origin, [])
+
+    def next_departures_any(self, date, origin, destination, after_minutes, limit, lookahead=False):
+        """Próximas salidas (minuto, id de viaje, llegada, ruta) de cualquier ruta.
+
+        Mezcla (k-way) las listas diarias ya ordenadas de cada ruta que sale
+        de origin; de cada una solo se toman limit salidas, así que el coste
+        depende del número de resultados y no del tamaño del feed.
+        """
+        streams = []
+        for route_id in self.routes_from(origin):
+            departures = self.next_departures(
+                date, route_id, origin, destination, after_minutes, limit, lookahead
+            )
+            if departures:
+                streams.append([departure + (route_id,) for departure in departures])
+        return list(islice(heapq.merge(*streams), limit))
+
+    def departure_board(self, date, stop_id, after_minutes, window_minutes, limit, route_id=None):
+        """Salidas (minuto, id de viaje, ruta, headsign) de una parada, en todos los sentidos.
+
+        Incluye las salidas posteriores a after_minutes y hasta
+        after_minutes + window_minutes de todas las rutas (o de route_id),
+        también las de madrugada del día de servicio anterior. Cada grupo
+        (ruta, parada) está ordenado por hora, así que basta una búsqueda
+        binaria por grupo y día de servicio.
+        """
+        services = (
+            (self._services_by_date.get(date, 0), 0),
+            (self._services_by_date.get(previous_date(date), 0), MINUTES_PER_DAY),
+        )
+        routes = [route_id] if route_id else self.routes_from(stop_id)
+        trips = self._tables["trips"]
+        headsigns = self._tables["headsigns"]
+        trip_headsign = self._columns["trip_headsign"]
+        dep_seconds = self._dep_seconds
+        results = []
+        for route in routes:
+            departure_range = self._departure_ranges.get((route, stop_id))
+            if departure_range is None:
+                continue
+            lo, hi = departure_range
+            for active, shift in services:
+                if not active:
+                    continue
+                first = bisect_left(dep_seconds, (after_minutes + 1 + shift) * 60, lo, hi)
+                last = bisect_left(dep_seconds, (after_minutes + window_minutes + 1 + shift) * 60, first, hi)
+                for i in range(first, last):
+                    trip = self._dep_trip[i]
+                    service = self._trip_service[trip]
+                    if service >= 0 and active >> service & 1:
+                        results.append((
+                            dep_seconds[i] // 60 - shift,
+                            trips[trip],
+                            route,
+                            headsigns[trip_headsign[trip]],
+                        ))
+        results.sort()
+        return results[:limit]
+
+    def departure_boards(self, date, stop_ids, after_minutes, window_minutes, limit, route_id=None):
+        """Paneles (departure_board) de varias paradas: {parada: salidas}.
+
+        Con NUMPY_MIN_STOPS paradas o más, y NumPy instalado, se responden
+        todas a la vez con el motor vectorizado de ``gtfs_numpy``; si no,
+        parada a parada.
+        """
+        if len(stop_ids) >= NUMPY_MIN_STOPS:
+            engine = self._numpy_engine()
+            if engine is not None:
+                return engine.boards(date, stop_ids, after_minutes, window_minutes, limit, route_id)
+        return {
+            stop_id: self.departure_board(date, stop_id, after_minutes, window_minutes, limit, route_id)
+            for stop_id in stop_ids
+        }
+
+    def _numpy_engine(self):
+        """Motor NumPy de los paneles, construido la primera vez (None sin NumPy)."""
+        if self._board_engine is None:
+            from .gtfs_numpy import BoardEngine, load_numpy
+            np = load_numpy()
+            self._board_engine = BoardEngine(self, np) if np is not None else False
+        return self._board_engine or None
+
+    def departures_arriving_by(self, date, routes, origin, destination, after_minutes, arrive_by):
+        """Salidas (minuto, id de viaje, llegada, ruta) que llegan a tiempo.
+
+        Devuelve las salidas posteriores a after_minutes de las rutas indicadas
+        cuya llegada a destination no es posterior a arrive_by. Como ningún
+        tren llega antes de salir, basta con recorrer cada lista diaria entre
+        after_minutes y arrive_by.
+        """
+        results = []
+        for route_id in routes:
+            departures = self.day_departures(date, route_id, origin, destination)
+            start = departures.position(after_minutes)
+            end = departures.position(arrive_by)
+            results.extend(
+                departure + (route_id,) for departure in departures[start:end]
+                if departure[2] <= arrive_by
+            )
+        results.sort()
+        return results
+
+    def _patterns_between(self, origin, destination):
+        """Patrones que pasan por origin y después por destination (memorizado).
+
+        Devuelve un dict patrón -> posición de destination en el patrón, con
+        la que se obtiene la llegada de cada viaje sin recorrer sus paradas.
+        """
+        key = (origin, destination)
+        patterns = self._pair_patterns.get(key)
+        if patterns is not None:
+            return patterns
+
+        stops = self._tables["stops"]
+        pattern_offsets = self._columns["pattern_offsets"]
+        pattern_stops = self._columns["pattern_stops"]
+        patterns = {}
+        if origin in stops and destination in stops:
+            origin_id = stops.index(origin)
+            destination_id = stops.index(destination)
+            for pattern in range(len(pattern_offsets) - 1):
+                sequence = pattern_stops[pattern_offsets[pattern]:pattern_offsets[pattern + 1]].tolist()
+                if origin_id not in sequence:
+                    continue
+                start = sequence.index(origin_id) + 1
+                if destination_id in sequence[start:]:
+                    patterns[pattern] = sequence.index(destination_id, start)
+        self._pair_patterns[key] = patterns
+        return patterns
+
+    def _compile_day(self, date, route_id, origin, destination):
+        """Compilar la lista de salidas de un día, con la madrugada del anterior."""
+        today = self._services_by_date.get(date, 0)
+        yesterday = self._services_by_date.get(previous_date(date), 0)
+        result = DayDepartures(self._tables["trips"])
+        departure_range = self._departure_ranges.get((route_id, origin))
+        if not (today or yesterday) or departure_range is None:
+            return result
+        patterns = self._patterns_between(origin, destination)
+        if not patterns:
+            return result
+
+        trip_offsets = self._columns["trip_offsets"]
+        st_arrival = self._columns["st_arrival"]
+        departures = {}
+
+        def add(minutes, trip, arrival):
+            # Un solo viaje por minuto: el que antes llega a destino
+            current = departures.get(minutes)
+            if current is None or arrival < current[1]:
+                departures[minutes] = (trip, arrival)
+
+        for i in range(*departure_range):
+            trip = self._dep_trip[i]
+            service = self._trip_service[trip]
+            if service < 0:
+                continue
+            destination_pos = patterns.get(self._trip_pattern[trip])
+            if destination_pos is None:
+                continue
+            total_minutes = self._dep_seconds[i] // 60
+            arrival = st_arrival[trip_offsets[trip] + destination_pos] // 60
+            if today >> service & 1:
+                add(total_minutes, trip, arrival)
+            if total_minutes >= MINUTES_PER_DAY and yesterday >> service & 1:
+                add(total_minutes - MINUTES_PER_DAY, trip, arrival - MINUTES_PER_DAY)
+        for minutes, (trip, arrival) in sorted(departures.items()):
+            result.append(minutes, trip, arrival)
+        return result
@@ -0,0 +1,145 @@
+"""Motor vectorizado con NumPy para los paneles de salidas de muchas paradas.
+
+Es opcional: si NumPy no está instalado, ``GTFSIndex.departure_boards``
+responde parada a parada con búsquedas binarias en Python puro.
+
+Las salidas de todas las rutas se guardan como columnas NumPy ordenadas
+por (parada, hora) en una sola clave entera ``parada * span + segundos``,
+de modo que las ventanas de tiempo de todas las paradas pedidas se
+localizan con un único ``searchsorted`` y los servicios activos del día se
+aplican como una máscara sobre todas las salidas candidatas a la vez.
+"""
+import logging
+
+from .gtfs_index import MINUTES_PER_DAY, previous_date
+
+_LOGGER = logging.getLogger(__name__)
+
+_numpy = None
+
+
+def load_numpy():
+    """Importar NumPy la primera vez que se necesita (None si no está instalado)."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            _LOGGER.debug("NumPy no disponible, paneles de salidas en Python puro")
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+class BoardEngine:
+    """Columnas NumPy de las salidas de un índice, ordenadas por parada y hora."""
+
+    def __init__(self, index, np):
+        """Construir las columnas a partir de las del índice."""
+        columns = index._columns
+        self._np = np
+        self._index = index
+
+        key_offsets = np.frombuffer(columns["key_offsets"], dtype=np.intc)
+        lengths = np.diff(key_offsets)
+        stop = np.repeat(np.frombuffer(columns["key_stop"], dtype=np.intc), lengths)
+        route = np.repeat(np.frombuffer(columns["key_route"], dtype=np.intc), lengths)
+        seconds = np.frombuffer(columns["dep_seconds"], dtype=np.intc).astype(np.int64)
+        trip = np.frombuffer(columns["dep_trip"], dtype=np.intc)
+
+        self._span = int(seconds.max()) + 1 if len(seconds) else 1
+        keys = stop.astype(np.int64) * self._span + seconds
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._seconds = seconds[order]
+        self._trip = trip[order]
+        self._route = route[order]
+        # -1 (viaje huérfano) indexa la última posición de las máscaras, siempre False
+        self._service = np.frombuffer(columns["trip_service"], dtype=np.intc)[self._trip]
+
+        # Desempate por id de viaje, como el orden de tuplas de departure_board
+        trips = index._tables["trips"]
+        trip_rank = np.empty(len(trips), dtype=np.int64)
+        trip_rank[sorted(range(len(trips)), key=trips.__getitem__)] = np.arange(len(trips))
+        self._trip_rank = trip_rank[self._trip]
+
+        self._stop_ids = {stop_id: i for i, stop_id in enumerate(index._tables["stops"])}
+        self._route_ids = {route_id: i for i, route_id in enumerate(index._tables["routes"])}
+        self._n_services = len(index._tables["services"])
+
+    def _active(self, date):
+        """Máscara de servicios activos de una fecha, con una posición extra False."""
+        np = self._np
+        bits = self._index._services_by_date.get(date, 0)
+        mask = np.zeros(self._n_services + 1, dtype=bool)
+        if bits:
+            raw = np.frombuffer(bits.to_bytes((self._n_services + 7) // 8, "little"), dtype=np.uint8)
+            mask[:self._n_services] = np.unpackbits(raw, bitorder="little")[:self._n_services]
+        return mask
+
+    def boards(self, date, stop_ids, after_minutes, window_minutes, limit, route_id=None):
+        """Salidas (minuto, id de viaje, ruta, headsign) de cada parada, como departure_board."""
+        np = self._np
+        boards = {stop_id: [] for stop_id in stop_ids}
+        known = [stop_id for stop_id in boards if stop_id in self._stop_ids]
+        route = self._route_ids.get(route_id) if route_id else None
+        if not known or (route_id and route is None):
+            return boards
+
+        stops = np.array([self._stop_ids[stop_id] for stop_id in known], dtype=np.int64)
+        count = len(known)
+        # Un segmento por parada y día de servicio: hoy y la madrugada de ayer
+        stop_pos = np.concatenate((np.arange(count), np.arange(count)))
+        shift = np.repeat(np.array([0, MINUTES_PER_DAY], dtype=np.int64), count)
+        base = np.concatenate((stops, stops)) * self._span
+        # Acotar cada ventana al rango de su parada para no entrar en la siguiente
+        low = np.clip((after_minutes + 1 + shift) * 60, 0, self._span)
+        high = np.clip((after_minutes + window_minutes + 1 + shift) * 60, 0, self._span)
+        starts = np.searchsorted(self._keys, base + low)
+        ends = np.searchsorted(self._keys, base + high)
+        lengths = np.maximum(ends - starts, 0)
+        total = int(lengths.sum())
+        if not total:
+            return boards
+
+        # Índices de todas las salidas candidatas, segmento a segmento
+        segment = np.repeat(np.arange(len(starts)), lengths)
+        offsets = np.cumsum(lengths) - lengths
+        rows = starts[segment] + np.arange(total) - offsets[segment]
+
+        service = self._service[rows]
+        today = self._active(date)
+        yesterday = self._active(previous_date(date))
+        keep = np.where(segment < count, today[service], yesterday[service])
+        if route is not None:
+            keep &= self._route[rows] == route
+        rows = rows[keep]
+        segment = segment[keep]
+        if not len(rows):
+            return boards
+
+        minutes = self._seconds[rows] // 60 - shift[segment]
+        positions = stop_pos[segment]
+        order = np.lexsort((self._trip_rank[rows], minutes, positions))
+        rows = rows[order]
+        minutes = minutes[order]
+        positions = positions[order]
+
+        # Solo las limit primeras de cada parada
+        first = np.searchsorted(positions, positions, side="left")
+        selected = np.arange(len(rows)) - first < limit
+
+        trips = self._index._tables["trips"]
+        routes = self._index._tables["routes"]
+        headsigns = self._index._tables["headsigns"]
+        trip_headsign = self._index._columns["trip_headsign"]
+        for position, minute, trip, route_index in zip(
+            positions[selected].tolist(),
+            minutes[selected].tolist(),
+            self._trip[rows[selected]].tolist(),
+            self._route[rows[selected]].tolist(),
+        ):
+            boards[known[position]].append(
+                (minute, trips[trip], routes[route_index], headsigns[trip_headsign[trip]])
+            )
+        return boards
@@ -0,0 +1,272 @@
+"""Superposición GTFS-Realtime (TripUpdates) para FGC Trains.
+
+Decodifica los mensajes ``FeedMessage`` directamente del formato binario
+de protobuf, sin depender de ``gtfs-realtime-bindings``: solo se leen los
+campos de TripUpdate que necesita la integración.
+
+El overlay guarda los bytes de cada entidad y solo decodifica las que han
+cambiado desde el sondeo anterior, de modo que el coste de cada sondeo es
+proporcional a las actualizaciones y no al tamaño del feed.
+"""
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# Incrementality de FeedHeader
+FULL_DATASET = 0
+DIFFERENTIAL = 1
+
+# ScheduleRelationship de TripDescriptor y StopTimeUpdate
+TRIP_CANCELED = 3
+STOP_SKIPPED = 1
+STOP_NO_DATA = 2
+
+_WIRE_VARINT = 0
+_WIRE_64BIT = 1
+_WIRE_LENGTH = 2
+_WIRE_32BIT = 5
+
+
+def _read_varint(data, pos):
+    """Leer un varint de protobuf; devuelve (valor, nueva posición)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint demasiado largo")
+
+
+def _signed(value):
+    """Interpretar un varint int32/int64 (complemento a dos de 64 bits)."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _fields(data):
+    """Iterar los campos (número, valor) de un mensaje protobuf.
+
+    Los campos de longitud variable se devuelven como ``memoryview`` sin
+    copiar; los de tamaño fijo se ignoran porque TripUpdate no los usa.
+    """
+    data = memoryview(data)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        field, wire = key >> 3, key & 7
+        if wire == _WIRE_VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire == _WIRE_LENGTH:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire == _WIRE_64BIT:
+            pos += 8
+            continue
+        elif wire == _WIRE_32BIT:
+            pos += 4
+            continue
+        else:
+            raise ValueError(f"tipo de campo protobuf no soportado: {wire}")
+        if pos > end:
+            raise ValueError("mensaje protobuf truncado")
+        yield field, value
+
+
+def _text(value):
+    """Decodificar un campo string."""
+    return bytes(value).decode("utf-8")
+
+
+def _stop_time_event(data):
+    """Decodificar un StopTimeEvent: (delay, time), cada uno o None."""
+    delay = time = None
+    for field, value in _fields(data):
+        if field == 1:
+            delay = _signed(value)
+        elif field == 2:
+            time = _signed(value)
+    return delay, time
+
+
+def _stop_time_update(data):
+    """Decodificar un StopTimeUpdate: (stop_id, llegada, salida, relación)."""
+    stop_id = None
+    arrival = departure = None
+    relationship = 0
+    for field, value in _fields(data):
+        if field == 4:
+            stop_id = _text(value)
+        elif field == 2:
+            arrival = _stop_time_event(value)
+        elif field == 3:
+            departure = _stop_time_event(value)
+        elif field == 5:
+            relationship = value
+    return stop_id, arrival, departure, relationship
+
+
+class TripDelay:
+    """Estado en tiempo real de un viaje."""
+
+    __slots__ = ("trip_id", "canceled", "delay", "stops")
+
+    def __init__(self, trip_id, canceled=False, delay=None, stops=None):
+        """Inicializar estado de viaje."""
+        self.trip_id = trip_id
+        self.canceled = canceled
+        self.delay = delay
+        self.stops = stops or {}
+
+
+def parse_trip_update(data):
+    """Decodificar un TripUpdate en un ``TripDelay`` (None si no tiene viaje)."""
+    trip_id = None
+    canceled = False
+    delay = None
+    stops = {}
+    for field, value in _fields(data):
+        if field == 1:
+            for trip_field, trip_value in _fields(value):
+                if trip_field == 1:
+                    trip_id = _text(trip_value)
+                elif trip_field == 4:
+                    canceled = trip_value == TRIP_CANCELED
+        elif field == 2:
+            stop_id, arrival, departure, relationship = _stop_time_update(value)
+            if stop_id is not None and relationship != STOP_NO_DATA:
+                stops[stop_id] = (arrival, departure, relationship == STOP_SKIPPED)
+        elif field == 5:
+            delay = _signed(value)
+    if trip_id is None:
+        return None
+    return TripDelay(trip_id, canceled, delay, stops)
+
+
+class RealtimeOverlay:
+    """Retrasos en tiempo real por viaje, mantenidos de forma incremental."""
+
+    def __init__(self):
+        """Inicializar overlay vacío."""
+        self.trips = {}
+        self.timestamp = None
+        self._entities = {}
+
+    def apply(self, payload):
+        """Aplicar un FeedMessage; devuelve el número de entidades que cambian.
+
+        Solo se decodifican los TripUpdate cuyos bytes difieren de los del
+        sondeo anterior. En un feed FULL_DATASET las entidades ausentes se
+        eliminan; en uno DIFFERENTIAL solo las marcadas como borradas.
+        """
+        incrementality = FULL_DATASET
+        seen = set()
+        changed = 0
+        for field, value in _fields(payload):
+            if field == 1:
+                for header_field, header_value in _fields(value):
+                    if header_field == 2:
+                        incrementality = header_value
+                    elif header_field == 3:
+                        self.timestamp = header_value
+            elif field == 2:
+                entity_id = None
+                deleted = False
+                trip_update = None
+                for entity_field, entity_value in _fields(value):
+                    if entity_field == 1:
+                        entity_id = _text(entity_value)
+                    elif entity_field == 2:
+                        deleted = bool(entity_value)
+                    elif entity_field == 3:
+                        trip_update = entity_value
+                if entity_id is None:
+                    continue
+                if deleted or trip_update is None:
+                    changed += self._remove(entity_id)
+                    continue
+                seen.add(entity_id)
+                changed += self._update(entity_id, trip_update)
+
+        if incrementality == FULL_DATASET:
+            for entity_id in [e for e in self._entities if e not in seen]:
+                changed += self._remove(entity_id)
+        return changed
+
+    def _update(self, entity_id, data):
+        """Actualizar una entidad si sus bytes han cambiado."""
+        previous = self._entities.get(entity_id)
+        if previous is not None and previous[0] == data:
+            return 0
+        trip = parse_trip_update(data)
+        if previous is not None:
+            self.trips.pop(previous[1], None)
+        if trip is None:
+            self._entities.pop(entity_id, None)
+            return 1
+        self._entities[entity_id] = (bytes(data), trip.trip_id)
+        self.trips[trip.trip_id] = trip
+        return 1
+
+    def _remove(self, entity_id):
+        """Eliminar una entidad; devuelve 1 si existía."""
+        previous = self._entities.pop(entity_id, None)
+        if previous is None:
+            return 0
+        self.trips.pop(previous[1], None)
+        return 1
+
+    def departure_delay(self, trip_id, stop_id, schedule, service_start):
+        """Retraso en segundos de la salida de un viaje en una parada.
+
+        ``schedule`` es la lista (parada, llegada, salida) del viaje en orden
+        de recorrido, en segundos, y ``service_start`` el timestamp de la
+        medianoche de su día de servicio. Si la parada no tiene predicción
+        propia se propaga la de la última parada anterior que la tenga o, en
+        su defecto, el retraso del viaje. Devuelve None sin datos y False si
+        el tren no pasará por la parada (viaje cancelado o parada suprimida).
+        """
+        return self._stop_delay(trip_id, stop_id, schedule, service_start, arrival=False)
+
+    def arrival_delay(self, trip_id, stop_id, schedule, service_start):
+        """Retraso en segundos de la llegada de un viaje a una parada (ver departure_delay)."""
+        return self._stop_delay(trip_id, stop_id, schedule, service_start, arrival=True)
+
+    def _stop_delay(self, trip_id, stop_id, schedule, service_start, arrival):
+        """Retraso propagado hasta una parada, de llegada o de salida."""
+        trip = self.trips.get(trip_id)
+        if trip is None:
+            return None
+        if trip.canceled:
+            return False
+
+        delay = trip.delay
+        for stop, arrival_seconds, departure_seconds in schedule:
+            update = trip.stops.get(stop)
+            if update is not None:
+                arrival_event, departure_event, skipped = update
+                if stop == stop_id and skipped:
+                    return False
+                # Preferir el evento pedido; si falta, el otro de la misma parada
+                if arrival:
+                    events = ((arrival_event, arrival_seconds), (departure_event, departure_seconds))
+                else:
+                    events = ((departure_event, departure_seconds), (arrival_event, arrival_seconds))
+                for event, seconds in events:
+                    if event is None:
+                        continue
+                    event_delay, event_time = event
+                    if event_delay is not None:
+                        delay = event_delay
+                        break
+                    if event_time is not None:
+                        delay = event_time - (service_start + seconds)
+                        break
+            if stop == stop_id:
+                break
+        return delay
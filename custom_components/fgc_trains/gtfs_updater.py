@@ -1,102 +1,458 @@
 """Actualizador de GTFS."""
+import io
 import os
+import csv
+import json
 import logging
-import requests
 import zipfile
 import shutil
 from datetime import datetime
 
 from .const import GTFS_URL
+from .gtfs_cache import CACHE_FILE
+from .gtfs_index import GTFSIndex, CURRENT_FILE, VERSIONS_DIR, resolve_feed_dir
+from .catalog import CatalogBuilder
+from .stats import timed
 
 _LOGGER = logging.getLogger(__name__)
 
-def update_gtfs(gtfs_path=None):
-    """Descargar y actualizar GTFS."""
-    if gtfs_path is None:
-        from .const import DEFAULT_GTFS_PATH
-        gtfs_path = DEFAULT_GTFS_PATH
+# Metadatos de la descarga (ETag, Last-Modified) guardados junto al GTFS
+FEED_META_FILE = "feed_meta.json"
+
+REQUIRED_FILES = ['trips.txt', 'stops.txt', 'stop_times.txt']
+
+# Ficheros y columnas del GTFS que usa la integración; el resto del ZIP
+# (shapes, transfers, tarifas...) no se extrae. El orden importa: el
+# catálogo necesita leer trips.txt antes que stop_times.txt
+GTFS_COLUMNS = {
+    'routes.txt': ('route_id', 'route_short_name', 'route_long_name'),
+    'calendar.txt': (
+        'service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+        'saturday', 'sunday', 'start_date', 'end_date',
+    ),
+    'calendar_dates.txt': ('service_id', 'date', 'exception_type'),
+    'trips.txt': ('route_id', 'service_id', 'trip_id', 'trip_headsign'),
+    'stop_times.txt': ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'),
+    'stops.txt': ('stop_id', 'stop_name'),
+    'feed_info.txt': ('feed_start_date', 'feed_end_date', 'feed_version'),
+}
+
+# Versión de GTFS_COLUMNS y del filtrado de stop_times; si cambia, los GTFS
+# instalados se re-extraen del ZIP
+INGEST_SCHEMA = 7
+
+# ZIP original conservado dentro del GTFS para re-extraerlo sin red
+SOURCE_ZIP = "feed.zip"
+
+# Ficheros que el formato anterior (sin versiones) dejaba en gtfs_path
+LEGACY_FILES = (
+    'agency.txt', 'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt',
+    'calendar.txt', 'calendar_dates.txt', 'fare_attributes.txt', 'fare_rules.txt',
+    'shapes.txt', 'frequencies.txt', 'transfers.txt', 'pathways.txt', 'levels.txt',
+    'feed_info.txt', 'translations.txt', 'attributions.txt',
+    FEED_META_FILE, SOURCE_ZIP, CACHE_FILE,
+)
+
+# Tamaño de bloque de la descarga: acota la memoria usada con ZIPs grandes
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Timeout (segundos) de conexión y de lectura de cada bloque
+DOWNLOAD_TIMEOUT = 30
+
+def read_feed_meta(gtfs_path):
+    """Leer los metadatos de descarga del GTFS instalado."""
+    try:
+        with open(os.path.join(gtfs_path, FEED_META_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def read_feed_info(feed_dir):
+    """Primera fila de feed_info.txt (periodo de validez publicado), o {}."""
+    try:
+        with open(os.path.join(feed_dir, 'feed_info.txt'), 'r', encoding='utf-8-sig') as f:
+            return {key: value.strip() for key, value in next(csv.DictReader(f), {}).items() if value}
+    except OSError:
+        return {}
+
+def write_feed_meta(gtfs_path, meta):
+    """Guardar los metadatos de descarga del GTFS."""
+    with open(os.path.join(gtfs_path, FEED_META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+def _conditional_headers(meta):
+    """Cabeceras If-None-Match/If-Modified-Since de la descarga anterior."""
+    headers = {}
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+def _download_meta(headers, size):
+    """Metadatos a guardar de una descarga completada."""
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'downloaded': datetime.now().isoformat(),
+        'size': size,
+    }
+
+async def async_download_gtfs(hass, session, dest_file, meta=None, url=GTFS_URL):
+    """Descargar el ZIP en streaming a dest_file sobre una sesión aiohttp.
+
+    Si meta contiene el ETag/Last-Modified de la descarga anterior se hace
+    una petición condicional. Devuelve los metadatos de la nueva descarga,
+    o None si el servidor responde 304 (el GTFS no ha cambiado). Cada
+    bloque se escribe en el executor para no bloquear el event loop.
+    """
+    # Este módulo no depende de Home Assistant (lo usan los benchmarks y los
+    # tests sin aiohttp instalado); dentro de HA aiohttp ya está cargado
+    import aiohttp
     
-    temp_dir = None
-    backup_path = None
+    headers = _conditional_headers(meta)
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=DOWNLOAD_TIMEOUT, sock_read=DOWNLOAD_TIMEOUT
+    )
     
-    try:
-        _LOGGER.info(f"🚆 Iniciando descarga GTFS desde {GTFS_URL}...")
-        
-        # Descargar a archivo temporal
-        response = requests.get(GTFS_URL, timeout=30)
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        if response.status == 304:
+            return None
         response.raise_for_status()
         
-        temp_file = f"/tmp/gtfs_fgc_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-        with open(temp_file, 'wb') as f:
-            f.write(response.content)
+        size = 0
+        f = await hass.async_add_executor_job(open, dest_file, 'wb')
+        try:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                await hass.async_add_executor_job(f.write, chunk)
+                size += len(chunk)
+        finally:
+            await hass.async_add_executor_job(f.close)
         
-        _LOGGER.info(f"✅ Descarga completada ({len(response.content)} bytes)")
+        return _download_meta(response.headers, size)
+
+def _trips_serving(zip_ref, member, stop_ids):
+    """Ids de los viajes de stop_times.txt que paran en alguna de stop_ids."""
+    trips = set()
+    with zip_ref.open(member) as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+        header = [name.strip() for name in next(reader, [])]
+        trip_position = header.index('trip_id')
+        stop_position = header.index('stop_id')
+        for row in reader:
+            if row and row[stop_position] in stop_ids:
+                trips.add(row[trip_position])
+    return trips
+
+def extract_gtfs(zip_path, dest_dir, stop_ids=None):
+    """Extraer del ZIP solo los ficheros y columnas que usa la integración.
+
+    Cada fichero se lee en streaming desde el ZIP y se escribe ya podado a
+    las columnas de GTFS_COLUMNS. Si se indica stop_ids, stop_times.txt se
+    filtra además a los viajes que paran en esas paradas, con todas sus
+    paradas: el tiempo real propaga los retrasos desde las anteriores. En
+    la misma pasada, y antes del filtro, se genera el catálogo de líneas y
+    estaciones.
+    """
+    if stop_ids is not None:
+        stop_ids = frozenset(stop_ids)
+    os.makedirs(dest_dir, exist_ok=True)
+    catalog = CatalogBuilder()
+    
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = {os.path.basename(name): name for name in zip_ref.namelist()}
         
+        for file_name, columns in GTFS_COLUMNS.items():
+            member = members.get(file_name)
+            if member is None:
+                continue
+            
+            with zip_ref.open(member) as raw, open(
+                os.path.join(dest_dir, file_name), 'w', encoding='utf-8', newline=''
+            ) as out:
+                reader = csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+                header = [name.strip() for name in next(reader, [])]
+                positions = [header.index(c) if c in header else None for c in columns]
+                add_to_catalog = catalog.row_handler(file_name, header)
+                
+                trips = trip_position = None
+                if stop_ids is not None and file_name == 'stop_times.txt':
+                    trips = _trips_serving(zip_ref, member, stop_ids)
+                    trip_position = header.index('trip_id')
+                
+                writer = csv.writer(out, lineterminator='\n')
+                writer.writerow(columns)
+                for row in reader:
+                    if not row:
+                        continue
+                    if add_to_catalog is not None:
+                        add_to_catalog(row)
+                    if trips is not None and row[trip_position] not in trips:
+                        continue
+                    writer.writerow([
+                        row[p] if p is not None and p < len(row) else ''
+                        for p in positions
+                    ])
+    
+    catalog.write(dest_dir)
+
+def activate_version(gtfs_path, version):
+    """Apuntar gtfs_path/current a una versión instalada (reemplazo atómico)."""
+    pointer = os.path.join(gtfs_path, CURRENT_FILE)
+    tmp_pointer = f"{pointer}.tmp"
+    with open(tmp_pointer, 'w', encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_pointer, pointer)
+
+def _load_active_index(gtfs_path):
+    """Índice de la versión activa, base de la construcción incremental."""
+    try:
+        return GTFSIndex.load(gtfs_path)
+    except Exception as e:
+        _LOGGER.debug(f"Sin índice previo para construcción incremental: {e}")
+        return None
+
+def _same_source(previous_meta, meta):
+    """Comprobar si meta describe la misma descarga que previous_meta (re-extracción)."""
+    if not previous_meta or not meta:
+        return False
+    keys = ('etag', 'last_modified', 'size', 'downloaded')
+    return all(previous_meta.get(key) == meta.get(key) for key in keys)
+
+def install_gtfs(zip_path, gtfs_path, meta, stop_ids=None, stats=None):
+    """Extraer un ZIP descargado e instalarlo como nueva versión activa.
+
+    La versión se extrae e indexa por completo en su propio directorio y
+    solo entonces se cambia el puntero, de modo que los lectores siguen
+    usando la versión anterior mientras tanto. El ZIP se conserva dentro
+    de la versión (SOURCE_ZIP) para poder volver a extraerlo sin red si
+    cambian las paradas o el esquema de ingesta. Con stats se miden las
+    etapas "extract" e "index_build".
+
+    Si el ZIP es el mismo que el de la versión activa (una re-extracción
+    por cambio de paradas o de esquema) no se guarda diff: los horarios no
+    han cambiado, solo lo que se extrae de ellos.
+    """
+    versions_dir = os.path.join(gtfs_path, VERSIONS_DIR)
+    os.makedirs(versions_dir, exist_ok=True)
+    
+    version = datetime.now().strftime('%Y%m%d_%H%M%S')
+    suffix = 1
+    while os.path.exists(os.path.join(versions_dir, version)):
+        suffix += 1
+        version = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{suffix}"
+    version_dir = os.path.join(versions_dir, version)
+    temp_dir = f"{version_dir}.tmp"
+    
+    try:
         # Extraer a directorio temporal primero
-        temp_dir = f"/tmp/gtfs_fgc_extract_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        with zipfile.ZipFile(temp_file, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
+        with timed(stats, "extract"):
+            extract_gtfs(zip_path, temp_dir, stop_ids)
         
         _LOGGER.info(f"✅ Archivos extraídos a temporal")
         
         # Verificar que se extrajeron archivos importantes
-        required_files = ['trips.txt', 'stops.txt', 'stop_times.txt']
-        for req_file in required_files:
+        for req_file in REQUIRED_FILES:
             if not os.path.exists(os.path.join(temp_dir, req_file)):
                 raise Exception(f"Archivo requerido no encontrado: {req_file}")
         
-        # Ahora sí, hacer backup y reemplazar
-        if os.path.exists(gtfs_path):
-            backup_path = f"{gtfs_path}_backup_{datetime.now().strftime('%Y%m%d')}"
-            if os.path.exists(backup_path):
-                shutil.rmtree(backup_path)
-            shutil.move(gtfs_path, backup_path)
-            _LOGGER.info(f"📦 Backup creado: {backup_path}")
+        shutil.move(zip_path, os.path.join(temp_dir, SOURCE_ZIP))
         
-        # Mover archivos del temporal al destino final
-        shutil.move(temp_dir, gtfs_path)
+        # Precompilar el índice para que los lectores lo carguen al instante,
+        # de forma incremental respecto a la versión activa si la hay
+        diff = None
+        try:
+            with timed(stats, "index_build"):
+                index = GTFSIndex.build(temp_dir, previous=_load_active_index(gtfs_path))
+                index.save()
+            if not _same_source(_installed_meta(gtfs_path), meta):
+                diff = index.diff
+            _LOGGER.info("✅ Caché del índice GTFS generada")
+        except Exception as e:
+            _LOGGER.warning(f"⚠️ No se pudo generar la caché del índice GTFS: {e}")
         
-        # Limpiar archivo zip temporal
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+        write_feed_meta(temp_dir, {
+            **meta,
+            'schema': INGEST_SCHEMA,
+            'stops': sorted(stop_ids) if stop_ids is not None else None,
+            'diff': diff,
+        })
+        
+        os.rename(temp_dir, version_dir)
         
-        cleanup_old_backups(gtfs_path)
+    except Exception:
+        # La versión activa no se ha tocado; basta con limpiar temporales
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        raise
+    
+    activate_version(gtfs_path, version)
+    _LOGGER.info(f"📦 Versión GTFS activa: {version}")
+    
+    cleanup_old_backups(gtfs_path)
+
+def _installed_meta(gtfs_path):
+    """Metadatos del GTFS activo, o None si no está instalado completo.
+
+    Solo se pide condicionalmente si el GTFS instalado está completo.
+    """
+    feed_dir = resolve_feed_dir(gtfs_path)
+    installed = all(
+        os.path.exists(os.path.join(feed_dir, req_file))
+        for req_file in REQUIRED_FILES
+    )
+    return read_feed_meta(feed_dir) if installed else None
+
+def _download_path(gtfs_path):
+    """Archivo temporal de descarga junto al GTFS (mismo disco: mover es renombrar)."""
+    os.makedirs(gtfs_path, exist_ok=True)
+    return os.path.join(
+        gtfs_path, f"download_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip.tmp"
+    )
+
+def _remove_file(path):
+    """Borrar un archivo temporal si existe."""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+async def async_update_gtfs(hass, session, gtfs_path, stop_ids=None, url=GTFS_URL, stats=None):
+    """Descargar y actualizar el GTFS.
+
+    stop_ids limita stop_times.txt a las paradas indicadas (None = todas).
+    La descarga usa la sesión aiohttp indicada; la extracción y el
+    indexado se hacen en el executor.
+    """
+    temp_file = None
+    
+    try:
+        _LOGGER.info(f"🚆 Iniciando descarga GTFS desde {url}...")
+        
+        meta = await hass.async_add_executor_job(_installed_meta, gtfs_path)
+        temp_file = await hass.async_add_executor_job(_download_path, gtfs_path)
+        with timed(stats, "download"):
+            new_meta = await async_download_gtfs(hass, session, temp_file, meta, url)
+        
+        if new_meta is None:
+            _LOGGER.info("✅ GTFS sin cambios en el servidor (304), nada que actualizar")
+            if stats is not None:
+                stats.increment("download_not_modified")
+            if stop_ids is not None and await hass.async_add_executor_job(
+                needs_reingest, gtfs_path, stop_ids
+            ):
+                return await hass.async_add_executor_job(reingest_gtfs, gtfs_path, stop_ids, stats)
+            return True
+        
+        _LOGGER.info(f"✅ Descarga completada ({new_meta['size']} bytes)")
+        if stats is not None:
+            stats.set("download_bytes", new_meta['size'])
+        
+        await hass.async_add_executor_job(
+            install_gtfs, temp_file, gtfs_path, new_meta, stop_ids, stats
+        )
         
         _LOGGER.info("✅ GTFS actualizado correctamente")
         return True
         
     except Exception as e:
         _LOGGER.error(f"❌ Error actualizando GTFS: {e}", exc_info=True)
+        if stats is not None:
+            stats.increment("update_errors")
+        return False
+    
+    finally:
+        if temp_file:
+            await hass.async_add_executor_job(_remove_file, temp_file)
+
+def needs_reingest(gtfs_path, stop_ids):
+    """Comprobar si el GTFS instalado debe re-extraerse de su ZIP.
+
+    Ocurre si se extrajo con otro esquema de ingesta o si se filtró a un
+    conjunto de paradas que no incluye stop_ids.
+    """
+    feed_dir = resolve_feed_dir(gtfs_path)
+    meta = read_feed_meta(feed_dir)
+    if 'schema' not in meta:
+        # Extraído completo por una versión anterior de la integración
+        return False
+    if not os.path.exists(os.path.join(feed_dir, SOURCE_ZIP)):
+        return False
+    if meta['schema'] != INGEST_SCHEMA:
+        return True
+    covered = meta.get('stops')
+    return covered is not None and not set(stop_ids) <= set(covered)
+
+def reingest_gtfs(gtfs_path, stop_ids=None, stats=None):
+    """Re-extraer el GTFS instalado desde su ZIP, sin descargar nada.
+
+    Las paradas ya cubiertas se mantienen además de las de stop_ids.
+    """
+    temp_file = os.path.join(
+        gtfs_path, f"reingest_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip.tmp"
+    )
+    
+    try:
+        feed_dir = resolve_feed_dir(gtfs_path)
+        meta = read_feed_meta(feed_dir)
+        covered = meta.get('stops')
+        if stop_ids is not None and covered is not None:
+            stop_ids = set(stop_ids) | set(covered)
+        else:
+            stop_ids = None
         
-        # Restaurar backup si existe y el destino está vacío/corrupto
-        if backup_path and os.path.exists(backup_path) and not os.path.exists(gtfs_path):
-            _LOGGER.warning(f"🔄 Restaurando backup desde {backup_path}")
-            shutil.copytree(backup_path, gtfs_path)
-            _LOGGER.info("✅ Backup restaurado")
-        
-        # Limpiar temporales
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        _LOGGER.info("🔄 Re-extrayendo GTFS desde el ZIP conservado...")
+        # Las versiones no se modifican nunca: basta un enlace al ZIP
+        source_zip = os.path.join(feed_dir, SOURCE_ZIP)
+        try:
+            os.link(source_zip, temp_file)
+        except OSError:
+            shutil.copy2(source_zip, temp_file)
+        install_gtfs(temp_file, gtfs_path, meta, stop_ids, stats)
+        return True
         
+    except Exception as e:
+        _LOGGER.error(f"❌ Error re-extrayendo GTFS: {e}", exc_info=True)
         return False
+    
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
 
 def cleanup_old_backups(gtfs_path, keep=3):
-    """Limpiar backups antiguos."""
+    """Limpiar versiones antiguas del GTFS.
+
+    Las copias de seguridad son las versiones anteriores a la activa; se
+    conservan las keep más recientes para poder volver a ellas con
+    activate_version. También se eliminan los ficheros y backups del
+    formato anterior, sin versiones.
+    """
     try:
-        parent_dir = os.path.dirname(gtfs_path)
-        base_name = os.path.basename(gtfs_path)
+        versions_dir = os.path.join(gtfs_path, VERSIONS_DIR)
+        current = os.path.basename(resolve_feed_dir(gtfs_path))
         
         backups = sorted([
-            f for f in os.listdir(parent_dir)
-            if f.startswith(f"{base_name}_backup_")
+            f for f in os.listdir(versions_dir)
+            if f != current and not f.endswith('.tmp')
         ], reverse=True)
         
         for backup in backups[keep:]:
-            backup_path = os.path.join(parent_dir, backup)
-            shutil.rmtree(backup_path)
-            _LOGGER.info(f"🗑️ Backup antiguo eliminado: {backup}")
+            shutil.rmtree(os.path.join(versions_dir, backup))
+            _LOGGER.info(f"🗑️ Versión GTFS antigua eliminada: {backup}")
+        
+        # Ficheros del formato anterior directamente en gtfs_path
+        for name in LEGACY_FILES:
+            path = os.path.join(gtfs_path, name)
+            if os.path.isfile(path):
+                os.remove(path)
+        
+        parent_dir = os.path.dirname(gtfs_path)
+        base_name = os.path.basename(gtfs_path)
+        for name in os.listdir(parent_dir):
+            if name.startswith(f"{base_name}_backup_"):
+                shutil.rmtree(os.path.join(parent_dir, name))
+                _LOGGER.info(f"🗑️ Backup antiguo eliminado: {name}")
             
     except Exception as e:
         _LOGGER.warning(f"⚠️ Error limpiando backups: {e}")
@@ -1,133 +1,269 @@
 """Plataforma de sensores para FGC Trains."""
+import os
 import logging
 
-from homeassistant.components.sensor import SensorEntity
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.const import EntityCategory, UnitOfTime
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
-from .const import DOMAIN
+from .const import DOMAIN, ANY_LINE, DEFAULT_TRAIN_SENSORS, MAIN_SENSOR_TRAINS, MAX_TRAIN_SENSORS
 
 _LOGGER = logging.getLogger(__name__)
 
 async def async_setup_entry(hass, entry, async_add_entities):
     """Configurar sensores desde config entry (UI)."""
     coordinator = hass.data[DOMAIN][entry.entry_id]
-    
-    sensors = [
-        FGCMainSensor(coordinator, entry),
-        FGCIndividualTrainSensor(coordinator, entry, 1),
-        FGCIndividualTrainSensor(coordinator, entry, 2),
-        FGCIndividualTrainSensor(coordinator, entry, 3),
-        FGCIndividualTrainSensor(coordinator, entry, 4),
-    ]
-    
+    config = {**entry.data, **entry.options}
+    train_sensors = config.get("train_sensors", DEFAULT_TRAIN_SENSORS)
+
+    # Quitar del registro los sensores que sobran si se ha reducido el número
+    # de trenes o desactivado los de diagnóstico
+    unused = [f"train_{number}" for number in range(train_sensors + 1, MAX_TRAIN_SENSORS + 1)]
+    if not config.get("diagnostic_sensors", False):
+        unused.extend(key for key, _name, _value, _unit in DIAGNOSTIC_SENSORS)
+    registry = er.async_get(hass)
+    for key in unused:
+        entity_id = registry.async_get_entity_id("sensor", DOMAIN, f"{entry.entry_id}_{key}")
+        if entity_id is not None:
+            registry.async_remove(entity_id)
+
+    renderer = FGCSensorRenderer(coordinator)
+    sensors = [FGCMainSensor(coordinator, entry, renderer)]
+    sensors.extend(
+        FGCIndividualTrainSensor(coordinator, entry, renderer, number)
+        for number in range(1, train_sensors + 1)
+    )
+    if config.get("diagnostic_sensors", False):
+        sensors.extend(
+            FGCDiagnosticSensor(coordinator, entry, key, name, value, unit)
+            for key, name, value, unit in DIAGNOSTIC_SENSORS
+        )
+
     async_add_entities(sensors)
 
-class FGCMainSensor(CoordinatorEntity, SensorEntity):
-    """Sensor principal de FGC."""
+class FGCSensorRenderer:
+    """Estado y atributos de todos los sensores de una entry.
 
-    def __init__(self, coordinator, entry):
-        """Inicializar sensor."""
-        super().__init__(coordinator)
-        self._entry = entry
-        line = entry.data["line"]
-        origin = entry.data["origin"]
-        dest = entry.data["destination"]
-        self._attr_name = f"FGC {line} {origin}-{dest}"
-        self._attr_unique_id = f"{entry.entry_id}_main"
-        self._attr_icon = "mdi:train"
+    Se calculan una sola vez por cada versión de los datos del coordinador
+    y los comparten todas las entidades de la entry.
+    """
 
-    @property
-    def state(self):
-        """Estado del sensor."""
-        if not self.coordinator.data or "trains" not in self.coordinator.data:
+    def __init__(self, coordinator):
+        """Inicializar renderer."""
+        self.coordinator = coordinator
+        self._data = None
+        self._main = (None, {})
+        self._trains = ()
+
+    def main(self):
+        """(estado, atributos) del sensor principal."""
+        self._render()
+        return self._main
+
+    def train(self, number):
+        """(estado, atributos) del sensor del tren number, o None si no hay tren."""
+        self._render()
+        if number > len(self._trains):
             return None
-        
-        trains = self.coordinator.data["trains"]
-        if trains and len(trains) > 0:
-            return trains[0]["time"]
-        return "No hay trenes"
+        return self._trains[number - 1]
+
+    def _render(self):
+        """Recalcular si los datos del coordinador han cambiado."""
+        data = self.coordinator.data
+        if data is self._data:
+            return
+        self._data = data
+
+        if not data or "trains" not in data:
+            self._main = (None, {})
+            self._trains = ()
+            return
+
+        coordinator = self.coordinator
+        trains = data["trains"]
+        common = {
+            "line": coordinator.line,
+            "origin": coordinator.origin,
+            "destination": coordinator.destination,
+        }
 
-    @property
-    def extra_state_attributes(self):
-        """Atributos del sensor."""
-        if not self.coordinator.data or "trains" not in self.coordinator.data:
-            return {}
-        
-        trains = self.coordinator.data["trains"]
-        
         attrs = {
-            "line": self._entry.data["line"],
-            "origin": self._entry.data["origin"],
-            "destination": self._entry.data["destination"],
-            "origin_name": self.get_station_name(self._entry.data["origin"]),
-            "destination_name": self.get_station_name(self._entry.data["destination"]),
-            "total_departures_today": self.coordinator.data.get("total", 0),
-            "last_update": self.coordinator.data.get("last_update"),
-            "trip_duration": "~50 min"
+            **common,
+            "origin_name": coordinator.feed.station_name(coordinator.origin),
+            "destination_name": coordinator.feed.station_name(coordinator.destination),
+            "total_departures_today": data.get("total", 0),
+            "last_update": data.get("last_update"),
+            "trip_duration": trains[0]["duration"] if trains else None,
+            "realtime": data.get("realtime", False),
+            "valid_until": data.get("valid_until"),
+            "stale_schedule": data.get("stale_schedule", False),
         }
-        
-        for i in range(min(4, len(trains))):
-            train = trains[i]
-            num = i + 1
+
+        if data.get("stale_schedule"):
+            attrs["schedule_date"] = data["schedule_date"]
+        if data.get("timetable_changes"):
+            attrs["timetable_changes"] = data["timetable_changes"]
+
+        for num, train in enumerate(trains[:MAIN_SENSOR_TRAINS], start=1):
             attrs[f"train_{num}_time"] = train["time"]
             attrs[f"train_{num}_minutes"] = train["minutes_until"]
-        
-        return attrs
-    
-    def get_station_name(self, code):
-        """Obtener nombre de estación."""
-        from .const import STATIONS
-        return STATIONS.get(code, code)
-
-class FGCIndividualTrainSensor(CoordinatorEntity, SensorEntity):
-    """Sensor individual para cada tren."""
+            attrs[f"train_{num}_line"] = train["route"]
+            attrs[f"train_{num}_arrival"] = train["arrival_time"]
+            if "delay" in train:
+                attrs[f"train_{num}_delay"] = train["delay"]
+
+        self._main = (trains[0]["time"] if trains else "No hay trenes", attrs)
+
+        rendered = []
+        for num, train in enumerate(trains, start=1):
+            train_attrs = {
+                "train_number": num,
+                **common,
+                "departure_time": train["time"],
+                "minutes_until_departure": train["minutes_until"],
+                "train_line": train["route"],
+                "arrival_time": train["arrival_time"],
+                "duration_minutes": train["duration"],
+            }
+            if "delay" in train:
+                train_attrs["scheduled_time"] = train["scheduled_time"]
+                train_attrs["delay_minutes"] = train["delay"]
+            rendered.append((train["time"], train_attrs))
+        self._trains = tuple(rendered)
 
-    def __init__(self, coordinator, entry, train_number):
+class FGCBaseSensor(CoordinatorEntity, SensorEntity):
+    """Sensor que toma su estado del renderer compartido.
+
+    Solo escribe estado si lo que muestra ha cambiado respecto a la última
+    escritura.
+    """
+
+    def __init__(self, coordinator, renderer):
         """Inicializar sensor."""
         super().__init__(coordinator)
-        self._entry = entry
+        self._renderer = renderer
+        self._rendered = None
+        self._written_available = None
+        self._refresh_from_renderer()
+
+    def _current(self):
+        """(estado, atributos, disponible) según el renderer."""
+        raise NotImplementedError
+
+    def _refresh_from_renderer(self):
+        """Copiar el estado del renderer; devuelve True si ha cambiado."""
+        rendered = self._current()
+        if rendered == self._rendered:
+            return False
+        self._rendered = rendered
+        self._attr_native_value, self._attr_extra_state_attributes, self._sensor_available = rendered
+        return True
+
+    @callback
+    def _handle_coordinator_update(self):
+        """Escribir estado solo si cambia lo que muestra el sensor o su disponibilidad.
+
+        Una actualización fallida no cambia coordinator.data, pero sí
+        last_update_success y con ello available: también hay que escribir.
+        """
+        changed = self._refresh_from_renderer()
+        available = self.available
+        if changed or available != self._written_available:
+            self._written_available = available
+            with self.coordinator.stats.timed("entity_write"):
+                self.async_write_ha_state()
+        else:
+            self.coordinator.stats.increment("entity_write_skipped")
+
+    @property
+    def available(self):
+        """Disponibilidad del sensor: no lo está hasta la primera carga del GTFS."""
+        return self.coordinator.data is not None and self._sensor_available and super().available
+
+class FGCMainSensor(FGCBaseSensor):
+    """Sensor principal de FGC."""
+
+    def __init__(self, coordinator, entry, renderer):
+        """Inicializar sensor."""
+        line = coordinator.line
+        origin = coordinator.origin
+        dest = coordinator.destination
+        if line == ANY_LINE:
+            self._attr_name = f"FGC {origin}-{dest}"
+        else:
+            self._attr_name = f"FGC {line} {origin}-{dest}"
+        self._attr_unique_id = f"{entry.entry_id}_main"
+        self._attr_icon = "mdi:train"
+        super().__init__(coordinator, renderer)
+
+    def _current(self):
+        """(estado, atributos, disponible) según el renderer."""
+        state, attrs = self._renderer.main()
+        return state, attrs, True
+
+class FGCIndividualTrainSensor(FGCBaseSensor):
+    """Sensor individual para cada tren."""
+
+    def __init__(self, coordinator, entry, renderer, train_number):
+        """Inicializar sensor."""
         self._train_number = train_number
-        line = entry.data["line"]
+        line = coordinator.line
+        if line == ANY_LINE:
+            line = f"{coordinator.origin}-{coordinator.destination}"
         self._attr_name = f"FGC {line} Tren {train_number}"
         self._attr_unique_id = f"{entry.entry_id}_train_{train_number}"
         self._attr_icon = "mdi:train-car"
+        super().__init__(coordinator, renderer)
 
-    @property
-    def state(self):
-        """Estado del sensor."""
-        if not self.coordinator.data or "trains" not in self.coordinator.data:
-            return None
-        
-        trains = self.coordinator.data["trains"]
-        if trains and len(trains) >= self._train_number:
-            return trains[self._train_number - 1]["time"]
-        return None
+    def _current(self):
+        """(estado, atributos, disponible) según el renderer."""
+        rendered = self._renderer.train(self._train_number)
+        if rendered is None:
+            return None, {}, False
+        state, attrs = rendered
+        return state, attrs, True
 
-    @property
-    def extra_state_attributes(self):
-        """Atributos del sensor."""
-        if not self.coordinator.data or "trains" not in self.coordinator.data:
-            return {}
-        
-        trains = self.coordinator.data["trains"]
-        
-        attrs = {
-            "train_number": self._train_number,
-            "line": self._entry.data["line"],
-            "origin": self._entry.data["origin"],
-            "destination": self._entry.data["destination"],
-        }
-        
-        if trains and len(trains) >= self._train_number:
-            train = trains[self._train_number - 1]
-            attrs["departure_time"] = train["time"]
-            attrs["minutes_until_departure"] = train["minutes_until"]
-        
-        return attrs
+def _query_ms(coordinator):
+    """Última consulta de próximos trenes (con o sin tiempo real)."""
+    if coordinator.data and coordinator.data.get("realtime"):
+        return coordinator.stats.last_ms("rt_merge")
+    return coordinator.stats.last_ms("query")
+
+def _feed_version(coordinator):
+    """Versión GTFS activa (nombre de su directorio)."""
+    index = coordinator.feed.index
+    return os.path.basename(index.feed_dir) if index is not None else None
+
+# (clave, nombre, valor, unidad) de los sensores de diagnóstico opcionales
+DIAGNOSTIC_SENSORS = (
+    ("query_time", "Tiempo consulta", _query_ms, UnitOfTime.MILLISECONDS),
+    ("refresh_time", "Tiempo refresco", lambda c: c.stats.last_ms("refresh"), UnitOfTime.MILLISECONDS),
+    ("index_load_time", "Tiempo carga índice", lambda c: c.feed.stats.last_ms("index_load"), UnitOfTime.MILLISECONDS),
+    ("feed_version", "Versión GTFS", _feed_version, None),
+)
+
+class FGCDiagnosticSensor(CoordinatorEntity, SensorEntity):
+    """Sensor de diagnóstico con una medida de rendimiento del coordinador o del feed."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, coordinator, entry, key, name, value, unit):
+        """Inicializar sensor."""
+        super().__init__(coordinator)
+        self._value = value
+        line = coordinator.line
+        if line == ANY_LINE:
+            line = f"{coordinator.origin}-{coordinator.destination}"
+        self._attr_name = f"FGC {line} {name}"
+        self._attr_unique_id = f"{entry.entry_id}_{key}"
+        self._attr_icon = "mdi:speedometer"
+        self._attr_native_unit_of_measurement = unit
+        if unit is not None:
+            self._attr_state_class = SensorStateClass.MEASUREMENT
 
     @property
-    def available(self):
-        """Disponibilidad del sensor."""
-        if not self.coordinator.data or "trains" not in self.coordinator.data:
-            return False
-        return len(self.coordinator.data["trains"]) >= self._train_number
+    def native_value(self):
+        """Valor actual de la medida."""
+        return self._value(self.coordinator)
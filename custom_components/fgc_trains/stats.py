@@ -0,0 +1,91 @@
+"""Tiempos por etapa y contadores para los diagnósticos de FGC Trains.
+
+Cada feed y cada coordinador tiene su ``Stats``: medir una etapa son dos
+lecturas de ``perf_counter`` y unas sumas, así que se mide siempre. Los
+datos solo se consultan desde ``diagnostics.py`` y, si se activan, desde
+los sensores de diagnóstico.
+"""
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageTiming:
+    """Tiempos acumulados de una etapa."""
+
+    __slots__ = ("count", "total", "last", "max")
+
+    def __init__(self):
+        """Inicializar sin mediciones."""
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Registrar una ejecución de la etapa."""
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        """Tiempos en milisegundos."""
+        return {
+            "count": self.count,
+            "last_ms": round(self.last * 1000, 3),
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else None,
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Stats:
+    """Tiempos por etapa, contadores y últimos valores de un componente."""
+
+    def __init__(self):
+        """Inicializar vacío."""
+        self.timings = {}
+        self.counters = {}
+        self.values = {}
+
+    def record(self, stage, seconds):
+        """Registrar la duración de una etapa."""
+        timing = self.timings.get(stage)
+        if timing is None:
+            timing = self.timings[stage] = StageTiming()
+        timing.add(seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        """Medir el bloque como una ejecución de stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def increment(self, counter, amount=1):
+        """Sumar a un contador."""
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set(self, name, value):
+        """Guardar el último valor de una magnitud (bytes descargados, etc.)."""
+        self.values[name] = value
+
+    def last_ms(self, stage):
+        """Última duración de una etapa en milisegundos (None si no se ha medido)."""
+        timing = self.timings.get(stage)
+        return round(timing.last * 1000, 3) if timing is not None else None
+
+    def as_dict(self):
+        """Datos para los diagnósticos."""
+        return {
+            "timings": {stage: timing.as_dict() for stage, timing in self.timings.items()},
+            "counters": dict(self.counters),
+            "values": dict(self.values),
+        }
+
+
+def timed(stats, stage):
+    """``stats.timed(stage)``, o un contexto vacío si no hay stats."""
+    return stats.timed(stage) if stats is not None else nullcontext()
@@ -0,0 +1,49 @@
+"""Configuración de pytest para FGC Trains.
+
+Los tests cubren los módulos de la integración que no dependen de Home
+Assistant. ``__init__.py`` importa Home Assistant, así que el paquete se
+registra vacío (como en ``benchmarks/run.py``) para que las importaciones
+relativas entre módulos funcionen. Los feeds de prueba salen del generador
+sintético de los benchmarks.
+"""
+import os
+import sys
+import shutil
+import importlib.util
+import importlib.machinery
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "fgc_trains"
+COMPONENT_DIR = os.path.join(ROOT, "custom_components", PACKAGE)
+
+if PACKAGE not in sys.modules:
+    spec = importlib.machinery.ModuleSpec(PACKAGE, None, is_package=True)
+    package = importlib.util.module_from_spec(spec)
+    package.__path__ = [COMPONENT_DIR]
+    sys.modules[PACKAGE] = package
+
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from synthetic_feed import generate_feed  # noqa: E402
+
+
+@pytest.fixture
+def feed_zip(tmp_path):
+    """ZIP GTFS sintético pequeño, con viajes después de medianoche."""
+    path = tmp_path / "feed.zip"
+    generate_feed(str(path), routes=3, stops=30, stops_per_route=10, trips=16, days=21)
+    return path
+
+
+@pytest.fixture
+def installed_feed(tmp_path, feed_zip):
+    """gtfs_path con feed_zip instalado como versión activa (con caché del índice)."""
+    from fgc_trains.gtfs_updater import install_gtfs
+
+    gtfs_path = tmp_path / "gtfs"
+    # install_gtfs se queda el ZIP: se instala una copia
+    copy = shutil.copy(feed_zip, tmp_path / "install.zip")
+    install_gtfs(str(copy), str(gtfs_path), {"etag": "v1", "size": 1})
+    return str(gtfs_path)
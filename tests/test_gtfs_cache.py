@@ -0,0 +1,82 @@
+"""Tests de la caché binaria del índice: lectura y vuelta al CSV si no sirve."""
+import os
+import sys
+
+import pytest
+
+from fgc_trains.gtfs_cache import cache_path, read_cache, write_cache
+from fgc_trains.gtfs_index import INDEX_FORMAT, GTFSIndex, feed_version, resolve_feed_dir
+
+
+def _cache(gtfs_path):
+    """Ruta de la caché y versión esperada de la versión activa."""
+    feed_dir = resolve_feed_dir(gtfs_path)
+    return cache_path(feed_dir), f"{INDEX_FORMAT}/{feed_version(feed_dir)}"
+
+
+def _mappings(path):
+    """Número de mapeos del fichero en el proceso (solo Linux)."""
+    with open("/proc/self/maps", encoding="utf-8") as maps:
+        return sum(1 for line in maps if line.rstrip().endswith(path))
+
+
+def _sample(index):
+    """Unas cuantas consultas para comparar índices."""
+    date = sorted(index._services_by_date)[3]
+    stops = index._tables["stops"]
+    return index.departure_boards(date, stops, 0, 30 * 60, 1000)
+
+
+def test_load_uses_valid_cache(installed_feed):
+    index = GTFSIndex.load(installed_feed)
+
+    assert index.from_cache
+    assert _sample(index) == _sample(GTFSIndex.build(index.feed_dir))
+
+
+def test_stale_cache_is_rebuilt(installed_feed):
+    path, version = _cache(installed_feed)
+    built = GTFSIndex.build(resolve_feed_dir(installed_feed))
+    # Caché de otra versión del formato o del feed
+    write_cache(path, f"{version}-old", built._tables, built._columns)
+
+    assert read_cache(path, version) is None
+    index = GTFSIndex.load(installed_feed)
+    assert not index.from_cache
+    assert _sample(index) == _sample(built)
+    # La carga la reescribe para la versión actual
+    assert GTFSIndex.load(installed_feed).from_cache
+
+
+@pytest.mark.parametrize("damage", ["truncate", "corrupt_header", "garbage"])
+def test_invalid_cache_falls_back_to_csv(installed_feed, damage):
+    path, version = _cache(installed_feed)
+    expected = _sample(GTFSIndex.load(installed_feed))
+
+    with open(path, "r+b") as f:
+        data = f.read()
+        f.seek(0)
+        if damage == "truncate":
+            f.truncate(len(data) // 2)
+        elif damage == "corrupt_header":
+            f.write(data[:12] + b"{" * 16 + data[28:])
+        else:
+            f.write(b"\0" * len(data))
+
+    assert read_cache(path, version) is None
+    index = GTFSIndex.load(installed_feed)
+    assert not index.from_cache
+    assert _sample(index) == expected
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="usa /proc/self/maps")
+def test_discarded_cache_is_unmapped(installed_feed):
+    path, version = _cache(installed_feed)
+
+    assert read_cache(path, f"{version}-old") is None
+    assert _mappings(path) == 0
+
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) // 2)
+    assert read_cache(path, version) is None
+    assert _mappings(path) == 0
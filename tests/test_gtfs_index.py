@@ -0,0 +1,147 @@
+"""Tests del índice GTFS en memoria."""
+import itertools
+
+from synthetic_feed import generate_feed
+
+from fgc_trains.gtfs_index import MINUTES_PER_DAY, GTFSIndex
+from fgc_trains.gtfs_updater import extract_gtfs
+
+
+def _extract(tmp_path, name, **options):
+    """Generar y extraer un feed sintético; devuelve su directorio."""
+    path = tmp_path / f"{name}.zip"
+    generate_feed(str(path), routes=3, stops=30, stops_per_route=10, trips=16, days=21, **options)
+    feed_dir = tmp_path / name
+    extract_gtfs(str(path), str(feed_dir))
+    return str(feed_dir)
+
+
+def _answers(index):
+    """Paneles de todas las paradas y salidas entre pares, en varias fechas."""
+    stops = index._tables["stops"]
+    answers = {}
+    for date in sorted(index._services_by_date)[:8]:
+        answers[date, "boards"] = index.departure_boards(date, stops, 0, 30 * 60, 1000)
+        for origin, destination in itertools.islice(itertools.permutations(stops, 2), 200):
+            answers[date, origin, destination] = index.next_departures_any(
+                date, origin, destination, 0, 1000
+            )
+    return answers
+
+
+def test_incremental_build_matches_full_build(tmp_path):
+    first = _extract(tmp_path, "a")
+    second = _extract(tmp_path, "b", variant=0.2)
+    third = _extract(tmp_path, "c", variant=0.4)
+
+    previous = GTFSIndex.build(first)
+    incremental = GTFSIndex.build(second, previous=previous)
+    assert incremental.diff["added"] and incremental.diff["removed"] and incremental.diff["changed"]
+    assert _answers(incremental) == _answers(GTFSIndex.build(second))
+
+    # Encadenada sobre otro índice incremental (con viajes huérfanos)
+    chained = GTFSIndex.build(third, previous=incremental)
+    assert _answers(chained) == _answers(GTFSIndex.build(third))
+
+
+def test_incremental_build_without_changes_reports_none(tmp_path):
+    feed_dir = _extract(tmp_path, "a")
+    previous = GTFSIndex.build(feed_dir)
+    index = GTFSIndex.build(feed_dir, previous=previous)
+
+    assert index.diff["added"] == index.diff["removed"] == index.diff["changed"] == 0
+    assert index.diff["changed_dates"] == []
+    assert _answers(index) == _answers(previous)
+
+
+# Lunes 5 y martes 6 de enero de 2026: servicio "L" de lunes a viernes salvo
+# el festivo del día 6, en que circula el servicio "F"
+DAY_FEED = {
+    "routes.txt": "route_id,route_short_name,route_long_name\nR1,R1,A - C\n",
+    "calendar.txt": (
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+        "L,1,1,1,1,1,0,0,20260105,20260109\n"
+    ),
+    "calendar_dates.txt": "service_id,date,exception_type\nL,20260106,2\nF,20260106,1\n",
+    "trips.txt": (
+        "route_id,service_id,trip_id,trip_headsign\n"
+        "R1,L,MORNING,C\nR1,L,LATE,C\nR1,L,NIGHT,C\nR1,F,HOLIDAY,C\n"
+    ),
+    "stop_times.txt": (
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "MORNING,08:00:00,08:00:00,A,1\nMORNING,08:10:00,08:10:00,B,2\nMORNING,08:20:00,08:20:00,C,3\n"
+        "LATE,23:50:00,23:50:00,A,1\nLATE,24:00:00,24:00:00,B,2\nLATE,24:10:00,24:10:00,C,3\n"
+        "NIGHT,24:30:00,24:30:00,A,1\nNIGHT,24:40:00,24:40:00,B,2\nNIGHT,24:50:00,24:50:00,C,3\n"
+        "HOLIDAY,09:00:00,09:00:00,A,1\nHOLIDAY,09:10:00,09:10:00,B,2\nHOLIDAY,09:20:00,09:20:00,C,3\n"
+    ),
+    "stops.txt": "stop_id,stop_name\nA,A\nB,B\nC,C\n",
+}
+
+
+def _day_index(tmp_path):
+    """Índice de DAY_FEED."""
+    for name, content in DAY_FEED.items():
+        (tmp_path / name).write_text(content, encoding="utf-8")
+    return GTFSIndex.build(str(tmp_path))
+
+
+def test_service_dates_apply_calendar_exceptions(tmp_path):
+    index = _day_index(tmp_path)
+
+    assert index.has_service("20260105")
+    assert index.has_service("20260106")
+    assert not index.has_service("20260110")
+    assert index.service_window() == ("20260105", "20260109")
+    assert [d[1] for d in index.day_departures("20260106", "R1", "A", "C")] == ["NIGHT", "HOLIDAY"]
+
+
+def test_trips_after_midnight_belong_to_their_service_day(tmp_path):
+    index = _day_index(tmp_path)
+
+    # Las horas >= 24:00 quedan en el día de servicio, con minutos >= 24 * 60
+    assert index.day_departures("20260105", "R1", "A", "C")[:] == [
+        (8 * 60, "MORNING", 8 * 60 + 20),
+        (23 * 60 + 50, "LATE", MINUTES_PER_DAY + 10),
+        (MINUTES_PER_DAY + 30, "NIGHT", MINUTES_PER_DAY + 50),
+    ]
+    # ... y el día siguiente empieza con esa madrugada del anterior
+    assert index.day_departures("20260106", "R1", "A", "C")[:] == [
+        (30, "NIGHT", 50),
+        (9 * 60, "HOLIDAY", 9 * 60 + 20),
+    ]
+    # LATE sale de A a las 23:50 pero de B a las 24:00, ya el día siguiente
+    assert index.next_departures("20260106", "R1", "B", "C", -1, 5) == [
+        (0, "LATE", 10),
+        (30 + 10, "NIGHT", 50),
+        (9 * 60 + 10, "HOLIDAY", 9 * 60 + 20),
+    ]
+    # El sábado no hay servicio, pero sí la madrugada del viernes
+    assert not index.has_service("20260110")
+    assert index.next_departures("20260110", "R1", "B", "C", -1, 5) == [
+        (0, "LATE", 10),
+        (40, "NIGHT", 50),
+    ]
+    assert index.next_departures("20260111", "R1", "A", "C", -1, 5) == []
+
+
+def test_departure_board_includes_previous_service_day(tmp_path):
+    index = _day_index(tmp_path)
+
+    assert index.departure_board("20260106", "A", 0, 60, 10) == [(30, "NIGHT", "R1", "C")]
+    assert index.departure_board("20260105", "A", 23 * 60, 120, 10) == [
+        (23 * 60 + 50, "LATE", "R1", "C"),
+        (MINUTES_PER_DAY + 30, "NIGHT", "R1", "C"),
+    ]
+
+
+def test_lookahead_adds_next_day_without_repeating_night_trips(tmp_path):
+    index = _day_index(tmp_path)
+
+    assert index.next_departures("20260105", "R1", "A", "C", 23 * 60, 4, lookahead=True) == [
+        (23 * 60 + 50, "LATE", MINUTES_PER_DAY + 10),
+        (MINUTES_PER_DAY + 30, "NIGHT", MINUTES_PER_DAY + 50),
+        (MINUTES_PER_DAY + 9 * 60, "HOLIDAY", MINUTES_PER_DAY + 9 * 60 + 20),
+    ]
+    assert index.next_departures_any("20260105", "A", "C", MINUTES_PER_DAY + 30, 1, lookahead=True) == [
+        (MINUTES_PER_DAY + 9 * 60, "HOLIDAY", MINUTES_PER_DAY + 9 * 60 + 20, "R1"),
+    ]
@@ -0,0 +1,173 @@
+"""Tests del decodificador GTFS-RT contra un FeedMessage codificado a mano."""
+import zipfile
+
+from fgc_trains.gtfs_index import GTFSIndex
+from fgc_trains.gtfs_rt import DIFFERENTIAL, STOP_SKIPPED, RealtimeOverlay
+from fgc_trains.gtfs_updater import extract_gtfs
+
+SERVICE_START = 1_760_000_000
+
+# Viaje A -> B -> C -> D, una parada cada 5 minutos desde las 08:00
+SCHEDULE = [
+    ("A", 8 * 3600, 8 * 3600),
+    ("B", 8 * 3600 + 300, 8 * 3600 + 300),
+    ("C", 8 * 3600 + 600, 8 * 3600 + 600),
+    ("D", 8 * 3600 + 900, 8 * 3600 + 900),
+]
+
+
+def _varint(value):
+    """Codificar un varint (los negativos en complemento a dos de 64 bits)."""
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _varint_field(number, value):
+    """Campo varint de protobuf."""
+    return _varint(number << 3) + _varint(value)
+
+
+def _length_field(number, value):
+    """Campo de longitud variable de protobuf (bytes o texto)."""
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def stop_time_update(stop_id, delay=None, time=None, relationship=None):
+    """StopTimeUpdate con el mismo evento de llegada y de salida."""
+    event = b""
+    if delay is not None:
+        event += _varint_field(1, delay)
+    if time is not None:
+        event += _varint_field(2, time)
+    message = _length_field(4, stop_id)
+    if event:
+        message += _length_field(2, event) + _length_field(3, event)
+    if relationship is not None:
+        message += _varint_field(5, relationship)
+    return message
+
+
+def entity(entity_id, trip_id, updates=(), canceled=False, delay=None, deleted=False):
+    """FeedEntity con un TripUpdate."""
+    trip = _length_field(1, trip_id) + (_varint_field(4, 3) if canceled else b"")
+    trip_update = _length_field(1, trip) + b"".join(_length_field(2, update) for update in updates)
+    if delay is not None:
+        trip_update += _varint_field(5, delay)
+    message = _length_field(1, entity_id)
+    if deleted:
+        message += _varint_field(2, 1)
+    return message + _length_field(3, trip_update)
+
+
+def feed_message(entities, incrementality=0):
+    """FeedMessage con cabecera 2.0 y las entidades indicadas."""
+    header = (
+        _length_field(1, "2.0") + _varint_field(2, incrementality) + _varint_field(3, SERVICE_START)
+    )
+    return _length_field(1, header) + b"".join(_length_field(2, e) for e in entities)
+
+
+def test_apply_decodes_only_changed_entities():
+    overlay = RealtimeOverlay()
+    message = feed_message([
+        entity("e1", "T1", [stop_time_update("B", delay=120)]),
+        entity("e2", "T2", canceled=True),
+    ])
+
+    assert overlay.apply(message) == 2
+    assert overlay.timestamp == SERVICE_START
+    assert sorted(overlay.trips) == ["T1", "T2"]
+    # Los mismos bytes no cambian nada
+    assert overlay.apply(message) == 0
+
+
+def test_full_dataset_drops_missing_entities_and_differential_keeps_them():
+    overlay = RealtimeOverlay()
+    overlay.apply(feed_message([entity("e1", "T1", delay=60), entity("e2", "T2", delay=60)]))
+
+    assert overlay.apply(feed_message([entity("e1", "T1", delay=60)], DIFFERENTIAL)) == 0
+    assert sorted(overlay.trips) == ["T1", "T2"]
+
+    assert overlay.apply(feed_message([entity("e2", "T2", deleted=True)], DIFFERENTIAL)) == 1
+    assert sorted(overlay.trips) == ["T1"]
+
+    assert overlay.apply(feed_message([entity("e3", "T3", delay=0)])) == 2
+    assert sorted(overlay.trips) == ["T3"]
+
+
+def test_delay_propagates_from_earlier_stops():
+    overlay = RealtimeOverlay()
+    overlay.apply(feed_message([
+        entity("e1", "T1", [stop_time_update("A", delay=300)]),
+        entity("e2", "T2", [stop_time_update("B", time=SERVICE_START + SCHEDULE[1][2] + 120)]),
+        entity("e3", "T3", delay=-60),
+    ]))
+
+    assert overlay.departure_delay("T1", "C", SCHEDULE, SERVICE_START) == 300
+    assert overlay.arrival_delay("T1", "D", SCHEDULE, SERVICE_START) == 300
+    # Hora absoluta en lugar de retraso
+    assert overlay.departure_delay("T2", "C", SCHEDULE, SERVICE_START) == 120
+    # Sin paradas: retraso del viaje
+    assert overlay.departure_delay("T3", "C", SCHEDULE, SERVICE_START) == -60
+    # Antes de la primera parada con predicción no hay datos
+    assert overlay.departure_delay("T2", "A", SCHEDULE, SERVICE_START) is None
+    assert overlay.departure_delay("T9", "C", SCHEDULE, SERVICE_START) is None
+
+
+def test_canceled_trip_and_skipped_stop():
+    overlay = RealtimeOverlay()
+    overlay.apply(feed_message([
+        entity("e1", "T1", canceled=True),
+        entity("e2", "T2", [stop_time_update("C", relationship=STOP_SKIPPED)]),
+    ]))
+
+    assert overlay.departure_delay("T1", "C", SCHEDULE, SERVICE_START) is False
+    assert overlay.departure_delay("T2", "C", SCHEDULE, SERVICE_START) is False
+    assert overlay.departure_delay("T2", "B", SCHEDULE, SERVICE_START) is None
+
+
+def _write_feed(path):
+    """GTFS mínimo con el viaje T1 de SCHEDULE y un viaje T2 que no pasa por C ni D."""
+    files = {
+        "routes.txt": "route_id,route_short_name,route_long_name\nR1,R1,A - D\n",
+        "calendar.txt": (
+            "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+            "S,1,1,1,1,1,1,1,20260101,20261231\n"
+        ),
+        "trips.txt": "route_id,service_id,trip_id,trip_headsign\nR1,S,T1,D\nR1,S,T2,B\n",
+        "stop_times.txt": (
+            "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+            "T1,08:00:00,08:00:00,A,1\nT1,08:05:00,08:05:00,B,2\n"
+            "T1,08:10:00,08:10:00,C,3\nT1,08:15:00,08:15:00,D,4\n"
+            "T2,09:00:00,09:00:00,A,1\nT2,09:05:00,09:05:00,B,2\n"
+        ),
+        "stops.txt": "stop_id,stop_name\nA,A\nB,B\nC,C\nD,D\n",
+    }
+    with zipfile.ZipFile(path, "w") as zip_file:
+        for name, content in files.items():
+            zip_file.writestr(name, content)
+
+
+def test_pruned_feed_keeps_upstream_stops_of_served_trips(tmp_path):
+    _write_feed(tmp_path / "feed.zip")
+    extract_gtfs(tmp_path / "feed.zip", tmp_path / "feed", stop_ids={"C", "D"})
+    index = GTFSIndex.build(str(tmp_path / "feed"))
+
+    schedule = index.trip_schedule("T1")
+    assert [stop for stop, _arrival, _departure in schedule] == ["A", "B", "C", "D"]
+    assert index.trip_schedule("T2") == []
+
+    overlay = RealtimeOverlay()
+    overlay.apply(feed_message([entity("e1", "T1", [stop_time_update("A", delay=300)])]))
+    assert overlay.departure_delay("T1", "C", schedule, SERVICE_START) == 300
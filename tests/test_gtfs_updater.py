@@ -0,0 +1,120 @@
+"""Tests de la descarga condicional del GTFS contra un servidor HTTP local."""
+import os
+import json
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+
+from fgc_trains.gtfs_index import resolve_feed_dir  # noqa: E402
+from fgc_trains.gtfs_updater import async_update_gtfs, read_feed_meta  # noqa: E402
+from fgc_trains.stats import Stats  # noqa: E402
+
+
+class FakeHass:
+    """Lo único que usa async_update_gtfs de ``hass``: el executor."""
+
+    async def async_add_executor_job(self, target, *args):
+        """Ejecutar target en el executor por defecto del loop."""
+        return await asyncio.get_running_loop().run_in_executor(None, target, *args)
+
+
+def _serve(zip_bytes, mode):
+    """Aplicación que sirve zip_bytes con ETag "v2" y registra las peticiones."""
+    requests = []
+
+    async def handler(request):
+        requests.append(dict(request.headers))
+        if mode == "error":
+            return web.Response(status=500)
+        if request.headers.get("If-None-Match") == '"v2"':
+            return web.Response(status=304)
+        if mode == "truncated_zip":
+            return web.Response(body=zip_bytes[:len(zip_bytes) // 2], headers={"ETag": '"v2"'})
+        if mode == "truncated_body":
+            # Content-Length completo pero la conexión se cierra a medias
+            response = web.StreamResponse(headers={"ETag": '"v2"'})
+            response.content_length = len(zip_bytes)
+            await response.prepare(request)
+            await response.write(zip_bytes[:len(zip_bytes) // 2])
+            request.transport.close()
+            return response
+        return web.Response(body=zip_bytes, headers={"ETag": '"v2"', "Last-Modified": "Mon, 05 Jan 2026 00:00:00 GMT"})
+
+    app = web.Application()
+    app.router.add_get("/gtfs.zip", handler)
+    return app, requests
+
+
+async def _update(gtfs_path, zip_bytes, mode, stats):
+    """Arrancar el servidor local y lanzar async_update_gtfs contra él."""
+    app, requests = _serve(zip_bytes, mode)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            result = await async_update_gtfs(
+                FakeHass(), session, gtfs_path, url=f"http://127.0.0.1:{port}/gtfs.zip", stats=stats
+            )
+    finally:
+        await runner.cleanup()
+    return result, requests
+
+
+def _temp_files(gtfs_path):
+    """Descargas temporales que quedan en gtfs_path."""
+    return [name for name in os.listdir(gtfs_path) if name.endswith(".tmp")]
+
+
+def test_not_modified_keeps_active_version(installed_feed, feed_zip):
+    active = resolve_feed_dir(installed_feed)
+    meta = read_feed_meta(active)
+    meta["etag"] = '"v2"'
+    with open(os.path.join(active, "feed_meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    stats = Stats()
+
+    result, requests = asyncio.run(_update(installed_feed, feed_zip.read_bytes(), "ok", stats))
+
+    assert result is True
+    assert requests[0]["If-None-Match"] == '"v2"'
+    assert resolve_feed_dir(installed_feed) == active
+    assert stats.counters == {"download_not_modified": 1}
+    assert _temp_files(installed_feed) == []
+
+
+def test_modified_feed_installs_new_version(installed_feed, feed_zip):
+    active = resolve_feed_dir(installed_feed)
+    stats = Stats()
+
+    result, requests = asyncio.run(_update(installed_feed, feed_zip.read_bytes(), "ok", stats))
+
+    assert result is True
+    # Petición condicional con el ETag de la versión instalada ("v1")
+    assert requests[0]["If-None-Match"] == "v1"
+    new = resolve_feed_dir(installed_feed)
+    assert new != active
+    meta = read_feed_meta(new)
+    assert meta["etag"] == '"v2"'
+    assert meta["size"] == feed_zip.stat().st_size
+    assert stats.values["download_bytes"] == meta["size"]
+    assert _temp_files(installed_feed) == []
+
+
+@pytest.mark.parametrize("mode", ["error", "truncated_body", "truncated_zip"])
+def test_failed_download_keeps_active_version(installed_feed, feed_zip, mode):
+    active = resolve_feed_dir(installed_feed)
+    stats = Stats()
+
+    result, _requests = asyncio.run(_update(installed_feed, feed_zip.read_bytes(), mode, stats))
+
+    # False es lo que programa el reintento con backoff en GTFSFeed
+    assert result is False
+    assert resolve_feed_dir(installed_feed) == active
+    assert stats.counters == {"update_errors": 1}
+    assert _temp_files(installed_feed) == []